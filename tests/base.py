@@ -439,19 +439,28 @@ class FakeGerritConnection(zuul.connection.gerrit.GerritConnection):
             return change.query()
         return {}
 
+    def queryChanges(self, numbers):
+        results = []
+        for number in numbers:
+            change = self.changes.get(int(number))
+            if change:
+                results.append(change.query())
+        return results
+
     def simpleQuery(self, query):
         self.log.debug("simpleQuery: %s" % query)
         self.queries.append(query)
         if query.startswith('change:'):
-            # Query a specific changeid
-            changeid = query[len('change:'):]
+            # Query specific changeids
+            changeids = [q[len('change:'):] for q in query.split(' OR ')]
             l = [change.query() for change in self.changes.values()
-                 if change.data['id'] == changeid]
+                 if change.data['id'] in changeids]
         elif query.startswith('message:'):
-            # Query the content of a commit message
-            msg = query[len('message:'):].strip()
+            # Query the content of commit messages
+            msgs = [q[len('message:'):].strip() for q in query.split(' OR ')]
             l = [change.query() for change in self.changes.values()
-                 if msg in change.data['commitMessage']]
+                 if [msg for msg in msgs
+                     if msg in change.data['commitMessage']]]
         else:
             # Query all open changes
             l = [change.query() for change in self.changes.values()]
@@ -1232,6 +1241,15 @@ class ZuulTestCase(BaseTestCase):
 
         while len(self.gearman_server.functions) < count:
             time.sleep(0)
+        self.launcher.function_registry.waitForRefresh()
+
+    def registerFunction(self, name):
+        # Wait for the launcher to see the function, since it only
+        # looks at the functions from its last refresh.
+        self.worker.registerFunction(name)
+        while name.encode('utf8') not in self.gearman_server.functions:
+            time.sleep(0)
+        self.launcher.function_registry.waitForRefresh()
 
     def orderedRelease(self):
         # Run one build at a time to ensure non-race order:
@@ -1269,11 +1287,15 @@ class ZuulTestCase(BaseTestCase):
         self.gearman_server.functions = set()
         self.rpc.register()
         self.merge_server.register()
+        self.launcher.function_registry.waitForRefresh()
 
     def haveAllBuildsReported(self):
         # See if Zuul is waiting on a meta job to complete
         if self.launcher.meta_jobs:
             return False
+        # See if Zuul is still canceling builds
+        if self.launcher.areCancelsOutstanding():
+            return False
         # Find out if every build that the worker has completed has been
         # reported back to Zuul.  If it hasn't then that means a Gearman
         # event is still in transit and the system is not stable.
@@ -0,0 +1,698 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import threading
+import time
+from uuid import uuid4
+
+import gear
+from six.moves import configparser as ConfigParser
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from tests.base import BaseTestCase
+from zuul import model
+import zuul.launcher.gearman
+from zuul.launcher.gearman import GearmanCanceller
+from zuul.launcher.gearman import GearmanFunctionRegistry
+from zuul.launcher.gearman import ZuulGearmanClient
+
+
+class BaseGearmanLauncherTestCase(BaseTestCase):
+    """Tests of the launcher with its gearman client and threads mocked."""
+
+    def setUp(self):
+        super(BaseGearmanLauncherTestCase, self).setUp()
+        config = ConfigParser.ConfigParser()
+        config.add_section('gearman')
+        config.set('gearman', 'server', '127.0.0.1')
+        for name in ('ZuulGearmanClient', 'GearmanFunctionRegistry',
+                     'GearmanCleanup', 'GearmanCanceller'):
+            patcher = mock.patch('zuul.launcher.gearman.%s' % name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.sched = mock.Mock()
+        self.launcher = zuul.launcher.gearman.Gearman(config, self.sched,
+                                                      None)
+        self.client = self.launcher.gearman
+
+    def makeBuild(self, name, handle=None, connection=None, number=None):
+        build = model.Build(model.Job(name), str(uuid4().hex))
+        build.number = number
+        build._Gearman__gearman_manager = 'manager'
+        job = gear.Job(b'build:' + name.encode('utf8'), b'{}',
+                       unique=build.uuid.encode('utf8'))
+        job.handle = handle
+        job.connection = connection
+        build._Gearman__gearman_job = job
+        self.launcher.builds[job.unique] = build
+        return build
+
+
+class TestZuulGearmanClient(BaseTestCase):
+
+    def setUp(self):
+        super(TestZuulGearmanClient, self).setUp()
+        self.client = ZuulGearmanClient(mock.Mock())
+        self.connection = mock.Mock()
+        self.connection.pending_tasks = []
+        self.client.active_connections = [self.connection]
+        self.client.getConnection = mock.Mock(return_value=self.connection)
+        self.client._lostConnection = mock.Mock()
+        self.client.sendPacket = mock.Mock(side_effect=self.respond)
+        # How the server answers each request for a job, in turn
+        self.responses = {}
+
+    def respond(self, packet, connection):
+        task = connection.pending_tasks[-1]
+        response = self.responses[task.job.name].pop(0)
+        if response == 'broken':
+            connection.pending_tasks.pop()
+            raise Exception("Broken pipe")
+        if response == 'timeout':
+            return
+        connection.pending_tasks.pop()
+        if response == 'created':
+            task.job.handle = b'H:' + task.job.binary_name
+        task.setComplete()
+
+    def makeJob(self, name, *responses):
+        self.responses[name] = list(responses)
+        return gear.Job(name.encode('utf8'), b'{}',
+                        unique=str(uuid4().hex).encode('utf8'))
+
+    def test_submit_jobs(self):
+        "Test that a batch of jobs is submitted before any response"
+        jobs = [self.makeJob('job%s' % i, 'created') for i in range(3)]
+
+        def respond_later(packet, connection):
+            # Hold the responses until every request is sent
+            if len(connection.pending_tasks) < 3:
+                return
+            for task in connection.pending_tasks:
+                task.job.handle = b'H:' + task.job.binary_name
+                task.setComplete()
+            del connection.pending_tasks[:]
+        self.client.sendPacket.side_effect = respond_later
+
+        self.client.submitJobs(jobs, timeout=10)
+        self.assertEqual(self.client.sendPacket.call_count, 3)
+        for job in jobs:
+            self.assertEqual(job.handle, b'H:' + job.binary_name)
+            self.assertEqual(job.connection, self.connection)
+
+    def test_submit_jobs_mixed_results(self):
+        "Test that jobs which fail in a batch are submitted once more"
+        created = self.makeJob('created', 'created')
+        retried = self.makeJob('retried', 'error', 'created')
+        error = self.makeJob('error', 'error', 'error')
+        broken = self.makeJob('broken', 'broken', 'broken')
+        timeout = self.makeJob('timeout', 'timeout', 'timeout')
+        jobs = [created, retried, error, broken, timeout]
+
+        self.client.submitJobs(jobs, timeout=0.1)
+        self.assertEqual(created.handle, b'H:created')
+        self.assertEqual(created.connection, self.connection)
+        self.assertEqual(retried.handle, b'H:retried')
+        self.assertEqual(retried.connection, self.connection)
+        for job in (error, broken, timeout):
+            self.assertIsNone(job.handle)
+            self.assertIsNone(job.connection)
+        # Every job but the first was sent a second time on its own
+        self.assertEqual(self.client.sendPacket.call_count, 9)
+        self.assertEqual(self.client._lostConnection.mock_calls,
+                         [mock.call(self.connection)] * 2)
+        for responses in self.responses.values():
+            self.assertEqual(responses, [])
+
+    def test_submit_job(self):
+        "Test that a job is sent while holding the submit lock"
+        job = self.makeJob('job', 'created')
+        locked = []
+
+        def respond(packet, connection):
+            locked.append(self.client.submit_lock.locked())
+            self.respond(packet, connection)
+        self.client.sendPacket.side_effect = respond
+
+        self.client.submitJob(job, precedence=gear.PRECEDENCE_LOW)
+        self.assertEqual(job.handle, b'H:job')
+        self.assertEqual(job.connection, self.connection)
+        self.assertEqual(locked, [True])
+        packet = self.client.sendPacket.call_args[0][0]
+        self.assertEqual(packet.ptype, gear.constants.SUBMIT_JOB_LOW)
+
+    def test_submit_job_error(self):
+        "Test that a job which no connection accepts raises an error"
+        job = self.makeJob('job', 'error')
+        self.assertRaises(gear.GearmanError, self.client.submitJob, job)
+        self.assertIsNone(job.handle)
+
+
+class TestGearmanLaunchJobs(BaseGearmanLauncherTestCase):
+
+    def setUp(self):
+        super(TestGearmanLaunchJobs, self).setUp()
+        self.launcher.job_registration = False
+        self.item_params = dict(ZUUL_PROJECT='org/project',
+                                ZUUL_PIPELINE='check',
+                                ZUUL_REF='refs/zuul/master/Z1')
+        self.launcher.getItemParameters = mock.Mock(
+            side_effect=lambda *args: dict(self.item_params))
+        self.pipeline = mock.Mock()
+        self.pipeline.name = 'check'
+        self.pipeline.precedence = model.PRECEDENCE_NORMAL
+        queue = mock.Mock()
+        queue.pipeline = self.pipeline
+        change = mock.Mock()
+        change.getBasePath.return_value = '01/1/1'
+        self.item = model.QueueItem(queue, change)
+
+    def makeJobs(self, *names):
+        jobs = []
+        for name in names:
+            jobs.append(model.Job(name))
+            self.item.current_build_set.tries[name] = 1
+        return jobs
+
+    def launch(self, dependent_items=[]):
+        jobs = self.makeJobs('job1')
+        return self.launcher.launchJobs(jobs, self.item, self.pipeline,
+                                        dependent_items)[0]
+
+    def submit(self, jobs, precedence, timeout):
+        for job in jobs:
+            if not job.name.endswith('fail'):
+                job.handle = b'H:' + job.binary_name
+
+    def test_launch_jobs(self):
+        "Test that each build has its own parameters besides the item's"
+        self.client.submitJobs.side_effect = self.submit
+        jobs = self.makeJobs('job1', 'job2')
+
+        builds = self.launcher.launchJobs(jobs, self.item, self.pipeline)
+        self.assertEqual(len(builds), 2)
+        self.assertEqual(self.launcher.getItemParameters.call_count, 1)
+        self.assertEqual(self.client.submitJobs.call_count, 1)
+        self.assertNotEqual(builds[0].parameters['ZUUL_UUID'],
+                            builds[1].parameters['ZUUL_UUID'])
+        for build, job in zip(builds, jobs):
+            params = build.parameters
+            self.assertEqual(params['ZUUL_UUID'], build.uuid)
+            self.assertEqual(params['LOG_PATH'], '01/1/1/check/%s/%s' % (
+                job.name, build.uuid[:7]))
+            for key, value in self.item_params.items():
+                self.assertEqual(params[key], value)
+            self.assertEqual(json.loads(
+                build._Gearman__gearman_job.arguments), params)
+        self.assertFalse(self.sched.onBuildCompleted.called)
+
+    def test_launch_jobs_failed_submit(self):
+        "Test that builds which could not be submitted are completed"
+        self.client.submitJobs.side_effect = self.submit
+        self.launcher.launch_batch_size = 2
+        jobs = self.makeJobs('job1', 'job2-fail', 'job3', 'job4-fail')
+
+        builds = self.launcher.launchJobs(jobs, self.item, self.pipeline)
+        self.assertEqual(len(builds), 4)
+        self.assertEqual(self.client.submitJobs.call_count, 2)
+        self.assertEqual(self.sched.onBuildCompleted.mock_calls,
+                         [mock.call(builds[1], 'EXCEPTION'),
+                          mock.call(builds[3], 'EXCEPTION')])
+        self.assertEqual(sorted(self.launcher.builds.values(),
+                                key=lambda b: b.job.name),
+                         [builds[0], builds[2]])
+
+    def test_parameters_reused(self):
+        "Test that the item parameters are reused within a build set"
+        self.client.submitJobs.side_effect = self.submit
+        build_set = self.item.current_build_set
+        build_set.merge_state = build_set.COMPLETE
+
+        first = self.launch()
+        second = self.launch()
+        self.assertEqual(self.launcher.getItemParameters.call_count, 1)
+        self.assertEqual(build_set.parameters, self.item_params)
+        self.assertEqual(build_set.parameters_items, [])
+        self.assertNotEqual(first.parameters['ZUUL_UUID'],
+                            second.parameters['ZUUL_UUID'])
+        # The builds' own parameters are not added to the shared ones
+        self.assertNotIn('ZUUL_UUID', build_set.parameters)
+
+    def test_parameters_before_merge(self):
+        "Test that the item parameters are not kept until merged"
+        self.client.submitJobs.side_effect = self.submit
+        self.launch()
+        self.launch()
+        self.assertEqual(self.launcher.getItemParameters.call_count, 2)
+        self.assertIsNone(self.item.current_build_set.parameters)
+
+    def test_parameters_dependent_items_changed(self):
+        "Test that the item parameters follow the items ahead"
+        self.client.submitJobs.side_effect = self.submit
+        build_set = self.item.current_build_set
+        build_set.merge_state = build_set.COMPLETE
+        ahead = mock.Mock()
+
+        self.launch([ahead])
+        self.launch([ahead])
+        self.assertEqual(self.launcher.getItemParameters.call_count, 1)
+        # The item ahead left the queue
+        self.launch([])
+        self.assertEqual(self.launcher.getItemParameters.call_count, 2)
+        self.assertEqual(
+            self.launcher.getItemParameters.call_args[0][2], [])
+        self.assertEqual(build_set.parameters_items, [])
+
+    def test_parameters_reset(self):
+        "Test that the item parameters are worked out again after a reset"
+        self.client.submitJobs.side_effect = self.submit
+        build_set = self.item.current_build_set
+        build_set.merge_state = build_set.COMPLETE
+        self.launch()
+
+        self.item.resetAllBuilds()
+        new_build_set = self.item.current_build_set
+        self.assertIsNone(new_build_set.parameters)
+        new_build_set.merge_state = new_build_set.COMPLETE
+        self.item_params['ZUUL_REF'] = 'refs/zuul/master/Z2'
+        build = self.launch()
+        self.assertEqual(self.launcher.getItemParameters.call_count, 2)
+        self.assertEqual(build.parameters['ZUUL_REF'], 'refs/zuul/master/Z2')
+        self.assertEqual(new_build_set.parameters['ZUUL_REF'],
+                         'refs/zuul/master/Z2')
+        self.assertEqual(build_set.parameters['ZUUL_REF'],
+                         'refs/zuul/master/Z1')
+
+
+class TestGearmanCanceller(BaseGearmanLauncherTestCase):
+
+    def test_cancel_batches(self):
+        "Test that builds canceled while a batch is running are batched"
+        launcher = mock.Mock()
+        canceling = threading.Event()
+        proceed = threading.Event()
+
+        def cancel_builds(builds):
+            canceling.set()
+            proceed.wait(10)
+        launcher.cancelBuilds.side_effect = cancel_builds
+
+        canceller = GearmanCanceller(launcher)
+        canceller.start()
+        self.addCleanup(canceller.stop)
+        builds = [self.makeBuild('job%s' % i) for i in range(3)]
+
+        canceller.cancel(builds[0])
+        self.assertTrue(canceling.wait(10))
+        canceller.cancel(builds[1])
+        canceller.cancel(builds[2])
+        self.assertEqual(canceller.outstanding, 3)
+        proceed.set()
+
+        for x in range(100):
+            if not canceller.outstanding:
+                break
+            time.sleep(0.1)
+        self.assertEqual(canceller.outstanding, 0)
+        self.assertEqual(launcher.cancelBuilds.mock_calls,
+                         [mock.call([builds[0]]),
+                          mock.call([builds[1], builds[2]])])
+
+    def test_cancel_queued_builds(self):
+        "Test that queued builds are removed with one batch of requests"
+        connection = mock.Mock()
+        found = self.makeBuild('found', handle=b'H:1', connection=connection)
+        missing = self.makeBuild('missing', handle=b'H:2',
+                                 connection=connection)
+
+        def respond(connection, requests, timeout):
+            requests[0].response = 'OK\n'
+            requests[1].response = 'ERR UNKNOWN_JOB\n'
+            return True
+        self.client.sendAdminRequests.side_effect = respond
+
+        with mock.patch('time.sleep') as sleep:
+            self.launcher.cancelBuilds([found, missing])
+
+        self.assertEqual(self.client.sendAdminRequests.call_count, 1)
+        requests = self.client.sendAdminRequests.call_args[0][1]
+        self.assertEqual(len(requests), 2)
+        sleep.assert_called_once_with(1)
+        self.assertFalse(self.client.submitJobs.called)
+        self.assertEqual(self.sched.onBuildCanceled.mock_calls,
+                         [mock.call(found, 'DEQUEUED'),
+                          mock.call(missing, 'NOT_FOUND')])
+        self.assertNotIn(found._Gearman__gearman_job.unique,
+                         self.launcher.builds)
+
+    def test_cancel_build_starting(self):
+        "Test that a build which starts while it is canceled is stopped"
+        connection = mock.Mock()
+        build = self.makeBuild('starting', handle=b'H:1',
+                               connection=connection)
+
+        def respond(connection, requests, timeout):
+            requests[0].response = 'ERR UNKNOWN_JOB\n'
+            return True
+        self.client.sendAdminRequests.side_effect = respond
+
+        def start(delay):
+            # The build starts while waiting to look for it again
+            build.number = 1
+
+        def submit(jobs, precedence, timeout):
+            for job in jobs:
+                job.handle = b'H:stop'
+        self.client.submitJobs.side_effect = submit
+
+        with mock.patch('time.sleep', side_effect=start):
+            self.launcher.cancelBuilds([build])
+
+        self.assertEqual(self.client.submitJobs.call_count, 1)
+        jobs = self.client.submitJobs.call_args[0][0]
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0].name, 'stop:manager')
+        self.sched.onBuildCanceled.assert_called_once_with(build, 'STOPPED')
+
+    def test_cancel_running_builds(self):
+        "Test that running builds are stopped with one batch of jobs"
+        connection = mock.Mock()
+        stopped = self.makeBuild('stopped', handle=b'H:1',
+                                 connection=connection, number=1)
+        unstopped = self.makeBuild('unstopped', handle=b'H:2',
+                                   connection=connection, number=2)
+
+        def submit(jobs, precedence, timeout):
+            # Only the first stop job could be submitted
+            jobs[0].handle = b'H:stop'
+        self.client.submitJobs.side_effect = submit
+
+        with mock.patch('time.sleep') as sleep:
+            self.launcher.cancelBuilds([stopped, unstopped])
+
+        self.assertFalse(sleep.called)
+        self.assertFalse(self.client.sendAdminRequests.called)
+        self.assertEqual(self.client.submitJobs.call_count, 1)
+        jobs = self.client.submitJobs.call_args[0][0]
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(self.client.submitJobs.call_args[1]['precedence'],
+                         gear.PRECEDENCE_HIGH)
+        self.assertEqual(list(self.launcher.meta_jobs.keys()),
+                         [jobs[0].unique])
+        self.assertEqual(self.sched.onBuildCanceled.mock_calls,
+                         [mock.call(stopped, 'STOPPED'),
+                          mock.call(unstopped, 'NOT_FOUND')])
+
+    def test_cancel_unlaunched_build(self):
+        "Test that canceling a build which was never submitted is reported"
+        build = self.makeBuild('unlaunched')
+        unknown = model.Build(model.Job('unknown'), str(uuid4().hex))
+
+        self.launcher.cancelBuilds([build, unknown])
+
+        self.assertFalse(self.client.sendAdminRequests.called)
+        self.assertFalse(self.client.submitJobs.called)
+        self.assertEqual(self.sched.onBuildCanceled.mock_calls,
+                         [mock.call(build, 'NOT_LAUNCHED'),
+                          mock.call(unknown, 'NOT_LAUNCHED')])
+
+    def test_canceled_build_completed(self):
+        "Test that the completion of a canceled build is reported"
+        build = self.makeBuild('stopped', number=1)
+        build.canceled = True
+        job = build._Gearman__gearman_job
+        job.data = [b'{"result": "ABORTED"}']
+
+        self.launcher.onBuildCompleted(job)
+
+        self.assertFalse(self.sched.onBuildCompleted.called)
+        self.sched.onBuildCanceled.assert_called_once_with(build,
+                                                           'COMPLETED')
+        self.assertNotIn(job.unique, self.launcher.builds)
+
+
+class TestGearmanLostBuilds(BaseGearmanLauncherTestCase):
+
+    def setUp(self):
+        super(TestGearmanLostBuilds, self).setUp()
+        self.launcher.lost_build_timeout = 30
+        # The status responses are handled by a real client
+        patcher = mock.patch('zuul.launcher.gearman.ZuulGearmanClient',
+                             ZuulGearmanClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.status_client = ZuulGearmanClient(self.launcher)
+        self.statuses = {}
+        self.client.sendPacket.side_effect = self.respond
+
+    def respond(self, packet, connection):
+        # Answer a status request as the gearman server would
+        handle = packet.getArgument(0)
+        known = self.statuses[handle]
+        if callable(known):
+            known = known()
+        response = gear.Packet(gear.constants.RES, gear.constants.STATUS_RES,
+                               b'\x00'.join([handle, known, b'0', b'0',
+                                             b'0']),
+                               connection=connection)
+        self.status_client.handleStatusRes(response)
+
+    def makeConnection(self, *builds):
+        connection = mock.Mock()
+        connection.related_jobs = {}
+        for build in builds:
+            job = build._Gearman__gearman_job
+            job.connection = connection
+            connection.related_jobs[job.handle] = job
+        return connection
+
+    def getCompleted(self):
+        return set([(c[1][0].job.name, c[1][1])
+                    for c in self.sched.onBuildCompleted.mock_calls])
+
+    def test_lost_builds(self):
+        "Test that builds gearman does not know about are lost"
+        running = self.makeBuild('running', handle=b'H:1', number=1)
+        lost = self.makeBuild('lost', handle=b'H:2', number=2)
+        forgotten = self.makeBuild('forgotten', handle=b'H:3', number=3)
+        connection = self.makeConnection(running, lost)
+        forgotten._Gearman__gearman_job.connection = connection
+        self.statuses = {b'H:1': b'1', b'H:2': b'0', b'H:3': b'1'}
+
+        self.launcher.lookForLostBuilds()
+        self.assertEqual(self.client.sendPacket.call_count, 3)
+        # The client no longer knows about the job of the forgotten
+        # build, so its status raises UnknownJobError.
+        self.assertEqual(self.getCompleted(),
+                         set([('lost', 'LOST'), ('forgotten', 'LOST')]))
+        self.assertEqual(list(self.launcher.builds.values()), [running])
+
+    def test_builds_completed_while_looking(self):
+        "Test that builds which complete while looking are not lost"
+        finished = self.makeBuild('finished', handle=b'H:1', number=1)
+        removed = self.makeBuild('removed', handle=b'H:2', number=2)
+        self.makeConnection(finished, removed)
+
+        def finish():
+            finished.result = 'SUCCESS'
+            return b'0'
+
+        def remove():
+            del self.launcher.builds[removed._Gearman__gearman_job.unique]
+            return b'0'
+        self.statuses = {b'H:1': finish, b'H:2': remove}
+
+        self.launcher.lookForLostBuilds()
+        self.assertEqual(self.client.sendPacket.call_count, 2)
+        self.assertFalse(self.sched.onBuildCompleted.called)
+
+    def test_lost_connections(self):
+        "Test that builds on lost connections are not waited for"
+        self.makeBuild('disconnected', handle=b'H:1', number=1)
+        broken = self.makeBuild('broken', handle=b'H:2', number=2)
+        self.makeConnection(broken)
+        self.client.sendPacket.side_effect = Exception("Broken pipe")
+
+        start = time.time()
+        self.launcher.lookForLostBuilds()
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(self.client.sendPacket.call_count, 1)
+        self.assertFalse(self.sched.onBuildCompleted.called)
+
+
+class TestGearmanJobRegistered(BaseGearmanLauncherTestCase):
+
+    def setUp(self):
+        super(TestGearmanJobRegistered, self).setUp()
+        self.registry = self.launcher.function_registry
+        self.registry.functions = frozenset(['build:a'])
+        self.registry.refresh_time = 1
+        self.registry.isStale.return_value = False
+
+    def test_registered(self):
+        "Test that a registered function is found without a refresh"
+        self.assertTrue(self.launcher.isJobRegistered('build:a'))
+        self.assertFalse(self.registry.requestRefresh.called)
+        self.assertFalse(self.registry.waitForRefresh.called)
+
+    def test_stale(self):
+        "Test that stale functions are used while they are refreshed"
+        self.registry.isStale.return_value = True
+        self.assertTrue(self.launcher.isJobRegistered('build:a'))
+        self.registry.requestRefresh.assert_called_once_with(
+            self.launcher.negative_function_cache_ttl)
+        self.assertFalse(self.registry.waitForRefresh.called)
+
+    def test_not_registered(self):
+        "Test that a missing function asks for a refresh"
+        self.assertFalse(self.launcher.isJobRegistered('build:b'))
+        self.registry.requestRefresh.assert_called_once_with(
+            self.launcher.negative_function_cache_ttl)
+        self.assertFalse(self.registry.waitForRefresh.called)
+
+    def test_not_refreshed(self):
+        "Test that functions are assumed registered before a refresh"
+        self.registry.functions = frozenset()
+        self.registry.refresh_time = 0
+        self.registry.isStale.return_value = True
+        self.assertTrue(self.launcher.isJobRegistered('build:b'))
+        self.assertTrue(self.registry.requestRefresh.called)
+        self.assertFalse(self.registry.waitForRefresh.called)
+
+
+class TestGearmanFunctionRegistry(BaseTestCase):
+
+    def setUp(self):
+        super(TestGearmanFunctionRegistry, self).setUp()
+        self.client = mock.Mock()
+        self.connections = [mock.Mock(connect_time=1),
+                            mock.Mock(connect_time=1)]
+        self.client.active_connections = self.connections
+        self.responses = {}
+        self.client.sendAdminRequests.side_effect = self.respond
+        self.registry = GearmanFunctionRegistry(self.client)
+
+    def respond(self, connection, requests, timeout):
+        response = self.responses[connection]
+        if isinstance(response, Exception):
+            raise response
+        requests[0].response = response
+        return True
+
+    def setFunctions(self, connection, *lines):
+        self.responses[connection] = '\n'.join(lines + ('.', ''))
+
+    def test_refresh(self):
+        "Test that the functions of every connection are combined"
+        self.setFunctions(self.connections[0],
+                          'build:a\t0\t0\t1', 'build:b\t0\t0\t1')
+        self.setFunctions(self.connections[1], 'build:c\t1\t0\t1')
+
+        self.registry.refresh()
+        self.assertEqual(self.registry.functions,
+                         set(['build:a', 'build:b', 'build:c']))
+        self.assertEqual(self.registry.generation, 1)
+        self.assertNotEqual(self.registry.refresh_time, 0)
+        self.assertFalse(self.registry.isStale())
+
+    def test_refresh_changed_lines(self):
+        "Test that only the lines which changed are parsed"
+        self.setFunctions(self.connections[0], 'build:a\t0\t0\t1',
+                          'build:b\t0\t0\t1', 'build:c\t0\t0\t1')
+        self.setFunctions(self.connections[1])
+        self.registry.refresh()
+
+        # build:a is running, build:b was unregistered and build:d
+        # was registered.
+        self.setFunctions(self.connections[0], 'build:a\t1\t1\t1',
+                          'build:c\t0\t0\t1', 'build:d\t0\t0\t1')
+        with mock.patch.object(self.registry, '_getFunctionNames',
+                               wraps=self.registry._getFunctionNames) as get:
+            self.registry.refresh()
+        parsed = set()
+        for call in get.mock_calls:
+            parsed |= set(call[1][0])
+        self.assertEqual(parsed, set(['build:a\t0\t0\t1',
+                                      'build:a\t1\t1\t1',
+                                      'build:b\t0\t0\t1',
+                                      'build:d\t0\t0\t1']))
+        self.assertEqual(self.registry.functions,
+                         set(['build:a', 'build:c', 'build:d']))
+
+    def test_refresh_failed_connection(self):
+        "Test that a failed connection keeps its functions"
+        self.setFunctions(self.connections[0], 'build:a\t0\t0\t1')
+        self.setFunctions(self.connections[1], 'build:b\t0\t0\t1')
+        self.registry.refresh()
+        refresh_time = self.registry.refresh_time
+
+        self.setFunctions(self.connections[0], 'build:c\t0\t0\t1')
+        self.responses[self.connections[1]] = Exception("Timed out")
+        self.registry.refresh()
+        self.assertEqual(self.registry.functions,
+                         set(['build:b', 'build:c']))
+        self.assertEqual(self.registry.refresh_time, refresh_time)
+        self.assertEqual(self.registry.generation, 2)
+
+        # A connection which goes away takes its functions with it
+        self.connections.pop()
+        self.registry.refresh()
+        self.assertEqual(self.registry.functions, set(['build:c']))
+        self.assertNotEqual(self.registry.refresh_time, refresh_time)
+
+    def test_is_stale(self):
+        "Test that the functions are stale until refreshed after connecting"
+        self.setFunctions(self.connections[0], 'build:a\t0\t0\t1')
+        self.setFunctions(self.connections[1])
+        self.assertTrue(self.registry.isStale())
+        self.registry.refresh()
+        self.assertFalse(self.registry.isStale())
+
+        # The server may have restarted without its functions
+        self.connections[1].connect_time = time.time() + 1
+        self.assertTrue(self.registry.isStale())
+
+        self.client.active_connections = []
+        self.registry.refresh()
+        self.assertTrue(self.registry.isStale())
+
+    def test_wait_for_refresh(self):
+        "Test that waiting for a refresh wakes the registry thread"
+        self.setFunctions(self.connections[0], 'build:a\t0\t0\t1')
+        self.setFunctions(self.connections[1])
+        self.registry.refresh_interval = 300
+        self.registry.start()
+        self.addCleanup(self.registry.join)
+        self.addCleanup(self.registry.stop)
+
+        self.assertTrue(self.registry.waitForRefresh(timeout=10))
+        self.assertEqual(self.registry.functions, set(['build:a']))
+        generation = self.registry.generation
+
+        self.setFunctions(self.connections[1], 'build:b\t0\t0\t1')
+        self.assertTrue(self.registry.waitForRefresh(timeout=10))
+        self.assertGreater(self.registry.generation, generation)
+        self.assertEqual(self.registry.functions,
+                         set(['build:a', 'build:b']))
+
+    def test_request_refresh(self):
+        "Test that a refresh is only requested if the last one is old"
+        self.registry.attempt_time = time.time()
+        self.registry.requestRefresh(60)
+        self.assertFalse(self.registry.wake_event.is_set())
+        self.registry.requestRefresh(0)
+        self.assertTrue(self.registry.wake_event.is_set())
@@ -13,7 +13,15 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import gzip
+import json
 import os
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import urllib
 
 try:
     from unittest import mock
@@ -21,7 +29,11 @@ except ImportError:
     import mock
 
 from tests.base import BaseTestCase
-from zuul.connection.gerrit import GerritConnection
+from zuul import model
+from zuul.connection.gerrit import GerritChangeCache, GerritConnection
+from zuul.connection.gerrit import GerritEventConnector, GerritHTTPError
+from zuul.connection.gerrit import GerritSSHPool
+from zuul.source.gerrit import GerritSource
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures/gerrit')
 
@@ -78,3 +90,679 @@ class TestGerrit(BaseTestCase):
                  'simple_query_pagination_old_3']
         expected_patches = 5
         self.run_query(files, expected_patches)
+
+
+class TestGerritSSHPool(BaseTestCase):
+
+    def setUp(self):
+        super(TestGerritSSHPool, self).setUp()
+        patcher = mock.patch('paramiko.SSHClient')
+        self.ssh_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ssh_client.side_effect = lambda: mock.MagicMock()
+        self.pool = GerritSSHPool('localhost', 'gerrit', size=2, channels=2,
+                                  keepalive=30)
+
+    def test_pool_shares_channels(self):
+        a = self.pool.acquire()
+        b = self.pool.acquire()
+        c = self.pool.acquire()
+        d = self.pool.acquire()
+        self.assertEqual(self.ssh_client.call_count, 2)
+        self.assertNotEqual(a, b)
+        self.assertEqual(set([a, b]), set([c, d]))
+        a.get_transport().set_keepalive.assert_called_with(30)
+
+        # The pool is full, so a fifth caller must wait
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(self.pool.acquire()))
+        thread.daemon = True
+        thread.start()
+        thread.join(0.5)
+        self.assertEqual(acquired, [])
+        self.pool.release(a)
+        thread.join(5)
+        self.assertEqual(acquired, [a])
+
+    def test_pool_replaces_dead_connections(self):
+        a = self.pool.acquire()
+        self.pool.release(a)
+        a.get_transport().is_active.return_value = False
+        b = self.pool.acquire()
+        self.assertNotEqual(a, b)
+        a.close.assert_called_with()
+
+    def test_pool_discard(self):
+        self.pool.size = 1
+        a = self.pool.acquire()
+        b = self.pool.acquire()
+        self.assertEqual(a, b)
+        self.pool.release(a, discard=True)
+        self.assertFalse(a.close.called)
+        c = self.pool.acquire()
+        self.assertNotEqual(a, c)
+        self.pool.release(b)
+        a.close.assert_called_with()
+
+
+CURRENT_SHA = '2' * 40
+PARENT_SHA = '3' * 40
+CHILD_SHA = '4' * 40
+
+
+def http_change(number, sha, status='NEW', more_changes=False,
+                parent=PARENT_SHA):
+    change = {
+        '_number': number,
+        'project': 'org/project',
+        'branch': 'master',
+        'change_id': 'I%040d' % number,
+        'subject': 'Change %s' % number,
+        'status': status,
+        'updated': '2015-01-01 00:00:10.000000000',
+        'owner': {'name': 'Owner', 'email': 'owner@example.com',
+                  'username': 'owner'},
+        'current_revision': sha,
+        'revisions': {
+            '1' * 40: {'_number': 1, 'ref': 'refs/changes/%02d/%s/1' % (
+                number % 100, number)},
+            sha: {'_number': 2,
+                  'ref': 'refs/changes/%02d/%s/2' % (number % 100, number),
+                  'files': {'README': {}},
+                  'commit': {'message': 'Change %s\n' % number,
+                             'parents': [{'commit': parent}]}},
+        },
+        'labels': {
+            'Code-Review': {
+                'approved': {'username': 'reviewer'},
+                'all': [{'value': 2, 'date': '2015-01-01 00:00:05.000000000',
+                         'name': 'Reviewer', 'email': 'rev@example.com',
+                         'username': 'reviewer'},
+                        {'value': 0, 'username': 'other'}]},
+            'Verified': {'all': []},
+        },
+    }
+    if more_changes:
+        change['_more_changes'] = True
+    return change
+
+
+class TestGerritChangeCache(BaseTestCase):
+
+    def setUp(self):
+        super(TestGerritChangeCache, self).setUp()
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = GerritChangeCache(size=3, ttl=60)
+
+    def test_lru_eviction(self):
+        for i in range(3):
+            self.cache.put('%s,1' % i, 'change%s' % i)
+        self.assertEqual(self.cache.get('0,1'), 'change0')
+        self.cache.put('3,1', 'change3')
+        # 1,1 was the least recently used
+        self.assertEqual(sorted(self.cache.keys()), ['0,1', '2,1', '3,1'])
+        self.assertIsNone(self.cache.get('1,1'))
+
+    def test_ttl(self):
+        self.cache.put('1,1', 'change1')
+        self.now += 30
+        self.cache.put('2,1', 'change2')
+        self.assertIn('1,1', self.cache)
+        self.now += 40
+        self.assertNotIn('1,1', self.cache)
+        self.assertIsNone(self.cache.get('1,1'))
+        self.assertEqual(self.cache.get('2,1'), 'change2')
+
+    def test_pinned_changes_are_kept(self):
+        self.cache.put('1,1', 'change1')
+        self.cache.put('2,1', 'change2')
+        self.cache.pin('item', ['1,1', '2,1'])
+        self.now += 120
+        for i in range(3, 6):
+            self.cache.put('%s,1' % i, 'change%s' % i)
+        self.assertEqual(self.cache.get('1,1'), 'change1')
+        self.assertEqual(self.cache.get('2,1'), 'change2')
+        self.assertEqual(len(self.cache), 3)
+
+        # Re-pinning replaces the owner's previous pins, and the ttl
+        # of an unpinned change starts when it is released
+        self.cache.pin('item', ['1,1'])
+        self.assertIn('2,1', self.cache)
+        self.cache.unpin('item')
+        self.now += 30
+        self.assertEqual(self.cache.get('1,1'), 'change1')
+        self.now += 61
+        self.assertIsNone(self.cache.get('1,1'))
+
+    def test_pin_related(self):
+        self.cache.pin('item', ['1,1'])
+        self.cache.pinRelated('1,1', ['2,1', '3,1'])
+        self.cache.pinRelated('2,1', ['4,1'])
+        self.cache.pinRelated('5,1', ['6,1'])
+        self.assertEqual(self.cache.owners,
+                         {'item': set(['1,1', '2,1', '3,1', '4,1'])})
+        self.assertEqual(sorted(self.cache.pins.keys()),
+                         ['1,1', '2,1', '3,1', '4,1'])
+        self.cache.unpin('item')
+        self.assertEqual(self.cache.pins, {})
+        self.assertEqual(self.cache.owners, {})
+
+    @mock.patch('zuul.connection.gerrit.statsd')
+    def test_stats(self, statsd):
+        self.cache.stats_prefix = 'zuul.test'
+        self.cache.get('1,1')
+        self.cache.put('1,1', 'change1')
+        self.cache.get('1,1')
+        self.cache.get('1,1', refresh=True)
+        self.now += 60
+        self.cache.get('1,1')
+        statsd.incr.assert_has_calls([
+            mock.call('zuul.test.misses', 1),
+            mock.call('zuul.test.hits', 1),
+            mock.call('zuul.test.refreshes', 1),
+            mock.call('zuul.test.evictions', 1),
+            mock.call('zuul.test.misses', 1)])
+
+    def test_lock_change(self):
+        self.cache.lockChange('1,1')
+        locked = threading.Event()
+
+        def lock():
+            self.cache.lockChange('1,1')
+            locked.set()
+            self.cache.unlockChange('1,1')
+        thread = threading.Thread(target=lock)
+        thread.start()
+        # Another thread waits for the lock, even though the change
+        # is not in the cache yet.
+        self.assertFalse(locked.wait(0.1))
+        self.cache.put('1,1', 'change1')
+        self.assertFalse(locked.wait(0.1))
+        self.cache.unlockChange('1,1')
+        self.assertTrue(locked.wait(10))
+        thread.join()
+        self.assertEqual(self.cache.change_locks, {})
+        self.assertEqual(self.cache.lock_holders, {})
+
+    def test_lock_related_change(self):
+        locked = threading.Event()
+        release = threading.Event()
+
+        def update():
+            self.cache.lockChange('1,1')
+            self.cache.put('1,1', 'change1')
+            locked.set()
+            release.wait(10)
+            self.cache.unlockChange('1,1')
+        thread = threading.Thread(target=update)
+        thread.start()
+        self.assertTrue(locked.wait(10))
+
+        # While updating a change, a change which another thread is
+        # updating is returned rather than waited for.
+        self.assertIsNone(self.cache.lockChange('2,1'))
+        self.assertIsNone(self.cache.lockChange('2,1'))
+        self.assertEqual(self.cache.lockChange('1,1'), 'change1')
+        self.cache.unlockChange('2,1')
+        self.cache.unlockChange('2,1')
+        release.set()
+        thread.join()
+        self.assertEqual(self.cache.change_locks, {})
+        self.assertEqual(self.cache.lock_holders, {})
+
+
+class TestGerritEventConnector(BaseTestCase):
+
+    def setUp(self):
+        super(TestGerritEventConnector, self).setUp()
+        self.connection = GerritConnection('review_gerrit', {
+            'user': 'gerrit',
+            'server': 'localhost',
+        })
+        self.connection.event_queue = six.moves.queue.Queue()
+        self.connection.sched = mock.Mock()
+        self.delivered = []
+        self.connection.sched.addEvent.side_effect = self.delivered.append
+        self.source = mock.Mock()
+        self.connection.registerUse('source', self.source)
+        trigger = mock.Mock(connection=self.connection)
+        pipeline = mock.Mock()
+        pipeline.manager.event_filters = [
+            model.EventFilter(trigger, types=['comment-added'],
+                              comments=['(first|second|third)'])]
+        self.connection.sched.layout.pipelines = {'check': pipeline}
+        self.connector = GerritEventConnector(self.connection, workers=2)
+        self.connector.delay = 0.0
+        self.connector.start()
+        self.addCleanup(self.connector.join)
+        self.addCleanup(self.connector.stop)
+
+    def addEvent(self, number, comment):
+        self.connection.addEvent({
+            'type': 'comment-added',
+            'change': {'project': 'org/project', 'number': str(number)},
+            'patchSet': {'number': '1'},
+            'comment': comment,
+        })
+
+    def test_events_delivered_in_order(self):
+        release = threading.Event()
+        refreshed = []
+
+        def getChange(number, patchset, refresh=False):
+            if number == '1':
+                release.wait(10)
+            refreshed.append(number)
+        self.source._getChange.side_effect = getChange
+
+        self.addEvent(1, 'first')
+        self.addEvent(2, 'second')
+        self.addEvent(4, 'third')
+        # Change 2 is refreshed while change 1 is still being
+        # refreshed, but its event waits for change 1's to be
+        # delivered.  Change 4 is handled by the same worker as
+        # change 2.
+        for x in range(100):
+            if len(refreshed) == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(refreshed, ['2', '4'])
+        self.assertEqual(self.delivered, [])
+        release.set()
+        self.connection.event_queue.join()
+        self.assertEqual(refreshed, ['2', '4', '1'])
+        self.assertEqual([e.comment for e in self.delivered],
+                         ['first', 'second', 'third'])
+
+    def test_stop_drains_queues(self):
+        release = threading.Event()
+        refreshing = threading.Event()
+
+        def getChange(number, patchset, refresh=False):
+            refreshing.set()
+            release.wait(10)
+        self.source._getChange.side_effect = getChange
+
+        self.addEvent(1, 'first')
+        self.addEvent(1, 'second')
+        self.addEvent(1, 'third')
+        self.assertTrue(refreshing.wait(10))
+        queue = self.connector.worker_queues[1]
+        for x in range(100):
+            if queue.qsize() == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(queue.qsize(), 2)
+
+        # The events waiting for the worker are not refreshed, but
+        # are all marked done.
+        self.connector.stop()
+        release.set()
+        self.connection.event_queue.join()
+        self.assertEqual(self.source._getChange.call_count, 1)
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(len(self.connector.pending), 0)
+
+    def test_failed_refresh(self):
+        self.source._getChange.side_effect = [Exception("Gerrit error"),
+                                              None]
+        self.addEvent(1, 'first')
+        self.addEvent(1, 'second')
+        self.connection.event_queue.join()
+        self.assertEqual([e.comment for e in self.delivered], ['second'])
+
+    def test_skip_unmatched_refresh(self):
+        self.addEvent(1, 'unrelated')
+        self.addEvent(1, 'first')
+        self.connection.event_queue.join()
+        self.assertEqual(self.connector.skipped_refreshes, 1)
+        self.assertEqual(self.source._getChange.call_count, 1)
+        # Both events are delivered, but only the one which can match
+        # a pipeline needs its change.
+        self.assertEqual([(e.comment, e.skip_change_query)
+                          for e in self.delivered],
+                         [('unrelated', True), ('first', False)])
+
+    def test_refresh_cached_change(self):
+        # Changes which are already known are always refreshed so
+        # that the items using them are kept up to date.
+        self.connection.updateChangeCache('1,1', mock.Mock())
+        self.addEvent(1, 'unrelated')
+        self.connection.event_queue.join()
+        self.assertEqual(self.connector.skipped_refreshes, 0)
+        self.assertEqual(self.source._getChange.call_count, 1)
+        self.assertEqual([e.comment for e in self.delivered], ['unrelated'])
+
+    def test_refresh_pinned_change(self):
+        # A queue item uses another patchset of the change
+        self.connection.updateChangeCache('1,2', mock.Mock())
+        self.connection.pinChanges('item', ['1,2'])
+        self.addEvent(1, 'unrelated')
+        self.connection.event_queue.join()
+        self.assertEqual(self.connector.skipped_refreshes, 0)
+        self.assertEqual(self.source._getChange.call_count, 1)
+        self.assertFalse(self.delivered[0].skip_change_query)
+
+
+def source_change(number, parent=None, depends_on=(), status='NEW'):
+    data = {
+        'project': 'org/project',
+        'branch': 'master',
+        'id': 'I%040d' % number,
+        'number': str(number),
+        'url': 'https://review.example.com/%s' % number,
+        'commitMessage': 'Change %s\n\n%s' % (
+            number, ''.join(['Depends-On: I%040d\n' % n
+                             for n in depends_on])),
+        'patchSets': [{'number': '1',
+                       'ref': 'refs/changes/%02d/%s/1' % (number, number)}],
+        'currentPatchSet': {'number': '1'},
+        'open': status == 'NEW',
+        'status': status,
+        'owner': {'username': 'owner'},
+    }
+    if parent:
+        data['dependsOn'] = [{'ref': 'refs/changes/%02d/%s/1' % (
+            parent, parent)}]
+    return data
+
+
+class TestGerritSource(BaseTestCase):
+
+    def setUp(self):
+        super(TestGerritSource, self).setUp()
+        self.changes = {}
+        self.cache = GerritChangeCache()
+        connection = mock.Mock()
+        connection.getCachedChange.side_effect = self.cache.get
+        connection.isChangeCached.side_effect = \
+            lambda key: key in self.cache
+        connection.updateChangeCache.side_effect = self.cache.put
+        connection.deleteCachedChange.side_effect = self.cache.delete
+        connection.lockChange.side_effect = self.cache.lockChange
+        connection.unlockChange.side_effect = self.cache.unlockChange
+        connection.pinRelatedChanges.side_effect = self.cache.pinRelated
+        connection.query.side_effect = lambda number: json.loads(
+            json.dumps(self.changes[str(number)]))
+        connection.queryChanges.side_effect = self.queryChanges
+        connection.simpleQuery.side_effect = self.simpleQuery
+        self.connection = connection
+        self.source = GerritSource({}, mock.Mock(), connection)
+
+    def addChange(self, number, *args, **kw):
+        self.changes[str(number)] = source_change(number, *args, **kw)
+
+    def queryChanges(self, numbers):
+        return [json.loads(json.dumps(self.changes[n])) for n in numbers
+                if n in self.changes]
+
+    def simpleQuery(self, query):
+        terms = [term.split(':', 1) for term in query.split(' OR ')]
+        results = []
+        for data in self.changes.values():
+            for op, value in terms:
+                if ((op == 'change' and data['id'] == value) or
+                    (op == 'message' and
+                     value in data['commitMessage'])):
+                    results.append(dict(data))
+                    break
+        return results
+
+    def test_related_changes_queried_by_level(self):
+        "Test that related changes are queried a level at a time"
+        # 1 <- 2 <- 3 in git; 4 and 5 depend on 1 and 3 in their commit
+        # messages, and 6 on 4.
+        self.addChange(1)
+        self.addChange(2, parent=1)
+        self.addChange(3, parent=2)
+        self.addChange(4, depends_on=[1])
+        self.addChange(5, depends_on=[3])
+        self.addChange(6, depends_on=[4])
+        self.changes['1']['neededBy'] = [
+            {'ref': 'refs/changes/02/2/1'}]
+        self.changes['2']['neededBy'] = [
+            {'ref': 'refs/changes/03/3/1'}]
+
+        change = self.source._getChange('1', '1')
+        self.assertEqual([c.number for c in change.needed_by_changes],
+                         ['2', '4'])
+        self.assertEqual(sorted(self.cache.keys()),
+                         ['%s,1' % n for n in range(1, 7)])
+        self.assertEqual(
+            [c.number for c in self.cache.get('4,1').needs_changes], ['1'])
+        self.assertEqual(
+            [c.number for c in self.cache.get('6,1').needs_changes], ['4'])
+
+        self.assertEqual(self.connection.query.call_count, 1)
+        self.assertEqual(self.connection.queryChanges.mock_calls,
+                         [mock.call(['2', '4']),
+                          mock.call(['3', '6']),
+                          mock.call(['5'])])
+        queries = [c[1][0] for c in self.connection.simpleQuery.mock_calls]
+        self.assertEqual(len(queries), 7)
+        self.assertEqual(queries[0], 'message:I%040d' % 1)
+        self.assertEqual(queries[1], 'change:I%040d' % 1)
+        self.assertEqual(queries[2], 'message:I%040d OR message:I%040d' %
+                         (2, 4))
+
+    def test_cached_related_changes_not_queried(self):
+        "Test that cached related changes are not queried again"
+        self.addChange(1)
+        self.addChange(2, parent=1)
+        self.source._getChange('1', '1')
+        self.connection.reset_mock()
+
+        change = self.source._getChange('2', '1', refresh=True)
+        self.assertEqual([c.number for c in change.needs_changes], ['1'])
+        self.assertEqual(self.connection.query.call_count, 1)
+        self.assertFalse(self.connection.queryChanges.called)
+
+    def test_dependency_cycle(self):
+        "Test that a dependency cycle found a level later is detected"
+        self.addChange(1, depends_on=[2])
+        self.addChange(2, depends_on=[1])
+        self.assertRaises(Exception, self.source._getChange, '1', '1')
+        self.assertEqual(len(self.cache), 0)
+
+
+class FakeGerritHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        self.server.requests.append((url.path, params))
+        if url.path == '/changes/':
+            options = params.get('o', [])
+            if 'SUBMIT_REQUIREMENTS' in options and self.server.old_gerrit:
+                self.sendBadRequest('"SUBMIT_REQUIREMENTS" is not a valid '
+                                    'value for "-o"')
+                return
+            if self.server.bad_query:
+                self.sendBadRequest('line 1:0 no viable alternative')
+                return
+            if params.get('S'):
+                data = [http_change(5, CURRENT_SHA)]
+            elif params['q'] == ['change:1 OR change:3']:
+                data = [http_change(3, CHILD_SHA, parent=CURRENT_SHA),
+                        http_change(1, CURRENT_SHA)]
+            else:
+                data = [http_change(1, CURRENT_SHA, more_changes=True)]
+            for change in data:
+                if 'SUBMITTABLE' in options:
+                    change['submittable'] = False
+                if 'SUBMIT_REQUIREMENTS' in options:
+                    change['submit_records'] = [{
+                        'rule_name': 'gerrit~DefaultSubmitRule',
+                        'status': 'NOT_READY',
+                        'labels': [
+                            {'label': 'Code-Review', 'status': 'OK',
+                             'applied_by': {'username': 'reviewer'}},
+                            {'label': 'Verified', 'status': 'NEED'}]}]
+        elif url.path == '/changes/1/revisions/%s/related' % CURRENT_SHA:
+            data = {'changes': [
+                {'_change_number': 3, '_revision_number': 1,
+                 'commit': {'commit': CHILD_SHA,
+                            'parents': [{'commit': CURRENT_SHA}]}},
+                {'_change_number': 1, '_revision_number': 2,
+                 'commit': {'commit': CURRENT_SHA,
+                            'parents': [{'commit': PARENT_SHA}]}},
+                {'_change_number': 2, '_revision_number': 4,
+                 'commit': {'commit': PARENT_SHA,
+                            'parents': [{'commit': '5' * 40}]}},
+            ]}
+        else:
+            self.send_error(404)
+            return
+        body = ")]}'\n" + json.dumps(data)
+        body = body.encode('utf8')
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = six.BytesIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendBadRequest(self, message):
+        body = ('Bad Request\n' + message + '\n').encode('utf8')
+        self.send_response(400)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestGerritHTTP(BaseTestCase):
+
+    def setUp(self):
+        super(TestGerritHTTP, self).setUp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                FakeGerritHTTPHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.old_gerrit = False
+        self.server.bad_query = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        gerrit_config = {
+            'user': 'gerrit',
+            'server': 'localhost',
+            'baseurl': 'http://127.0.0.1:%s/' % self.server.server_port,
+            'query_backend': 'http',
+        }
+        self.gerrit = GerritConnection('review_gerrit', gerrit_config)
+        self.addCleanup(self.gerrit.http.close)
+
+    def test_query(self):
+        data = self.gerrit.query('1')
+        self.assertEqual(data['number'], '1')
+        self.assertEqual(data['id'], 'I%040d' % 1)
+        self.assertEqual(data['status'], 'NEW')
+        self.assertTrue(data['open'])
+        self.assertEqual(data['url'], '%s1' % self.gerrit.baseurl)
+        self.assertEqual(data['commitMessage'], 'Change 1\n')
+        self.assertEqual([ps['number'] for ps in data['patchSets']],
+                         ['1', '2'])
+        current = data['currentPatchSet']
+        self.assertEqual(current['number'], '2')
+        self.assertEqual(current['ref'], 'refs/changes/01/1/2')
+        self.assertEqual(current['files'], [{'file': 'README'}])
+        self.assertEqual(len(current['approvals']), 1)
+        approval = current['approvals'][0]
+        self.assertEqual(approval['description'], 'Code-Review')
+        self.assertEqual(approval['value'], '2')
+        self.assertEqual(approval['grantedOn'], 1420070405)
+        self.assertEqual(approval['by']['username'], 'reviewer')
+        self.assertEqual(data['submitRecords'],
+                         [{'status': 'NOT_READY',
+                           'labels': [{'label': 'Code-Review',
+                                       'status': 'OK'},
+                                      {'label': 'Verified',
+                                       'status': 'NEED'}]}])
+        self.assertEqual(data['dependsOn'],
+                         [{'number': '2', 'ref': 'refs/changes/02/2/4',
+                           'revision': PARENT_SHA}])
+        self.assertEqual(data['neededBy'],
+                         [{'number': '3', 'ref': 'refs/changes/03/3/1',
+                           'revision': CHILD_SHA}])
+
+        path, params = self.server.requests[0]
+        self.assertEqual(params['q'], ['change:1'])
+        self.assertIn('DETAILED_LABELS', params['o'])
+        # Both requests should have been made on one connection
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_query_submittable(self):
+        # Gerrit before 3.5 rejects the option for submit records
+        self.server.old_gerrit = True
+        data = self.gerrit.query('1')
+        self.assertEqual(data['submitRecords'][0]['status'], 'NOT_READY')
+        self.assertEqual(sorted(data['submitRecords'][0]['labels'],
+                                key=lambda r: r['label']),
+                         [{'label': 'Code-Review', 'status': 'OK'},
+                          {'label': 'Verified', 'status': 'NEED'}])
+        self.assertFalse(self.gerrit.http_submit_records)
+
+        # The option is not asked for again
+        self.gerrit.query('1')
+        options = [params['o'] for path, params in self.server.requests
+                   if path == '/changes/']
+        self.assertEqual(len(options), 3)
+        self.assertIn('SUBMIT_REQUIREMENTS', options[0])
+        self.assertNotIn('SUBMIT_REQUIREMENTS', options[1])
+        self.assertIn('SUBMITTABLE', options[1])
+        self.assertNotIn('SUBMIT_REQUIREMENTS', options[2])
+
+    def test_query_bad_request(self):
+        "Test that other bad requests keep asking for submit records"
+        self.server.bad_query = True
+        self.assertRaises(GerritHTTPError, self.gerrit.query, '1')
+        self.assertTrue(self.gerrit.http_submit_records)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_query_changes(self):
+        "Test that the changes in one chain share their related changes"
+        child, data = self.gerrit.queryChanges(['1', '3'])
+        self.assertEqual(data['dependsOn'],
+                         [{'number': '2', 'ref': 'refs/changes/02/2/4',
+                           'revision': PARENT_SHA}])
+        self.assertEqual(data['neededBy'],
+                         [{'number': '3', 'ref': 'refs/changes/03/3/1',
+                           'revision': CHILD_SHA}])
+        self.assertEqual(child['number'], '3')
+        self.assertEqual(child['dependsOn'],
+                         [{'number': '1', 'ref': 'refs/changes/01/1/2',
+                           'revision': CURRENT_SHA}])
+        self.assertNotIn('neededBy', child)
+        # Only the related changes of the oldest one were asked for
+        self.assertEqual([path for path, params in self.server.requests],
+                         ['/changes/',
+                          '/changes/1/revisions/%s/related' % CURRENT_SHA])
+
+    def test_simple_query_pagination(self):
+        data = self.gerrit.simpleQuery('project:org/project')
+        self.assertEqual([d['number'] for d in data], ['1', '5'])
+        self.assertEqual(data[0]['currentPatchSet']['number'], '2')
+        self.assertEqual(self.server.requests[1][1]['S'], ['1'])
+        self.assertEqual(self.server.connections, 1)
@@ -0,0 +1,140 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+
+from six.moves import configparser as ConfigParser
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from tests.base import BaseTestCase
+from zuul import model
+from zuul.merger.client import MergeClient
+
+
+class TestMergeClient(BaseTestCase):
+
+    def setUp(self):
+        super(TestMergeClient, self).setUp()
+        config = ConfigParser.ConfigParser()
+        config.add_section('gearman')
+        config.set('gearman', 'server', '127.0.0.1')
+        patcher = mock.patch('zuul.merger.client.MergeGearmanClient')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sched = mock.Mock()
+        self.client = MergeClient(config, self.sched)
+
+    def makeItems(self, *refs):
+        items = []
+        for i, ref in enumerate(refs):
+            items.append(dict(project='org/project', url='/org/project',
+                              connection_name='gerrit', merge_mode=1,
+                              refspec='refs/changes/1/%s/1' % i,
+                              branch='master', ref=ref,
+                              number=str(i), patchset='1',
+                              oldrev=None, newrev=None))
+        return items
+
+    def getSubmittedJobs(self):
+        return [c[1][0] for c in self.client.gearman.submitJob.mock_calls]
+
+    def completeJob(self, job, **result):
+        job.data = [json.dumps(result)]
+        self.client.onBuildCompleted(job)
+
+    def test_coalesce_identical_merges(self):
+        "Test that identical merges share a job and its result"
+        leader = mock.Mock()
+        follower = mock.Mock()
+        self.client.mergeChanges(self.makeItems('Z1', 'Z2'), leader)
+        self.client.mergeChanges(self.makeItems('Z3', 'Z4'), follower)
+
+        jobs = self.getSubmittedJobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(self.client.coalesced, 1)
+
+        self.completeJob(jobs[0], merged=True, commit='abc',
+                         zuul_url='http://merger')
+        self.assertEqual(self.sched.onMergeCompleted.mock_calls, [
+            mock.call(leader, 'http://merger', True, False, 'abc'),
+            mock.call(follower, 'http://merger', True, False, 'abc',
+                      zuul_ref='Z2'),
+        ])
+        self.assertFalse(self.client.areMergesOutstanding())
+        self.assertEqual(self.client.outstanding, {})
+        self.assertEqual(self.client.followers, {})
+
+    def test_coalesce_identical_updates(self):
+        "Test that identical updates share a job and its result"
+        leader = mock.Mock()
+        follower = mock.Mock()
+        self.client.updateRepo('org/project', '/org/project', leader)
+        self.client.updateRepo('org/project', '/org/project', follower)
+        self.client.updateRepo('org/project1', '/org/project1', mock.Mock())
+
+        jobs = self.getSubmittedJobs()
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(self.client.coalesced, 1)
+
+        self.completeJob(jobs[0], updated=True, zuul_url='http://merger')
+        self.assertEqual(self.sched.onMergeCompleted.mock_calls, [
+            mock.call(leader, 'http://merger', False, True, None),
+            mock.call(follower, 'http://merger', False, True, None,
+                      zuul_ref=None),
+        ])
+
+    def test_no_coalesce_after_start(self):
+        "Test that a request does not join a job which has started"
+        self.client.updateRepo('org/project', '/org/project', mock.Mock())
+        jobs = self.getSubmittedJobs()
+        self.client.onMergeStarted(jobs[0])
+        self.client.updateRepo('org/project', '/org/project', mock.Mock())
+
+        self.assertEqual(len(self.getSubmittedJobs()), 2)
+        self.assertEqual(self.client.coalesced, 0)
+
+    def test_no_coalesce_with_higher_precedence(self):
+        "Test that a request only joins a job of at least its precedence"
+        self.client.mergeChanges(self.makeItems('Z1'), mock.Mock(),
+                                 model.PRECEDENCE_NORMAL)
+        self.client.mergeChanges(self.makeItems('Z2'), mock.Mock(),
+                                 model.PRECEDENCE_HIGH)
+        self.assertEqual(len(self.getSubmittedJobs()), 2)
+
+        # Later requests join the job with high precedence
+        self.client.mergeChanges(self.makeItems('Z3'), mock.Mock(),
+                                 model.PRECEDENCE_LOW)
+        self.client.mergeChanges(self.makeItems('Z4'), mock.Mock(),
+                                 model.PRECEDENCE_HIGH)
+        self.assertEqual(len(self.getSubmittedJobs()), 2)
+        self.assertEqual(self.client.coalesced, 2)
+
+    def test_item_merged_fan_out(self):
+        "Test that items merged ahead are reported to every build set"
+        leader = mock.Mock()
+        follower = mock.Mock()
+        self.client.mergeChanges(self.makeItems('Z1', 'Z2'), leader)
+        self.client.mergeChanges(self.makeItems('Z3', 'Z4'), follower)
+        job = self.getSubmittedJobs()[0]
+
+        job.data = [json.dumps(dict(ref='Z1', commit='abc',
+                                    zuul_url='http://merger'))]
+        self.client.onMergeData(job)
+        self.assertEqual(self.sched.onItemMerged.mock_calls, [
+            mock.call(leader, 'Z1', 'http://merger', 'abc'),
+            mock.call(follower, 'Z3', 'http://merger', 'abc',
+                      zuul_ref='Z1'),
+        ])
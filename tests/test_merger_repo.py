@@ -20,7 +20,8 @@ import os
 
 import git
 
-from zuul.merger.merger import Repo
+import zuul.model
+from zuul.merger.merger import Merger, Repo
 from tests.base import ZuulTestCase
 
 logging.basicConfig(level=logging.DEBUG,
@@ -77,3 +78,175 @@ class TestMergerRepo(ZuulTestCase):
             os.path.join(self.upstream_root, 'org/project2'),
             sub_repo.createRepoObject().remotes[0].url,
             message="Sub repository points to upstream project2")
+
+    def test_update_when_changed(self):
+        parent_path = os.path.join(self.upstream_root, 'org/project1')
+        work_repo = Repo(parent_path, self.workspace_root,
+                         'none@example.org', 'User Name')
+        self.assertTrue(work_repo.isUpToDate())
+        self.assertFalse(work_repo.update())
+
+        self.create_commit('org/project1')
+        self.assertFalse(work_repo.isUpToDate())
+        self.assertTrue(work_repo.update())
+        self.assertTrue(work_repo.isUpToDate())
+
+        self.create_branch('org/project1', 'stable')
+        self.assertTrue(work_repo.update())
+        self.assertTrue(work_repo.hasBranch('stable'))
+
+    def test_prune_zuul_refs(self):
+        parent_path = os.path.join(self.upstream_root, 'org/project1')
+        work_repo = Repo(parent_path, self.workspace_root,
+                         'none@example.org', 'User Name')
+        work_repo.createZuulRef('master/Z1')
+        work_repo.createZuulRef('master/Z2')
+        self.assertEqual(work_repo.pruneZuulRefs(3600), 0)
+        self.assertIsNotNone(work_repo.getCommitFromRef('master/Z1'))
+
+        work_repo.gc()
+        self.assertEqual(work_repo.pruneZuulRefs(0), 2)
+        self.assertIsNone(work_repo.getCommitFromRef('master/Z1'))
+        self.assertIsNone(work_repo.getCommitFromRef('master/Z2'))
+
+    def test_mirror(self):
+        parent_path = os.path.join(self.upstream_root, 'org/project1')
+        mirror_path = os.path.join(self.test_root, 'mirror', 'org/project1')
+        work_repo = Repo(parent_path, self.workspace_root,
+                         'none@example.org', 'User Name',
+                         mirror=mirror_path)
+        alternates = os.path.join(self.workspace_root, '.git', 'objects',
+                                  'info', 'alternates')
+        with open(alternates) as f:
+            self.assertEqual(f.read().strip(),
+                             os.path.join(mirror_path, 'objects'))
+
+        self.create_commit('org/project1')
+        self.assertTrue(work_repo.update())
+        head = git.Repo(parent_path).heads['master'].commit.hexsha
+        self.assertEqual(git.Repo(mirror_path).heads['master'].commit.hexsha,
+                         head)
+        self.assertEqual(work_repo.getCommitFromRef(
+            'refs/remotes/origin/master').hexsha, head)
+
+
+class TestMerger(ZuulTestCase):
+
+    def _makeItem(self, change, ref):
+        return dict(project=change.project,
+                    url=os.path.join(self.upstream_root, change.project),
+                    connection_name='gerrit',
+                    merge_mode=zuul.model.MERGER_MERGE_RESOLVE,
+                    refspec=change.patchsets[-1]['ref'],
+                    branch=change.branch,
+                    ref=ref,
+                    number=change.number,
+                    patchset=change.latest_patchset)
+
+    def _getLog(self, merger, project, ref):
+        repo = merger.getRepo(project, None).createRepoObject()
+        return [c.message.strip() for c in repo.iter_commits(ref)]
+
+    def _test_merge_changes(self, prepare_workers, tree_merges=False):
+        merger = Merger(os.path.join(self.test_root, 'merger'), {},
+                        'zuul@example.com', 'zuul', prepare_workers,
+                        tree_merges)
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project2', 'master', 'B')
+        C = self.fake_gerrit.addFakeChange('org/project1', 'master', 'C')
+        items = [self._makeItem(A, 'Z1'),
+                 self._makeItem(B, 'Z2'),
+                 self._makeItem(C, 'Z3')]
+        self.assertIsNotNone(merger.mergeChanges(items))
+
+        # Each item's zuul refs include the changes ahead of it in
+        # every project.
+        self.assertIn('A-1', self._getLog(merger, 'org/project1',
+                                          'refs/zuul/master/Z2'))
+        self.assertIn('B-1', self._getLog(merger, 'org/project2',
+                                          'refs/zuul/master/Z2'))
+        log = self._getLog(merger, 'org/project1', 'refs/zuul/master/Z3')
+        self.assertIn('A-1', log)
+        self.assertIn('C-1', log)
+
+    def test_merge_changes(self):
+        self._test_merge_changes(1)
+
+    def test_merge_changes_prepared(self):
+        self._test_merge_changes(4)
+
+    def test_merge_changes_tree_merges(self):
+        self._test_merge_changes(1, tree_merges=True)
+
+    def test_tree_merge_conflict(self):
+        merger = Merger(os.path.join(self.test_root, 'merger'), {},
+                        'zuul@example.com', 'zuul', tree_merges=True)
+        A = self.fake_gerrit.addFakeChange('org/conflict-project',
+                                           'master', 'A')
+        A.addPatchset(['conflict'])
+        B = self.fake_gerrit.addFakeChange('org/conflict-project',
+                                           'master', 'B')
+        B.addPatchset(['conflict'])
+        self.assertIsNone(merger.mergeChanges([self._makeItem(A, 'Z1'),
+                                               self._makeItem(B, 'Z2')]))
+
+    def test_merge_result_reused(self):
+        merger = Merger(os.path.join(self.test_root, 'merger'), {},
+                        'zuul@example.com', 'zuul')
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        first = merger.mergeChanges([self._makeItem(A, 'Z1'),
+                                     self._makeItem(B, 'Z2')])
+        # Repeating the same merges for a new build set gives the same
+        # commit rather than a new merge commit.
+        second = merger.mergeChanges([self._makeItem(A, 'Z3'),
+                                      self._makeItem(B, 'Z4')])
+        self.assertEqual(first, second)
+        self.assertEqual(
+            first, merger.getRepo('org/project1', None).getCommitFromRef(
+                'master/Z4').hexsha)
+
+    def test_merge_changes_callback(self):
+        merger = Merger(os.path.join(self.test_root, 'merger'), {},
+                        'zuul@example.com', 'zuul')
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project2', 'master', 'B')
+        C = self.fake_gerrit.addFakeChange('org/project1', 'master', 'C')
+        merged = []
+        commit = merger.mergeChanges([self._makeItem(A, 'Z1'),
+                                      self._makeItem(B, 'Z2'),
+                                      self._makeItem(C, 'Z3')],
+                                     lambda item, sha: merged.append(
+                                         (item['ref'], sha)))
+        # Every item but the last is reported as soon as it is merged.
+        self.assertEqual(['Z1', 'Z2'], [ref for ref, sha in merged])
+        self.assertEqual(
+            merged[0][1], merger.getRepo('org/project1', None).
+            getCommitFromRef('master/Z1').hexsha)
+        self.assertEqual(
+            merged[1][1], merger.getRepo('org/project2', None).
+            getCommitFromRef('master/Z2').hexsha)
+        self.assertNotIn(commit, [sha for ref, sha in merged])
+
+
+class TestMergerShards(ZuulTestCase):
+
+    def setup_config(self, config_file='zuul.conf'):
+        super(TestMergerShards, self).setup_config(config_file)
+        self.config.set('merger', 'shard_count', '4')
+
+    def test_sharded_merge(self):
+        "Test that merge jobs are sent to the project's shard"
+        shard = self.merge_client.getShard('org/project')
+        self.assertEqual(shard, self.merge_client.getShard('org/project'))
+        self.assertEqual('merger:merge:%d' % shard,
+                         self.merge_client.getFunctionName('merger:merge',
+                                                           'org/project'))
+        self.assertEqual([0, 1, 2, 3], self.merge_server.shards)
+
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(1))
+        self.waitUntilSettled()
+        self.assertEqual(self.getJobFromHistory('project-test1').result,
+                         'SUCCESS')
+        self.assertEqual(A.reported, 1)
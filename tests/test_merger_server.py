@@ -0,0 +1,208 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import threading
+import time
+
+import fixtures
+from six.moves import configparser as ConfigParser
+from six.moves import queue as Queue
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from tests.base import BaseTestCase
+from zuul.merger.server import MergeServer
+
+
+class TestMergeServer(BaseTestCase):
+
+    def setUp(self):
+        super(TestMergeServer, self).setUp()
+        self.git_root = self.useFixture(fixtures.TempDir()).path
+        self.jobs = Queue.Queue()
+        self.release = threading.Event()
+        self.running = []
+        self.max_running = {}
+        self.lock = threading.Lock()
+
+    def makeConfig(self):
+        config = ConfigParser.ConfigParser()
+        config.add_section('merger')
+        config.set('merger', 'git_dir', self.git_root)
+        config.set('merger', 'zuul_url', 'http://merger')
+        return config
+
+    def startServer(self, slots):
+        config = self.makeConfig()
+        config.set('merger', 'slots', str(slots))
+        server = MergeServer(config)
+        server.merger.mergeChanges = mock.Mock(side_effect=self.merge)
+        server.merger.updateRepo = mock.Mock(side_effect=self.update)
+        server.worker = mock.Mock()
+        server.worker.getJob.side_effect = self.getJob
+        server._running = True
+        thread = threading.Thread(target=server.run)
+        thread.daemon = True
+        thread.start()
+        self.thread = thread
+
+        def stop():
+            server._running = False
+            self.release.set()
+            self.jobs.put(Exception("Stopped"))
+            thread.join()
+        self.addCleanup(stop)
+        return server
+
+    def getJob(self):
+        job = self.jobs.get()
+        if isinstance(job, Exception):
+            raise job
+        return job
+
+    def addJob(self, name, **args):
+        job = mock.Mock()
+        job.name = name
+        job.unique = '%s-%s' % (name, self.jobs.qsize())
+        job.arguments = json.dumps(args)
+        self.jobs.put(job)
+        return job
+
+    def run_job(self, projects):
+        with self.lock:
+            self.running.append(projects)
+            for project in projects:
+                running = len([p for p in self.running if project in p])
+                self.max_running[project] = max(
+                    running, self.max_running.get(project, 0))
+        self.release.wait(10)
+        with self.lock:
+            self.running.remove(projects)
+
+    def merge(self, items, item_merged):
+        self.run_job([item['project'] for item in items])
+        return 'abc'
+
+    def update(self, project, url, connection_name):
+        self.run_job([project])
+
+    def waitFor(self, check):
+        for x in range(100):
+            if check():
+                return
+            time.sleep(0.1)
+        self.fail("Timed out waiting for %s" % (check,))
+
+    def test_same_repo_serialized(self):
+        "Test that jobs which use the same repo run one at a time"
+        server = self.startServer(slots=2)
+        merge = self.addJob('merger:merge', items=[
+            dict(project='org/project1'), dict(project='org/project2')])
+        self.waitFor(lambda: len(self.running) == 1)
+        update = self.addJob('merger:update', project='org/project2',
+                             url='/org/project2')
+
+        # The update waits for the merge to finish with org/project2
+        self.waitFor(lambda: server.queued_slots == 1)
+        self.assertEqual(server.active_slots, 1)
+        self.assertEqual(self.running, [['org/project1', 'org/project2']])
+        self.assertFalse(server.merger.updateRepo.called)
+
+        self.release.set()
+        self.waitFor(lambda: update.sendWorkComplete.called)
+        self.assertTrue(merge.sendWorkComplete.called)
+        self.assertEqual(self.max_running, {'org/project1': 1,
+                                            'org/project2': 1})
+        self.waitFor(lambda: server._isIdle())
+
+    def test_different_repos_concurrent(self):
+        "Test that jobs which use different repos run at once"
+        server = self.startServer(slots=2)
+        update1 = self.addJob('merger:update', project='org/project1',
+                              url='/org/project1')
+        update2 = self.addJob('merger:update:0', project='org/project2',
+                              url='/org/project2')
+
+        self.waitFor(lambda: len(self.running) == 2)
+        self.assertEqual(server.active_slots, 2)
+        self.assertEqual(server.queued_slots, 0)
+
+        self.release.set()
+        self.waitFor(lambda: update2.sendWorkComplete.called)
+        self.waitFor(lambda: update1.sendWorkComplete.called)
+        self.assertEqual(json.loads(update1.sendWorkComplete.call_args[0][0]),
+                         dict(updated=True, zuul_url='http://merger'))
+
+    def test_slots(self):
+        "Test that no more jobs are taken than there are slots"
+        server = self.startServer(slots=1)
+        update1 = self.addJob('merger:update', project='org/project1',
+                              url='/org/project1')
+        update2 = self.addJob('merger:update', project='org/project2',
+                              url='/org/project2')
+
+        self.waitFor(lambda: len(self.running) == 1)
+        # The second job is left for another merger to take
+        self.assertEqual(self.jobs.qsize(), 1)
+        self.assertEqual(server.worker.getJob.call_count, 1)
+
+        self.release.set()
+        self.waitFor(lambda: update2.sendWorkComplete.called)
+        self.assertTrue(update1.sendWorkComplete.called)
+        self.assertEqual(self.max_running, {'org/project1': 1,
+                                            'org/project2': 1})
+
+    def test_repo_locks(self):
+        "Test that repo locks are shared and taken in a fixed order"
+        server = MergeServer(self.makeConfig())
+        locks = server.merger.getRepoLocks(['org/project2', 'org/project1',
+                                            'org/project2'])
+        self.assertEqual(len(locks), 2)
+        self.assertEqual(server.merger.getRepoLocks(['org/project1',
+                                                     'org/project2']),
+                         locks)
+        self.assertIs(server.merger.getRepoLocks(['org/project2'])[0],
+                      locks[1])
+
+    def test_stop_waiting_for_slot(self):
+        "Test that the listener stops while it waits for a free slot"
+        server = self.startServer(slots=1)
+        self.addJob('merger:update', project='org/project1',
+                    url='/org/project1')
+        self.waitFor(lambda: len(self.running) == 1)
+
+        server.stop()
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(server.worker.getJob.call_count, 1)
+
+    def test_update_uses_git_ssh(self):
+        "Test that updating a repo uses the ssh wrapper of its connection"
+        server = MergeServer(self.makeConfig())
+        merger = server.merger
+        merger.getRepo = mock.Mock()
+        merger._acquireGitSsh = mock.Mock()
+        merger._releaseGitSsh = mock.Mock()
+
+        merger.updateRepo('org/project', '/org/project', 'review')
+        merger._acquireGitSsh.assert_called_once_with('review')
+        self.assertTrue(merger.getRepo.return_value.update.called)
+        self.assertEqual(merger._releaseGitSsh.call_count, 1)
+
+        merger.getRepo.side_effect = Exception("No url")
+        self.assertRaises(Exception, merger.updateRepo,
+                          'org/project', None, 'review')
+        self.assertEqual(merger._releaseGitSsh.call_count, 2)
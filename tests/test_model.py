@@ -17,6 +17,11 @@ import random
 
 import fixtures
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 from zuul import change_matcher as cm
 from zuul import model
 
@@ -140,3 +145,105 @@ class TestTimeDataBase(BaseTestCase):
         for x in range(10):
             self.db.update('job-name', 100, 'SUCCESS')
         self.assertEqual(self.db.getEstimatedTime('job-name'), 100)
+
+    def test_timedatabase_deferred_save(self):
+        path = os.path.join(self.tmp_root, 'job-name')
+        self.db.add('job-name', 50, 'SUCCESS')
+        self.db.add('job-name', 100, 'SUCCESS')
+        self.assertEqual(self.db.getEstimatedTime('job-name'), 75)
+        self.assertFalse(os.path.exists(path))
+        self.db.save()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(model.TimeDataBase(self.tmp_root).getEstimatedTime(
+            'job-name'), 75)
+
+
+class TestChangeQueue(BaseTestCase):
+    def setUp(self):
+        super(TestChangeQueue, self).setUp()
+        self.project = model.Project('project')
+        self.pipeline = model.Pipeline('gate')
+        self.pipeline.addProject(self.project)
+        self.queue = model.ChangeQueue(self.pipeline)
+        self.queue.addProject(self.project)
+        self.pipeline.addQueue(self.queue)
+
+    def _makeChange(self, number, patchset):
+        change = model.Change(self.project)
+        change.number = number
+        change.patchset = patchset
+        return change
+
+    def _makeRef(self, ref, newrev):
+        change = model.Ref(self.project)
+        change.ref = ref
+        change.newrev = newrev
+        return change
+
+    def test_item_index(self):
+        a1 = self._makeChange('1', '1')
+        a2 = self._makeChange('1', '2')
+        b1 = self._makeChange('2', '1')
+        ref = self._makeRef('refs/heads/master', 'abc')
+        item_a = self.queue.enqueueChange(a1)
+        item_b = self.queue.enqueueChange(b1)
+        item_ref = self.queue.enqueueChange(ref)
+
+        self.assertEqual(self.pipeline.getItemsForChange(a2), [item_a])
+        self.assertEqual(self.queue.getItemsForChange(a2), [item_a])
+        self.assertEqual(self.pipeline.getItemsForChange(b1), [item_b])
+        self.assertEqual(self.pipeline.getItemsForChange(
+            self._makeRef('refs/heads/master', 'def')), [item_ref])
+        self.assertEqual(self.pipeline.getItemsForChange(
+            self._makeRef('refs/heads/stable', 'abc')), [])
+
+        self.queue.dequeueItem(item_a)
+        self.assertEqual(self.pipeline.getItemsForChange(a1), [])
+        self.assertEqual(self.queue.getItemsForChange(a1), [])
+        self.assertEqual(self.pipeline.getItemsForChange(b1), [item_b])
+        self.assertEqual(self.pipeline._item_index,
+                         self.queue._item_index)
+
+
+class TestQueueItemStatus(BaseTestCase):
+    def setUp(self):
+        super(TestQueueItemStatus, self).setUp()
+        project = model.Project('project')
+        pipeline = model.Pipeline('gate')
+        queue = model.ChangeQueue(pipeline)
+        change = model.Change(project)
+        change.number = '1'
+        change.patchset = '1'
+        self.item = queue.enqueueChange(change)
+        self.item.formatJSON = mock.Mock(
+            side_effect=lambda url_pattern: dict(jobs=[], remaining_time=None))
+
+    def test_status_cached(self):
+        item = self.item
+        self.assertEqual(item.getStatusJSON(version=1)['status_version'], 1)
+        self.assertEqual(item.getStatusJSON(version=2)['status_version'], 1)
+        self.assertEqual(item.formatJSON.call_count, 1)
+
+        item.invalidateStatus()
+        self.assertEqual(item.getStatusJSON(version=3)['status_version'], 3)
+        self.assertEqual(item.formatJSON.call_count, 2)
+        item.getStatusJSON(url_pattern='http://logs/{change.number}',
+                           version=4)
+        self.assertEqual(item.formatJSON.call_count, 3)
+
+    def test_status_invalidated_while_formatting(self):
+        item = self.item
+
+        def format_json(url_pattern):
+            # The item changes in another thread while it is formatted
+            if item.formatJSON.call_count == 1:
+                item.invalidateStatus()
+            return dict(jobs=[], remaining_time=None)
+        item.formatJSON.side_effect = format_json
+
+        self.assertEqual(item.getStatusJSON(version=1)['status_version'], 1)
+        # The change is not lost
+        self.assertEqual(item.getStatusJSON(version=2)['status_version'], 2)
+        self.assertEqual(item.formatJSON.call_count, 2)
+        self.assertEqual(item.getStatusJSON(version=3)['status_version'], 2)
+        self.assertEqual(item.formatJSON.call_count, 2)
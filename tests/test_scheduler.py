@@ -26,13 +26,20 @@ import git
 from six.moves import urllib
 import testtools
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 import zuul.change_matcher
+from zuul import model
 import zuul.scheduler
 import zuul.rpcclient
 import zuul.reporter.gerrit
 import zuul.reporter.smtp
 
 from tests.base import (
+    BaseTestCase,
     ZuulTestCase,
     repack_repo,
 )
@@ -74,6 +81,10 @@ class TestScheduler(ZuulTestCase):
             'zuul.pipeline.gate.org.project.resident_time', kind='ms')
         self.assertReportedStat(
             'zuul.pipeline.gate.org.project.total_changes', value='1|c')
+        self.assertReportedStat('zuul.scheduler.result_queue.depth',
+                                kind='g')
+        self.assertReportedStat('zuul.scheduler.result_queue.batch_size',
+                                kind='g')
 
         for build in self.builds:
             self.assertEqual(build.parameters['ZUUL_VOTING'], '1')
@@ -263,6 +274,42 @@ class TestScheduler(ZuulTestCase):
         self.assertEqual(B.reported, 2)
         self.assertEqual(C.reported, 2)
 
+    def test_only_dirty_queues_processed(self):
+        "Test that only change queues which have changed are processed"
+
+        self.sched.queue_sweep_interval = 3600
+        self.worker.hold_jobs_in_build = True
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project', 'master', 'B')
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(1))
+        self.fake_gerrit.addEvent(B.getPatchsetCreatedEvent(1))
+        self.waitUntilSettled()
+
+        pipeline = self.sched.layout.pipelines['check']
+        self.assertEqual(len(pipeline.queues), 2)
+        self.assertFalse([q for q in pipeline.queues if q.dirty])
+
+        processed = []
+        orig_process = pipeline.manager._processOneItem
+
+        def processOneItem(item, nnfi):
+            processed.append(item.change.number)
+            return orig_process(item, nnfi)
+        pipeline.manager._processOneItem = processOneItem
+
+        for build in self.builds:
+            if self.job_has_changes(build, A):
+                build.release()
+        self.waitUntilSettled()
+        self.assertIn(A.data['number'], processed)
+        self.assertNotIn(B.data['number'], processed)
+
+        self.worker.hold_jobs_in_build = False
+        self.worker.release()
+        self.waitUntilSettled()
+        self.assertEqual(A.reported, 1)
+        self.assertEqual(B.reported, 1)
+
     def test_failed_change_at_head(self):
         "Test that if a change at the head fails, jobs behind it are canceled"
 
@@ -727,8 +774,9 @@ jobs:
         # triggering events.  Since it will have the changes cached
         # already (without approvals), we need to clear the cache
         # first.
-        for connection in self.connections.values():
-            connection.maintainCache([])
+        for change in (A, B, C, D, E, F, G):
+            self.fake_gerrit.deleteCachedChange(
+                '%s,%s' % (change.number, change.latest_patchset))
 
         self.worker.hold_jobs_in_build = True
         A.addApproval('APRV', 1)
@@ -2101,7 +2149,7 @@ jobs:
         # the standard layout, but we need it to already be registerd
         # for when we reconfigure, as that is when Zuul will attempt
         # to run the new job.
-        self.worker.registerFunction('build:gate-noop')
+        self.registerFunction('build:gate-noop')
         self.gearman_server.hold_jobs_in_queue = True
         A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
         A.addApproval('CRVW', 2)
@@ -2202,8 +2250,7 @@ jobs:
 
     def test_build_description(self):
         "Test that build descriptions update"
-        self.worker.registerFunction('set_description:' +
-                                     self.worker.worker_id)
+        self.registerFunction('set_description:' + self.worker.worker_id)
 
         A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
         A.addApproval('CRVW', 2)
@@ -2394,9 +2441,51 @@ jobs:
         self.assertEqual(B.reported, 1)
         self.assertFalse('test-mutex' in self.sched.mutex.mutexes)
 
+    def test_mutex_superseded(self):
+        "Test that a job mutex is released when its holder is canceled"
+        self.config.set('zuul', 'layout_config',
+                        'tests/fixtures/layout-mutex.yaml')
+        self.sched.reconfigure(self.config)
+
+        self.worker.hold_jobs_in_build = True
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project', 'master', 'B')
+
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(1))
+        self.fake_gerrit.addEvent(B.getPatchsetCreatedEvent(1))
+        self.waitUntilSettled()
+        self.assertEqual(len(self.builds), 3)
+        self.assertEqual(self.builds[1].name, 'mutex-one')
+        self.assertEqual(self.builds[1].parameters['ZUUL_CHANGE'], '1')
+        self.assertTrue('test-mutex' in self.sched.mutex.mutexes)
+
+        # Uploading a new patchset dequeues the item which holds the
+        # mutex while its job is still running.
+        A.addPatchset()
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(2))
+        self.waitUntilSettled()
+
+        mutex_builds = [b for b in self.builds
+                        if b.name in ('mutex-one', 'mutex-two')]
+        self.assertEqual(len(mutex_builds), 1)
+        self.assertTrue('test-mutex' in self.sched.mutex.mutexes)
+        held_item, held_job_name = self.sched.mutex.mutexes['test-mutex']
+        self.assertEqual(held_job_name, mutex_builds[0].name)
+        self.assertEqual(held_item.change.number,
+                         mutex_builds[0].parameters['ZUUL_CHANGE'])
+
+        self.worker.hold_jobs_in_build = False
+        self.worker.release()
+        self.waitUntilSettled()
+
+        self.assertEqual(len(self.builds), 0)
+        self.assertEqual(A.reported, 1)
+        self.assertEqual(B.reported, 1)
+        self.assertFalse('test-mutex' in self.sched.mutex.mutexes)
+
     def test_node_label(self):
         "Test that a job runs on a specific node label"
-        self.worker.registerFunction('build:node-project-test1:debian')
+        self.registerFunction('build:node-project-test1:debian')
 
         A = self.fake_gerrit.addFakeChange('org/node-project', 'master', 'A')
         A.addApproval('CRVW', 2)
@@ -2435,7 +2524,7 @@ jobs:
         # conflict and a job is added to its project while it's
         # sitting in the queue.  The job gets added to the change and
         # enqueued and the change gets stuck.
-        self.worker.registerFunction('build:project-test3')
+        self.registerFunction('build:project-test3')
         self.worker.hold_jobs_in_build = True
 
         # This change is fine.  It's here to stop the queue long
@@ -2494,7 +2583,7 @@ jobs:
         # An extrapolation of test_live_reconfiguration_merge_conflict
         # that tests a job added to a job tree with a failed root does
         # not run.
-        self.worker.registerFunction('build:project-test3')
+        self.registerFunction('build:project-test3')
         self.worker.hold_jobs_in_build = True
 
         # This change is fine.  It's here to stop the queue long
@@ -2759,8 +2848,8 @@ jobs:
 
     def test_live_reconfiguration_functions(self):
         "Test live reconfiguration with a custom function"
-        self.worker.registerFunction('build:node-project-test1:debian')
-        self.worker.registerFunction('build:node-project-test1:wheezy')
+        self.registerFunction('build:node-project-test1:debian')
+        self.registerFunction('build:node-project-test1:wheezy')
         A = self.fake_gerrit.addFakeChange('org/node-project', 'master', 'A')
         A.addApproval('CRVW', 2)
         self.fake_gerrit.addEvent(A.addApproval('APRV', 1))
@@ -3773,8 +3862,9 @@ For CI problems and help debugging, contact ci@example.org"""
         self.assertEqual(A.data['status'], 'NEW')
         self.assertEqual(B.data['status'], 'NEW')
 
-        for connection in self.connections.values():
-            connection.maintainCache([])
+        for change in (A, B, AM1, AM2, BM1, BM2):
+            self.fake_gerrit.deleteCachedChange(
+                '%s,%s' % (change.number, change.latest_patchset))
 
         self.worker.hold_jobs_in_build = True
         B.addApproval('APRV', 1)
@@ -3877,6 +3967,10 @@ For CI problems and help debugging, contact ci@example.org"""
 
         self.assertEqual(self.getJobFromHistory('project1-merge').changes,
                          '2,1 3,1 1,1')
+        # Both Depends-On changes are found with a single query
+        self.assertIn('change:%s OR change:%s' % (B.data['id'],
+                                                  C.data['id']),
+                      self.fake_gerrit.queries)
 
     def test_crd_unshared_gate(self):
         "Test cross-repo dependencies in unshared gate queues"
@@ -4514,3 +4608,157 @@ For CI problems and help debugging, contact ci@example.org"""
         self.assertEqual(self.countJobResults(self.history, 'SUCCESS'), 2)
         self.assertEqual(A.reported, 1)
         self.assertIn('RETRY_LIMIT', A.messages[0])
+
+
+class TestItemMergedEvent(BaseTestCase):
+
+    def setUp(self):
+        super(TestItemMergedEvent, self).setUp()
+        self.sched = zuul.scheduler.Scheduler(None, testonly=True)
+        self.sched.time_database = mock.Mock()
+        pipeline = model.Pipeline('gate')
+        pipeline.setManager(zuul.scheduler.DependentPipelineManager(
+            self.sched, pipeline))
+        self.queue = model.ChangeQueue(pipeline)
+        pipeline.addQueue(self.queue)
+        project = model.Project('org/project')
+        self.items = []
+        for i in range(3):
+            change = model.Change(project)
+            change.number = str(i + 1)
+            change.patchset = '1'
+            item = self.queue.enqueueChange(change)
+            self.setMergePending(item, 'Z%s' % (i + 1))
+            self.items.append(item)
+        self.queue.dirty = False
+
+    def setMergePending(self, item, ref):
+        build_set = item.current_build_set
+        build_set.ref = ref
+        build_set.merge_state = build_set.PENDING
+
+    def itemMerged(self, item, ref, zuul_ref=None):
+        self.sched.onItemMerged(item.current_build_set, ref,
+                                'http://merger', 'abc', zuul_ref)
+        self.sched.process_result_queue()
+
+    def test_item_merged(self):
+        "Test that an item merged ahead completes that item's merge"
+        a, b, c = self.items
+        self.itemMerged(c, 'Z2')
+        build_set = b.current_build_set
+        self.assertEqual(build_set.merge_state, build_set.COMPLETE)
+        self.assertEqual(build_set.commit, 'abc')
+        self.assertEqual(build_set.zuul_url, 'http://merger')
+        self.assertEqual(build_set.ref, 'Z2')
+        self.assertTrue(self.queue.dirty)
+        for item in (a, c):
+            self.assertEqual(item.current_build_set.merge_state,
+                             model.BuildSet.PENDING)
+            self.assertIsNone(item.current_build_set.commit)
+
+    def test_item_merged_zuul_ref(self):
+        "Test that an item uses the zuul ref of a shared merge"
+        a, b, c = self.items
+        self.itemMerged(c, 'Z1', zuul_ref='Z7')
+        build_set = a.current_build_set
+        self.assertEqual(build_set.merge_state, build_set.COMPLETE)
+        self.assertEqual(build_set.ref, 'Z7')
+
+    def test_item_merged_different_ref(self):
+        "Test that an item merged ahead is matched by its zuul ref"
+        a, b, c = self.items
+        # B was reset since C's merge was requested
+        b.resetAllBuilds()
+        self.setMergePending(b, 'Z4')
+        self.itemMerged(c, 'Z2')
+        for item in self.items:
+            self.assertEqual(item.current_build_set.merge_state,
+                             model.BuildSet.PENDING)
+        self.assertFalse(self.queue.dirty)
+
+    def test_item_merged_not_current(self):
+        "Test that an item merged for an old build set is ignored"
+        a, b, c = self.items
+        old_build_set = c.current_build_set
+        self.sched.onItemMerged(old_build_set, 'Z1', 'http://merger', 'abc')
+        c.resetAllBuilds()
+        self.sched.process_result_queue()
+        for item in self.items:
+            self.assertNotEqual(item.current_build_set.merge_state,
+                                model.BuildSet.COMPLETE)
+        self.assertFalse(self.queue.dirty)
+
+    def test_item_merged_after_merge(self):
+        "Test that an item whose own merge finished is left alone"
+        a, b, c = self.items
+        build_set = a.current_build_set
+        build_set.merge_state = build_set.COMPLETE
+        build_set.commit = 'def'
+        self.itemMerged(c, 'Z1')
+        self.assertEqual(build_set.commit, 'def')
+        self.assertFalse(self.queue.dirty)
+
+
+class TestCanceledBuildMutex(BaseTestCase):
+
+    def setUp(self):
+        super(TestCanceledBuildMutex, self).setUp()
+        self.sched = zuul.scheduler.Scheduler(None, testonly=True)
+        pipeline = model.Pipeline('check')
+        pipeline.setManager(zuul.scheduler.IndependentPipelineManager(
+            self.sched, pipeline))
+        self.sched.layout.pipelines['check'] = pipeline
+        project = model.Project('org/project')
+        self.items = []
+        for i in range(2):
+            queue = model.ChangeQueue(pipeline)
+            pipeline.addQueue(queue)
+            change = model.Change(project)
+            change.number = str(i + 1)
+            change.patchset = '1'
+            self.items.append(queue.enqueueChange(change))
+        self.job = model.Job('mutex-job')
+        self.job.mutex = 'test-mutex'
+        self.build = model.Build(self.job, 'uuid')
+        self.items[0].addBuild(self.build)
+        self.assertTrue(self.sched.mutex.acquire(self.items[0], self.job))
+        self.sched.mutex.cancel(self.items[0], self.build)
+
+    def buildCanceled(self, outcome):
+        self.sched.onBuildCanceled(self.build, outcome)
+        self.sched.process_result_queue()
+
+    def test_mutex_held_until_stopped_build_completes(self):
+        "Test that a stopped build keeps its mutex until it completes"
+        a, b = self.items
+        self.buildCanceled('STOPPED')
+        self.assertIn('test-mutex', self.sched.mutex.mutexes)
+        self.assertFalse(self.sched.mutex.acquire(b, self.job))
+        # Nor may the item which was canceled take it for a new build
+        a.resetAllBuilds()
+        self.assertFalse(self.sched.mutex.acquire(a, self.job))
+
+        self.buildCanceled('COMPLETED')
+        self.assertNotIn('test-mutex', self.sched.mutex.mutexes)
+        self.assertTrue(all(queue.dirty for queue in
+                            self.sched.layout.pipelines['check'].queues))
+        self.assertTrue(self.sched.mutex.acquire(b, self.job))
+
+    def test_mutex_released_when_cancel_confirmed(self):
+        "Test that a mutex is released once a build is known not to run"
+        for outcome in ('DEQUEUED', 'NOT_FOUND', 'NOT_LAUNCHED'):
+            self.buildCanceled(outcome)
+            self.assertNotIn('test-mutex', self.sched.mutex.mutexes)
+            self.assertTrue(self.sched.mutex.acquire(self.items[0],
+                                                     self.job))
+            self.sched.mutex.cancel(self.items[0], self.build)
+
+    def test_mutex_released_once(self):
+        "Test that a late completion does not release a reacquired mutex"
+        a, b = self.items
+        self.buildCanceled('NOT_FOUND')
+        self.assertTrue(self.sched.mutex.acquire(b, self.job))
+        self.buildCanceled('COMPLETED')
+        self.assertEqual(self.sched.mutex.mutexes['test-mutex'],
+                         (b, 'mutex-job'))
@@ -84,3 +84,64 @@ class TestWebapp(ZuulTestCase):
 
         self.assertEqual(1, len(data), data)
         self.assertEqual("org/project1", data[0]['project'], data)
+
+    def test_webapp_status_not_modified(self):
+        # an unchanged status version is answered with a 304
+        req = urllib.request.Request(
+            "http://localhost:%s/status" % self.port)
+        f = urllib.request.urlopen(req)
+        etag = f.info().get('ETag')
+        data = json.loads(f.read())
+        self.assertEqual('"%s"' % data['status_version'], etag)
+
+        req = urllib.request.Request(
+            "http://localhost:%s/status" % self.port,
+            headers={'If-None-Match': etag})
+        e = self.assertRaises(urllib.error.HTTPError,
+                              urllib.request.urlopen, req)
+        self.assertEqual(304, e.code)
+
+        req = urllib.request.Request(
+            "http://localhost:%s/status?since=%s" %
+            (self.port, data['status_version']))
+        e = self.assertRaises(urllib.error.HTTPError,
+                              urllib.request.urlopen, req)
+        self.assertEqual(304, e.code)
+
+    def test_webapp_status_since(self):
+        # changes which have not changed since the supplied version
+        # are replaced by stubs
+        req = urllib.request.Request(
+            "http://localhost:%s/status" % self.port)
+        f = urllib.request.urlopen(req)
+        data = json.loads(f.read())
+        version = data['status_version']
+        self.assertTrue(version > 0)
+
+        req = urllib.request.Request(
+            "http://localhost:%s/status?since=0" % self.port)
+        f = urllib.request.urlopen(req)
+        data = json.loads(f.read())
+        self.assertEqual(0, data['since'])
+        changes = []
+        for pipeline in data['pipelines']:
+            for change_queue in pipeline['change_queues']:
+                for head in change_queue['heads']:
+                    changes.extend(head)
+        self.assertEqual(2, len(changes))
+        for change in changes:
+            self.assertNotIn('unchanged', change)
+            self.assertIn('jobs', change)
+
+        self.webapp.cache_time = 0
+        self.sched.status_version += 1
+        req = urllib.request.Request(
+            "http://localhost:%s/status?since=%s" %
+            (self.port, version))
+        f = urllib.request.urlopen(req)
+        data = json.loads(f.read())
+        for pipeline in data['pipelines']:
+            for change_queue in pipeline['change_queues']:
+                for head in change_queue['heads']:
+                    for change in head:
+                        self.assertTrue(change['unchanged'])
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Copyright 2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Zuul merger benchmark.
+
+Create a repository with many files and a series of changes to it, then
+time the Zuul merger merging the series with git merge (which checks out
+each commit) and with git merge-tree (which does not).  Both methods must
+produce the same trees.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import git
+
+import zuul.model
+from zuul.merger.merger import Merger
+
+parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+)
+parser.add_argument('--files', type=int, default=20000,
+                    help='number of files in the repository')
+parser.add_argument('--changes', type=int, default=10,
+                    help='number of changes to merge')
+parser.add_argument('--mode', choices=zuul.model.MERGER_MAP.keys(),
+                    default='merge-resolve', help='merge mode to use')
+parser.add_argument('--keep', action='store_true',
+                    help='do not remove the repositories afterwards')
+args = parser.parse_args()
+
+
+def make_upstream(path):
+    repo = git.Repo.init(path)
+    with repo.config_writer() as config:
+        config.set_value('user', 'email', 'user@example.com')
+        config.set_value('user', 'name', 'User Name')
+    for i in range(args.files):
+        d = os.path.join(path, 'dir%d' % (i % 100))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        with open(os.path.join(d, 'file%d' % i), 'w') as f:
+            f.write('%d\n' % i)
+    repo.git.add('-A')
+    repo.git.commit('-m', 'Initial commit')
+    base = repo.head.commit
+    # Every change is based on the initial commit, so each one after
+    # the first needs a real merge.
+    for i in range(args.changes):
+        repo.git.checkout('-q', base.hexsha)
+        with open(os.path.join(path, 'change%d' % i), 'w') as f:
+            f.write('%d\n' % i)
+        repo.git.add('-A')
+        repo.git.commit('-m', 'Change %d' % i)
+        repo.git.update_ref('refs/changes/%d' % i, 'HEAD')
+    repo.git.checkout('-q', 'master')
+
+
+def run(root, upstream, tree_merges):
+    merger = Merger(os.path.join(root, 'tree' if tree_merges else 'merge'),
+                    {}, 'zuul@example.com', 'zuul',
+                    tree_merges=tree_merges)
+    items = []
+    for i in range(args.changes):
+        items.append(dict(project='project', url=upstream,
+                          connection_name='gerrit',
+                          merge_mode=zuul.model.MERGER_MAP[args.mode],
+                          refspec='refs/changes/%d' % i,
+                          branch='master', ref='Z%d' % i,
+                          number=i, patchset=1))
+    # Clone before timing the merges
+    merger.getRepo('project', upstream).reset()
+    start = time.time()
+    sha = merger.mergeChanges(items)
+    elapsed = time.time() - start
+    repo = merger.getRepo('project', None).createRepoObject()
+    return elapsed, repo.commit(sha).tree.hexsha
+
+
+def main():
+    root = tempfile.mkdtemp()
+    try:
+        upstream = os.path.join(root, 'upstream')
+        print("Creating a repository with %d files and %d changes in %s" %
+              (args.files, args.changes, root))
+        make_upstream(upstream)
+        merge_time, merge_tree = run(root, upstream, False)
+        print("git merge:      %.2fs" % merge_time)
+        tree_time, tree_tree = run(root, upstream, True)
+        print("git merge-tree: %.2fs" % tree_time)
+        if merge_tree != tree_tree:
+            print("The merged trees differ: %s != %s" %
+                  (merge_tree, tree_tree))
+            return 1
+    finally:
+        if not args.keep:
+            shutil.rmtree(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,10 +13,17 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import calendar
+import collections
+import extras
 import threading
 import select
 import json
+import socket
 import time
+import zlib
+from six.moves import http_client
 from six.moves import queue as Queue
 from six.moves import urllib
 import paramiko
@@ -27,35 +34,40 @@ import voluptuous as v
 from zuul.connection import BaseConnection
 from zuul.model import TriggerEvent
 
+statsd = extras.try_import('statsd.statsd')
+
 
 class GerritEventConnector(threading.Thread):
-    """Move events from Gerrit to the scheduler."""
+    """Move events from Gerrit to the scheduler.
+
+    Changes are refreshed by a pool of worker threads.  Every event for
+    a given change is handled by the same worker, so refreshes of a
+    change happen in order, and events are delivered to the scheduler
+    in the order they were received from Gerrit.
+    """
 
     log = logging.getLogger("zuul.GerritEventConnector")
     delay = 10.0
 
-    def __init__(self, connection):
+    def __init__(self, connection, workers=1):
         super(GerritEventConnector, self).__init__()
         self.daemon = True
         self.connection = connection
         self._stopped = False
+        self.condition = threading.Condition()
+        # Events in the order they were received, waiting to be
+        # delivered to the scheduler
+        self.pending = collections.deque()
+        self.worker_queues = [Queue.Queue() for x in range(workers)]
+        self.worker_threads = []
+        self._next_worker = 0
+        self.skipped_refreshes = 0
 
     def stop(self):
         self._stopped = True
         self.connection.addEvent(None)
 
-    def _handleEvent(self):
-        ts, data = self.connection.getEvent()
-        if self._stopped:
-            return
-        # Gerrit can produce inconsistent data immediately after an
-        # event, So ensure that we do not deliver the event to Zuul
-        # until at least a certain amount of time has passed.  Note
-        # that if we receive several events in succession, we will
-        # only need to delay for the first event.  In essence, Zuul
-        # should always be a constant number of seconds behind Gerrit.
-        now = time.time()
-        time.sleep(max((ts + self.delay) - now, 0.0))
+    def _makeEvent(self, data):
         event = TriggerEvent()
         event.type = data.get('type')
         event.trigger_name = 'gerrit'
@@ -97,9 +109,33 @@ class GerritEventConnector(threading.Thread):
             self.log.warning("Received unrecognized event type '%s' from Gerrit.\
                     Can not get account information." % event.type)
             event.account = None
+        return event
 
+    def _refreshChange(self, ts, event):
+        # Gerrit can produce inconsistent data immediately after an
+        # event, So ensure that we do not refresh the change or
+        # deliver the event to Zuul until at least a certain amount
+        # of time has passed.  Each event is delayed on its own, so
+        # in essence Zuul should always be a constant number of
+        # seconds behind Gerrit.
+        now = time.time()
+        time.sleep(max((ts + self.delay) - now, 0.0))
         if (event.change_number and
             self.connection.sched.getProject(event.project_name)):
+            if self._canSkipRefresh(event):
+                # The event is still delivered, for the triggers and
+                # statistics, but the scheduler need not query the
+                # change for it either.
+                self.log.debug("Skipping refresh of change %s,%s for "
+                               "event %s which can not match any "
+                               "pipeline" % (event.change_number,
+                                             event.patch_number, event))
+                event.skip_change_query = True
+                self.skipped_refreshes += 1
+                if statsd:
+                    statsd.incr('zuul.connection.%s.skipped_refreshes' %
+                                self.connection.connection_name)
+                return True
             # Call _getChange for the side effect of updating the
             # cache.  Note that this modifies Change objects outside
             # the main thread.
@@ -116,19 +152,117 @@ class GerritEventConnector(threading.Thread):
                 # the cache (which is shared between all the sources)
                 # NOTE(jhesketh): We may couple sources and connections again
                 # at which point this becomes more sensible.
-        self.connection.sched.addEvent(event)
+        return True
 
-    def run(self):
-        while True:
-            if self._stopped:
-                return
+    def _canSkipRefresh(self, event):
+        # If nothing holds the change and no pipeline could be
+        # triggered by the event, the scheduler would only query
+        # Gerrit for the change and then discard it, so the refresh
+        # is not needed.  New patchsets and abandoned changes affect
+        # items for other patchsets of the change, so they are always
+        # refreshed, as are changes which any queue item uses.
+        if event.type in ('patchset-created', 'change-abandoned'):
+            return False
+        if not event.patch_number:
+            return False
+        key = '%s,%s' % (event.change_number, event.patch_number)
+        if self.connection.isChangeCached(key):
+            return False
+        if self.connection.isChangeNumberPinned(event.change_number):
+            return False
+        for pipeline in list(self.connection.sched.layout.pipelines.values()):
+            for ef in pipeline.manager.event_filters:
+                # Only filters for this connection's trigger can match
+                # events from it; the remaining checks (such as
+                # required approvals) need the change, so any filter
+                # which matches the event might match.
+                if ef.trigger.connection is not self.connection:
+                    continue
+                if ef.matchesEvent(event):
+                    return False
+        return True
+
+    def _getWorkerQueue(self, event):
+        if event.change_number:
+            index = int(event.change_number) % len(self.worker_queues)
+        else:
+            index = self._next_worker
+            self._next_worker = (index + 1) % len(self.worker_queues)
+        return self.worker_queues[index]
+
+    def _deliverEvents(self):
+        # Called with the condition held by whichever worker finished
+        # last, so only one thread delivers events at a time.
+        while self.pending and self.pending[0]['done']:
+            entry = self.pending.popleft()
             try:
-                self._handleEvent()
-            except:
+                if entry['event'] and not self._stopped:
+                    self.connection.sched.addEvent(entry['event'])
+            except Exception:
                 self.log.exception("Exception moving Gerrit event:")
             finally:
                 self.connection.eventDone()
 
+    def _runWorker(self, queue):
+        while True:
+            entry = queue.get()
+            if entry is None:
+                return
+            try:
+                if self._stopped:
+                    entry['event'] = None
+                elif not self._refreshChange(entry['ts'], entry['event']):
+                    entry['event'] = None
+            except Exception:
+                self.log.exception("Exception moving Gerrit event:")
+                entry['event'] = None
+            with self.condition:
+                entry['done'] = True
+                self._deliverEvents()
+
+    def _handleEvent(self):
+        ts, data = self.connection.getEvent()
+        if self._stopped:
+            self.connection.eventDone()
+            return
+        entry = dict(ts=ts, event=None, done=False)
+        with self.condition:
+            self.pending.append(entry)
+        try:
+            entry['event'] = self._makeEvent(data)
+        except Exception:
+            self.log.exception("Exception moving Gerrit event:")
+            with self.condition:
+                entry['done'] = True
+                self._deliverEvents()
+            return
+        self._getWorkerQueue(entry['event']).put(entry)
+
+    def run(self):
+        for queue in self.worker_queues:
+            thread = threading.Thread(target=self._runWorker, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.worker_threads.append(thread)
+        while not self._stopped:
+            self._handleEvent()
+        # Events which are still waiting for a worker are dropped, but
+        # each must still be marked done on the connection.
+        for queue in self.worker_queues:
+            while True:
+                try:
+                    entry = queue.get(block=False)
+                except Queue.Empty:
+                    break
+                entry['event'] = None
+            queue.put(None)
+        for thread in self.worker_threads:
+            thread.join()
+        with self.condition:
+            for entry in self.pending:
+                entry['done'] = True
+            self._deliverEvents()
+
 
 class GerritWatcher(threading.Thread):
     log = logging.getLogger("gerrit.GerritWatcher")
@@ -206,6 +340,422 @@ class GerritWatcher(threading.Thread):
         self._stopped = True
 
 
+class GerritSSHPool(object):
+    """A bounded pool of SSH connections to Gerrit.
+
+    Up to size SSH connections are opened as they are needed, and up
+    to channels commands may be run on each connection at once.
+    Callers wait for a free channel if the pool is fully in use.
+    Connections which have died are replaced.
+    """
+
+    log = logging.getLogger("gerrit.GerritSSHPool")
+
+    def __init__(self, hostname, username, port=29418, keyfile=None,
+                 size=1, channels=1, keepalive=0):
+        self.hostname = hostname
+        self.username = username
+        self.port = port
+        self.keyfile = keyfile
+        self.size = size
+        self.channels = channels
+        self.keepalive = keepalive
+        self.condition = threading.Condition()
+        # client -> number of commands in progress
+        self.clients = {}
+        # Clients removed from the pool which are still in use
+        self.retired = {}
+        self.opening = 0
+
+    def _connect(self):
+        self.log.debug("Opening SSH connection to %s" % self.hostname)
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.WarningPolicy())
+        client.connect(self.hostname,
+                       username=self.username,
+                       port=self.port,
+                       key_filename=self.keyfile)
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def _isActive(self, client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _retire(self, client):
+        count = self.clients.pop(client)
+        if count:
+            self.retired[client] = count
+        else:
+            client.close()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                for client in list(self.clients.keys()):
+                    if not self._isActive(client):
+                        self.log.debug("Removing inactive SSH connection")
+                        self._retire(client)
+                # Prefer an idle connection, then a new one, then
+                # sharing the least busy connection.
+                available = [c for c in self.clients.keys()
+                             if self.clients[c] < self.channels]
+                if available:
+                    client = min(available, key=lambda c: self.clients[c])
+                    if (not self.clients[client] or
+                            len(self.clients) + self.opening >= self.size):
+                        self.clients[client] += 1
+                        return client
+                if len(self.clients) + self.opening < self.size:
+                    self.opening += 1
+                    break
+                self.condition.wait()
+        try:
+            client = self._connect()
+        except Exception:
+            with self.condition:
+                self.opening -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.opening -= 1
+            self.clients[client] = 1
+        return client
+
+    def release(self, client, discard=False):
+        """Return a client to the pool.
+
+        If discard is true, or the connection has died, the client is
+        removed from the pool and closed once nothing is using it.
+        """
+        with self.condition:
+            if client in self.clients:
+                self.clients[client] -= 1
+                if discard or not self._isActive(client):
+                    self._retire(client)
+            elif client in self.retired:
+                self.retired[client] -= 1
+                if not self.retired[client]:
+                    del self.retired[client]
+                    client.close()
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            for client in list(self.clients.keys()):
+                self._retire(client)
+
+
+class GerritHTTPError(Exception):
+    def __init__(self, url, status, reason, body=''):
+        super(GerritHTTPError, self).__init__(
+            "Gerrit error fetching %s: %s %s" % (url, status, reason))
+        self.status = status
+        self.body = body
+
+
+class GerritHTTPClient(object):
+    """A client for the Gerrit REST API.
+
+    Requests are made over a small pool of persistent HTTP(S)
+    connections, and ask for gzip compressed responses.  If a password
+    is supplied, requests are authenticated with HTTP basic auth.
+    """
+
+    log = logging.getLogger("gerrit.GerritHTTPClient")
+    timeout = 60
+
+    def __init__(self, baseurl, user=None, password=None, size=2):
+        url = urllib.parse.urlparse(baseurl)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/')
+        self.auth = None
+        if password:
+            # Authenticated REST endpoints are under /a/
+            self.path += '/a'
+            self.auth = 'Basic ' + base64.b64encode(
+                ('%s:%s' % (user, password)).encode('utf8')).decode('ascii')
+        self.connections = Queue.LifoQueue(size)
+
+    def _connect(self):
+        self.log.debug("Opening HTTP connection to %s" % self.netloc)
+        if self.scheme == 'https':
+            return http_client.HTTPSConnection(self.netloc,
+                                               timeout=self.timeout)
+        return http_client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _getConnection(self):
+        try:
+            return self.connections.get(block=False)
+        except Queue.Empty:
+            return self._connect()
+
+    def _putConnection(self, conn):
+        try:
+            self.connections.put(conn, block=False)
+        except Queue.Full:
+            conn.close()
+
+    def get(self, path, params=None):
+        url = self.path + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params, doseq=True)
+        headers = {'Accept': 'application/json',
+                   'Accept-Encoding': 'gzip'}
+        if self.auth:
+            headers['Authorization'] = self.auth
+        self.log.debug("HTTP request: %s" % url)
+        # A pooled connection may have been closed by the server since
+        # it was last used, in which case try again on a new one.
+        for attempt in range(2):
+            conn = self._getConnection()
+            try:
+                conn.request('GET', url, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http_client.HTTPException, socket.error):
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self._putConnection(conn)
+            break
+        if response.getheader('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        body = body.decode('utf8', 'replace')
+        if response.status != 200:
+            raise GerritHTTPError(url, response.status, response.reason,
+                                  body)
+        # Strip the prefix Gerrit adds to guard against XSSI
+        if body.startswith(")]}'"):
+            body = body[4:]
+        return json.loads(body)
+
+    def close(self):
+        while True:
+            try:
+                self.connections.get(block=False).close()
+            except Queue.Empty:
+                return
+
+
+class GerritChangeCache(object):
+    """A cache of Change objects, keyed by "number,patchset".
+
+    Changes which belong to queue items are pinned by their owner and
+    are never evicted.  Other changes expire ttl seconds after they
+    were last used, and the least recently used ones are evicted
+    whenever the cache holds more than size changes.
+
+    Each change may also be locked while it is updated, so that two
+    threads do not update (or create) the same change at once.
+    """
+
+    log = logging.getLogger("gerrit.GerritChangeCache")
+
+    def __init__(self, size=10000, ttl=3600, stats_prefix=None):
+        self.size = size
+        self.ttl = ttl
+        self.stats_prefix = stats_prefix
+        self.lock = threading.Lock()
+        # key -> (change, time last used), least recently used first
+        self.changes = collections.OrderedDict()
+        # key -> set of owners pinning it
+        self.pins = {}
+        # owner -> set of keys it pins
+        self.owners = {}
+        # key -> [lock, number of users, change]; the change is set
+        # once the thread holding the lock has put it in the cache.
+        self.change_locks = {}
+        # thread -> number of change locks it holds
+        self.lock_holders = {}
+
+    def _incr(self, stat, count=1):
+        if statsd and self.stats_prefix and count:
+            statsd.incr('%s.%s' % (self.stats_prefix, stat), count)
+
+    def _touch(self, key, change):
+        self.changes.pop(key, None)
+        self.changes[key] = (change, time.time())
+
+    def _prune(self):
+        # Expired and excess changes are at the front of the cache;
+        # pinned ones found there are moved to the back, since they
+        # are exempt from both.
+        evicted = 0
+        now = time.time()
+        remaining = len(self.changes)
+        while remaining:
+            remaining -= 1
+            key = next(iter(self.changes))
+            change, last_used = self.changes[key]
+            if key in self.pins:
+                self._touch(key, change)
+                continue
+            if (len(self.changes) <= self.size and
+                    now - last_used < self.ttl):
+                break
+            del self.changes[key]
+            evicted += 1
+        if evicted:
+            self.log.debug("Evicted %s changes from the cache" % evicted)
+        return evicted
+
+    def get(self, key, refresh=False):
+        """Return the cached change for key, or None.
+
+        If refresh is true the caller is about to update the change, so
+        the lookup is counted as a refresh rather than a hit.
+        """
+        with self.lock:
+            change = None
+            evicted = 0
+            if key in self.changes:
+                change, last_used = self.changes[key]
+                if (key not in self.pins and
+                        time.time() - last_used >= self.ttl):
+                    del self.changes[key]
+                    change = None
+                    evicted = 1
+                else:
+                    self._touch(key, change)
+        self._incr('evictions', evicted)
+        if change is None:
+            self._incr('misses')
+        elif refresh:
+            self._incr('refreshes')
+        else:
+            self._incr('hits')
+        return change
+
+    def put(self, key, change):
+        with self.lock:
+            if key in self.change_locks:
+                self.change_locks[key][2] = change
+            self._touch(key, change)
+            evicted = self._prune()
+        self._incr('evictions', evicted)
+
+    def delete(self, key):
+        with self.lock:
+            self.changes.pop(key, None)
+
+    def pin(self, owner, keys):
+        """Pin the changes with the given keys on behalf of owner.
+
+        This replaces any changes which owner previously pinned.
+        """
+        with self.lock:
+            self._unpin(owner)
+            keys = set(keys)
+            if keys:
+                self.owners[owner] = keys
+            for key in keys:
+                self.pins.setdefault(key, set()).add(owner)
+
+    def pinRelated(self, key, keys):
+        """Pin the changes with the given keys on behalf of every owner
+        which pins the change with key."""
+        with self.lock:
+            owners = self.pins.get(key)
+            if not owners:
+                return
+            for owner in owners:
+                self.owners[owner].update(keys)
+            for related_key in keys:
+                self.pins.setdefault(related_key, set()).update(owners)
+
+    def _unpin(self, owner):
+        for key in self.owners.pop(owner, set()):
+            owners = self.pins.get(key)
+            if owners is None:
+                continue
+            owners.discard(owner)
+            if not owners:
+                del self.pins[key]
+                # The change's ttl starts when it is no longer in use
+                if key in self.changes:
+                    self._touch(key, self.changes[key][0])
+
+    def unpin(self, owner):
+        with self.lock:
+            self._unpin(owner)
+
+    def lockChange(self, key):
+        """Lock the change with key while this thread updates it.
+
+        Returns None once the lock is held; it must then be released
+        with unlock().  A thread which already holds the lock of
+        another change (while updating the changes related to it) does
+        not wait for one which another thread is updating, so that two
+        threads can not wait for each other; the change which is being
+        updated is returned instead.
+        """
+        thread = threading.current_thread()
+        with self.lock:
+            entry = self.change_locks.get(key)
+            if entry is None:
+                entry = self.change_locks[key] = [threading.RLock(), 0, None]
+            entry[1] += 1
+            nested = thread in self.lock_holders
+        if not entry[0].acquire(False):
+            change = entry[2]
+            if nested and change is not None:
+                self._releaseEntry(key, entry)
+                return change
+            entry[0].acquire()
+        with self.lock:
+            self.lock_holders[thread] = self.lock_holders.get(thread, 0) + 1
+        return None
+
+    def unlockChange(self, key):
+        thread = threading.current_thread()
+        with self.lock:
+            entry = self.change_locks[key]
+            entry[0].release()
+            self.lock_holders[thread] -= 1
+            if not self.lock_holders[thread]:
+                del self.lock_holders[thread]
+        self._releaseEntry(key, entry)
+
+    def _releaseEntry(self, key, entry):
+        with self.lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.change_locks[key]
+
+    def isNumberPinned(self, number):
+        """Return whether any patchset of the change is pinned."""
+        prefix = '%s,' % (number,)
+        with self.lock:
+            for key in self.pins:
+                if key.startswith(prefix):
+                    return True
+        return False
+
+    def __contains__(self, key):
+        # Unlike get(), this does not count as a use of the change
+        with self.lock:
+            if key not in self.changes:
+                return False
+            last_used = self.changes[key][1]
+            return (key in self.pins or
+                    time.time() - last_used < self.ttl)
+
+    def keys(self):
+        with self.lock:
+            return list(self.changes.keys())
+
+    def __len__(self):
+        return len(self.changes)
+
+
 class GerritConnection(BaseConnection):
     driver_name = 'gerrit'
     log = logging.getLogger("connection.gerrit")
@@ -226,36 +776,68 @@ class GerritConnection(BaseConnection):
         self.keyfile = self.connection_config.get('sshkey', None)
         self.watcher_thread = None
         self.event_queue = None
-        self.client = None
+        self.event_workers = int(self.connection_config.get('event_workers',
+                                                            4))
+        self.ssh_pool = GerritSSHPool(
+            self.server, self.user, port=self.port, keyfile=self.keyfile,
+            size=int(self.connection_config.get('ssh_connections', 2)),
+            channels=int(self.connection_config.get('ssh_channels', 2)),
+            keepalive=int(self.connection_config.get('ssh_keepalive', 60)))
 
         self.baseurl = self.connection_config.get('baseurl',
                                                   'https://%s' % self.server)
 
-        self._change_cache = {}
+        self.query_backend = self.connection_config.get('query_backend',
+                                                        'ssh')
+        if self.query_backend not in ('ssh', 'http'):
+            raise Exception('query_backend must be ssh or http for gerrit '
+                            'connections in %s' % self.connection_name)
+        self.http = GerritHTTPClient(
+            self.baseurl,
+            user=self.connection_config.get('http_user', self.user),
+            password=self.connection_config.get('http_password'),
+            size=int(self.connection_config.get('http_connections', 2)))
+        # Submit records are only returned by Gerrit 3.5 and later;
+        # this is cleared if Gerrit turns out not to support them.
+        self.http_submit_records = True
+
+        self._change_cache = GerritChangeCache(
+            size=int(self.connection_config.get('change_cache_size',
+                                                10000)),
+            ttl=int(self.connection_config.get('change_cache_ttl', 3600)),
+            stats_prefix='zuul.connection.%s.change_cache' %
+            self.connection_name)
         self.gerrit_event_connector = None
 
-    def getCachedChange(self, key):
-        if key in self._change_cache:
-            return self._change_cache.get(key)
-        return None
+    def getCachedChange(self, key, refresh=False):
+        return self._change_cache.get(key, refresh)
+
+    def isChangeCached(self, key):
+        return key in self._change_cache
+
+    def isChangeNumberPinned(self, number):
+        return self._change_cache.isNumberPinned(number)
 
     def updateChangeCache(self, key, value):
-        self._change_cache[key] = value
+        self._change_cache.put(key, value)
 
     def deleteCachedChange(self, key):
-        if key in self._change_cache:
-            del self._change_cache[key]
-
-    def maintainCache(self, relevant):
-        # This lets the user supply a list of change objects that are
-        # still in use.  Anything in our cache that isn't in the supplied
-        # list should be safe to remove from the cache.
-        remove = []
-        for key, change in self._change_cache.items():
-            if change not in relevant:
-                remove.append(key)
-        for key in remove:
-            del self._change_cache[key]
+        self._change_cache.delete(key)
+
+    def lockChange(self, key):
+        return self._change_cache.lockChange(key)
+
+    def unlockChange(self, key):
+        self._change_cache.unlockChange(key)
+
+    def pinChanges(self, owner, keys):
+        self._change_cache.pin(owner, keys)
+
+    def unpinChanges(self, owner):
+        self._change_cache.unpin(owner)
+
+    def pinRelatedChanges(self, key, keys):
+        self._change_cache.pinRelated(key, keys)
 
     def addEvent(self, data):
         return self.event_queue.put((time.time(), data))
@@ -279,12 +861,18 @@ class GerritConnection(BaseConnection):
         out, err = self._ssh(cmd)
         return err
 
+    query_args = ('--all-approvals --comments --commit-message'
+                  ' --current-patch-set --dependencies --files'
+                  ' --patch-sets --submit-records')
+
     def query(self, query):
-        args = '--all-approvals --comments --commit-message'
-        args += ' --current-patch-set --dependencies --files'
-        args += ' --patch-sets --submit-records'
+        if self.query_backend == 'http':
+            results = self._httpQuery(query)
+            if not results:
+                return False
+            return results[0]
         cmd = 'gerrit query --format json %s %s' % (
-            args, query)
+            self.query_args, query)
         out, err = self._ssh(cmd)
         if not out:
             return False
@@ -298,7 +886,32 @@ class GerritConnection(BaseConnection):
                        (pprint.pformat(data)))
         return data
 
+    def queryChanges(self, numbers):
+        """Query several changes at once.
+
+        Returns a list of results in the same format as query() for
+        each of the numbered changes which was found.
+        """
+        if not numbers:
+            return []
+        query = ' OR '.join(['change:%s' % n for n in numbers])
+        if self.query_backend == 'http':
+            return self._httpQuery(query)
+        cmd = 'gerrit query --format json %s %s' % (
+            self.query_args, query)
+        out, err = self._ssh(cmd)
+        # filter out blank lines and the statistics line
+        data = [json.loads(line) for line in out.split('\n')
+                if line.startswith('{')]
+        data = [d for d in data if d.get('type') != 'stats']
+        self.log.debug("Received data from Gerrit query: \n%s" %
+                       (pprint.pformat(data)))
+        return data
+
     def simpleQuery(self, query):
+        if self.query_backend == 'http':
+            return self._httpSimpleQuery(query)
+
         def _query_chunk(query):
             args = '--commit-message --current-patch-set'
 
@@ -348,42 +961,272 @@ class GerritConnection(BaseConnection):
             chunk, more_changes = _query_chunk("%s %s" % (query, resume))
         return alldata
 
-    def _open(self):
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        client.connect(self.server,
-                       username=self.user,
-                       port=self.port,
-                       key_filename=self.keyfile)
-        self.client = client
-
     def _ssh(self, command, stdin_data=None):
-        if not self.client:
-            self._open()
-
+        client = self.ssh_pool.acquire()
         try:
-            self.log.debug("SSH command:\n%s" % command)
-            stdin, stdout, stderr = self.client.exec_command(command)
-        except:
-            self._open()
-            stdin, stdout, stderr = self.client.exec_command(command)
+            try:
+                self.log.debug("SSH command:\n%s" % command)
+                stdin, stdout, stderr = client.exec_command(command)
+            except:
+                # Replace the connection and try once more
+                self.ssh_pool.release(client, discard=True)
+                client = None
+                client = self.ssh_pool.acquire()
+                stdin, stdout, stderr = client.exec_command(command)
 
-        if stdin_data:
-            stdin.write(stdin_data)
+            if stdin_data:
+                stdin.write(stdin_data)
 
-        out = stdout.read()
-        self.log.debug("SSH received stdout:\n%s" % out)
+            out = stdout.read()
+            self.log.debug("SSH received stdout:\n%s" % out)
 
-        ret = stdout.channel.recv_exit_status()
-        self.log.debug("SSH exit status: %s" % ret)
+            ret = stdout.channel.recv_exit_status()
+            self.log.debug("SSH exit status: %s" % ret)
 
-        err = stderr.read()
-        self.log.debug("SSH received stderr:\n%s" % err)
+            err = stderr.read()
+            self.log.debug("SSH received stderr:\n%s" % err)
+        finally:
+            if client:
+                self.ssh_pool.release(client)
         if ret:
             raise Exception("Gerrit error executing %s" % command)
         return (out, err)
 
+    # The REST API returns changes in a different format from the SSH
+    # query command; the methods below translate them into the SSH
+    # format, which is what the rest of Zuul expects.
+
+    def _httpTime(self, timestamp):
+        # Gerrit timestamps look like 2015-01-01 00:00:00.000000000 UTC
+        return calendar.timegm(time.strptime(timestamp[:19],
+                                             '%Y-%m-%d %H:%M:%S'))
+
+    def _httpAccount(self, account):
+        ret = {}
+        for key in ('name', 'email', 'username'):
+            if key in account:
+                ret[key] = account[key]
+        return ret
+
+    def _httpChange(self, info):
+        number = str(info['_number'])
+        data = {
+            'project': info['project'],
+            'branch': info['branch'],
+            'id': info['change_id'],
+            'number': number,
+            'subject': info['subject'],
+            'owner': self._httpAccount(info.get('owner', {})),
+            'url': '%s/%s' % (self.baseurl.rstrip('/'), number),
+            'lastUpdated': self._httpTime(info['updated']),
+            'open': info['status'] not in ('MERGED', 'ABANDONED'),
+            'status': info['status'],
+        }
+        patchsets = []
+        for sha, revision in info.get('revisions', {}).items():
+            ps = {
+                'number': str(revision['_number']),
+                'revision': sha,
+                'ref': revision['ref'],
+            }
+            if 'files' in revision:
+                ps['files'] = [dict(file=f) for f in revision['files']]
+            if sha == info.get('current_revision'):
+                data['currentPatchSet'] = ps
+                if 'commit' in revision:
+                    data['commitMessage'] = revision['commit']['message']
+            patchsets.append(ps)
+        patchsets.sort(key=lambda ps: int(ps['number']))
+        data['patchSets'] = patchsets
+        return data
+
+    def _httpApprovals(self, info):
+        approvals = []
+        for label, label_info in info.get('labels', {}).items():
+            for approval in label_info.get('all', []):
+                if not approval.get('value'):
+                    continue
+                approvals.append({
+                    'type': label,
+                    'description': label,
+                    'value': str(approval['value']),
+                    'grantedOn': self._httpTime(approval['date']),
+                    'by': self._httpAccount(approval),
+                })
+        return approvals
+
+    def _httpSubmitRecords(self, info):
+        if info['status'] != 'NEW':
+            return [{'status': 'CLOSED'}]
+        if 'submit_records' in info:
+            # These are the same records the SSH query returns
+            records = []
+            for record in info['submit_records']:
+                labels = [{'label': label['label'],
+                           'status': label['status']}
+                          for label in record.get('labels', [])]
+                records.append({'status': record['status'],
+                                'labels': labels})
+            return records
+        # Older versions of Gerrit only say whether the change can be
+        # submitted, so work out what each label needs from its votes.
+        labels = []
+        for label, label_info in info.get('labels', {}).items():
+            if 'rejected' in label_info:
+                status = 'REJECT'
+            elif 'approved' in label_info:
+                status = 'OK'
+            elif label_info.get('optional'):
+                status = 'MAY'
+            else:
+                status = 'NEED'
+            labels.append({'label': label, 'status': status})
+        if 'submittable' in info:
+            submittable = info['submittable']
+        else:
+            submittable = not [x for x in labels
+                               if x['status'] in ('NEED', 'REJECT')]
+        if submittable:
+            status = 'OK'
+        else:
+            status = 'NOT_READY'
+        return [{'status': status, 'labels': labels}]
+
+    def _httpQuery(self, query):
+        query = str(query)
+        if query.isdigit():
+            query = 'change:%s' % query
+        params = [('q', query),
+                  ('o', 'ALL_REVISIONS'),
+                  ('o', 'ALL_FILES'),
+                  ('o', 'CURRENT_COMMIT'),
+                  ('o', 'DETAILED_LABELS'),
+                  ('o', 'DETAILED_ACCOUNTS'),
+                  ('o', 'SUBMITTABLE')]
+        if self.http_submit_records:
+            params.append(('o', 'SUBMIT_REQUIREMENTS'))
+        try:
+            infos = self.http.get('/changes/', params)
+        except GerritHTTPError as e:
+            # Gerrit before 3.5 rejects the option as not valid
+            if (e.status != 400 or not self.http_submit_records or
+                'SUBMIT_REQUIREMENTS' not in e.body):
+                raise
+            self.log.info("Gerrit does not return submit records; "
+                          "using whether changes are submittable")
+            self.http_submit_records = False
+            return self._httpQuery(query)
+        related = self._httpRelated(infos)
+        results = []
+        for info in infos:
+            data = self._httpChange(info)
+            data['submitRecords'] = self._httpSubmitRecords(info)
+            if 'currentPatchSet' in data:
+                data['currentPatchSet']['approvals'] = \
+                    self._httpApprovals(info)
+                self._httpDependencies(info, data,
+                                       related[info['current_revision']])
+            results.append(data)
+        self.log.debug("Received data from Gerrit query: \n%s" %
+                       (pprint.pformat(results)))
+        return results
+
+    def _httpParents(self, revision):
+        return [p['commit'] for p in revision.get('parents', [])]
+
+    def _httpDescendants(self, sha, related):
+        # The commits in a list of related changes which are, or
+        # descend from, the given one.
+        descendants = set([sha])
+        found = True
+        while found:
+            found = False
+            for change in related:
+                commit = change['commit']
+                if commit['commit'] in descendants:
+                    continue
+                if descendants.intersection(self._httpParents(commit)):
+                    descendants.add(commit['commit'])
+                    found = True
+        return descendants
+
+    def _httpRelated(self, infos):
+        # Gerrit lists the related changes of one change at a time, but
+        # the list includes all of its ancestors and descendants, and
+        # so every change in it which descends from that one has the
+        # same related changes.  Ask about the oldest change in each
+        # chain of the results, and share its list with the rest.
+        # Returns the related changes for the current revision of each.
+        current = {}
+        for info in infos:
+            if info.get('current_revision') in info.get('revisions', {}):
+                current[info['current_revision']] = info
+        related = {}
+        for sha, info in current.items():
+            if sha in related:
+                continue
+            root = info
+            seen = set([sha])
+            while True:
+                revision = root['revisions'][root['current_revision']]
+                parents = [p for p in self._httpParents(
+                    revision.get('commit', {}))
+                    if p in current and p not in seen
+                    and p not in related]
+                if not parents:
+                    break
+                seen.add(parents[0])
+                root = current[parents[0]]
+            path = '/changes/%s/revisions/%s/related' % (
+                root['_number'], root['current_revision'])
+            changes = self.http.get(path).get('changes', [])
+            for descendant in self._httpDescendants(
+                    root['current_revision'], changes):
+                related.setdefault(descendant, changes)
+        return related
+
+    def _httpDependencies(self, info, data, related):
+        # The git dependencies of the current patchset: the change
+        # whose commit is its parent, and those whose parent it is.
+        current = info['current_revision']
+        parents = self._httpParents(info['revisions'][current]['commit'])
+        depends_on = []
+        needed_by = []
+        for change in related:
+            if '_change_number' not in change:
+                continue
+            ref = 'refs/changes/%02d/%s/%s' % (
+                int(change['_change_number']) % 100,
+                change['_change_number'], change['_revision_number'])
+            dep = {'number': str(change['_change_number']),
+                   'ref': ref,
+                   'revision': change['commit']['commit']}
+            if dep['revision'] in parents:
+                depends_on.append(dep)
+            elif current in self._httpParents(change['commit']):
+                needed_by.append(dep)
+        if depends_on:
+            data['dependsOn'] = depends_on
+        if needed_by:
+            data['neededBy'] = needed_by
+
+    def _httpSimpleQuery(self, query):
+        alldata = []
+        while True:
+            params = [('q', query),
+                      ('o', 'CURRENT_REVISION'),
+                      ('o', 'CURRENT_COMMIT')]
+            if alldata:
+                params.append(('S', len(alldata)))
+            results = self.http.get('/changes/', params)
+            for info in results:
+                alldata.append(self._httpChange(info))
+            if not results or not results[-1].get('_more_changes'):
+                break
+        self.log.debug("Received data from Gerrit query: \n%s" %
+                       (pprint.pformat(alldata)))
+        return alldata
+
     def getInfoRefs(self, project):
         url = "%s/p/%s/info/refs?service=git-upload-pack" % (
             self.baseurl, project)
@@ -448,6 +1291,8 @@ class GerritConnection(BaseConnection):
         self.log.debug("Stopping Gerrit Conncetion/Watchers")
         self._stop_watcher_thread()
         self._stop_event_connector()
+        self.ssh_pool.close()
+        self.http.close()
 
     def _stop_watcher_thread(self):
         if self.watcher_thread:
@@ -470,7 +1315,8 @@ class GerritConnection(BaseConnection):
             self.gerrit_event_connector.join()
 
     def _start_event_connector(self):
-        self.gerrit_event_connector = GerritEventConnector(self)
+        self.gerrit_event_connector = GerritEventConnector(
+            self, workers=self.event_workers)
         self.gerrit_event_connector.start()
 
 
@@ -12,12 +12,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import extras
 import gear
 import inspect
 import json
 import logging
 import os
 import six
+from six.moves import queue as Queue
 import time
 import threading
 from uuid import uuid4
@@ -25,6 +27,8 @@ from uuid import uuid4
 import zuul.model
 from zuul.model import Build
 
+statsd = extras.try_import('statsd.statsd')
+
 
 class GearmanCleanup(threading.Thread):
     """ A thread that checks to see if outstanding builds have
@@ -53,6 +57,215 @@ class GearmanCleanup(threading.Thread):
                 self.log.exception("Exception checking builds:")
 
 
+class GearmanCanceller(threading.Thread):
+    """ A thread that cancels builds, so that the scheduler need not
+    wait for the gearman servers to respond. """
+    log = logging.getLogger("zuul.GearmanCanceller")
+
+    def __init__(self, gearman):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.gearman = gearman
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+        self.queue.put(None)
+
+    def cancel(self, build):
+        with self.lock:
+            self.outstanding += 1
+        self.queue.put(build)
+
+    def run(self):
+        while not self._stopped:
+            # Cancel every build requested since the last batch at once
+            builds = [self.queue.get()]
+            while True:
+                try:
+                    builds.append(self.queue.get(block=False))
+                except Queue.Empty:
+                    break
+            builds = [b for b in builds if b is not None]
+            try:
+                if builds and not self._stopped:
+                    self.gearman.cancelBuilds(builds)
+            except Exception:
+                self.log.exception("Exception canceling builds:")
+            finally:
+                with self.lock:
+                    self.outstanding -= len(builds)
+
+
+class GearmanFunctionRegistry(threading.Thread):
+    """A thread that keeps track of the functions registered with the
+    gearman servers.
+
+    The status of the servers can be very large, so it is fetched and
+    parsed here rather than when launching a job, which only needs to
+    look the function up in the current set.  Only the lines of the
+    status which changed since the last refresh are parsed.
+
+    The functions are refreshed when a lookup asks for it, and
+    otherwise only every refresh_interval seconds.
+    """
+    log = logging.getLogger("zuul.GearmanFunctionRegistry")
+    refresh_interval = 60
+
+    def __init__(self, client):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        # Replaced rather than updated, so that it may be read without
+        # holding the lock.
+        self.functions = frozenset()
+        # The lines of the last status of each connection, and the
+        # functions registered with it.
+        self.connection_lines = {}
+        self.connection_functions = {}
+        # When the last refresh of every connection started, when the
+        # last attempt to refresh started, and when the last refresh
+        # which changed the functions finished.
+        self.refresh_time = 0
+        self.attempt_time = 0
+        self.change_time = 0
+        self.generation = 0
+        self.refreshing = False
+        self.condition = threading.Condition()
+        self.wake_event = threading.Event()
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+        self.wake_event.set()
+
+    def run(self):
+        while not self._stopped:
+            try:
+                self.refresh()
+            except Exception:
+                self.log.exception("Exception refreshing functions:")
+            self.wake_event.wait(self.refresh_interval)
+            self.wake_event.clear()
+
+    def refresh(self):
+        start = time.time()
+        with self.condition:
+            self.refreshing = True
+            self.attempt_time = start
+        connections = list(self.client.active_connections)
+        failed = False
+        size = 0
+        try:
+            for connection in connections:
+                try:
+                    req = gear.StatusAdminRequest()
+                    if not self.client.sendAdminRequests(connection, [req],
+                                                         timeout=300):
+                        raise Exception("Timed out waiting for status")
+                except Exception:
+                    # Keep the functions from the last refresh of this
+                    # connection.
+                    self.log.exception("Exception while checking functions")
+                    failed = True
+                    continue
+                size += len(req.response)
+                self._updateConnection(connection, req.response)
+        finally:
+            for connection in list(self.connection_functions):
+                if connection not in connections:
+                    del self.connection_lines[connection]
+                    del self.connection_functions[connection]
+            functions = set()
+            for connection_functions in self.connection_functions.values():
+                functions |= connection_functions
+            elapsed = time.time() - start
+            added = functions - self.functions
+            removed = self.functions - functions
+            if added or removed:
+                self.log.debug("Functions registered: %s, unregistered: %s" %
+                               (len(added), len(removed)))
+            with self.condition:
+                self.functions = frozenset(functions)
+                # Without any connections nothing is known, so the next
+                # lookup should refresh again; nor is it if any of them
+                # failed.
+                if not connections:
+                    self.refresh_time = 0
+                elif not failed:
+                    self.refresh_time = start
+                if added or removed:
+                    self.change_time = time.time()
+                self.generation += 1
+                self.refreshing = False
+                self.condition.notify_all()
+        if statsd:
+            statsd.timing('zuul.gearman.function_registry.refresh_time',
+                          elapsed * 1000)
+            statsd.gauge('zuul.gearman.function_registry.functions',
+                         len(functions))
+            statsd.gauge('zuul.gearman.function_registry.bytes', size)
+
+    def _updateConnection(self, connection, response):
+        # Only the lines of the functions whose counts have changed
+        # differ from the last status, so only those are parsed.  A
+        # function whose line changed is in both the old and new lines.
+        lines = frozenset(response.split('\n'))
+        old_lines = self.connection_lines.get(connection, frozenset())
+        added = self._getFunctionNames(lines - old_lines)
+        removed = self._getFunctionNames(old_lines - lines) - added
+        functions = set(self.connection_functions.get(connection, ()))
+        functions -= removed
+        functions |= added
+        self.connection_lines[connection] = lines
+        self.connection_functions[connection] = functions
+
+    def _getFunctionNames(self, lines):
+        names = set()
+        for line in lines:
+            parts = [x.strip() for x in line.split()]
+            if not parts or parts[0] == '.':
+                continue
+            names.add(parts[0])
+        return names
+
+    def requestRefresh(self, age=0):
+        """Ask for a refresh without waiting for it.
+
+        Nothing is done if the last refresh started less than age
+        seconds ago.
+        """
+        if time.time() - self.attempt_time >= age:
+            self.wake_event.set()
+
+    def waitForRefresh(self, timeout=300):
+        """Refresh the functions now and wait until that is done."""
+        end = time.time() + timeout
+        with self.condition:
+            # A refresh which has already started may have missed
+            # whatever prompted this one.
+            generation = self.generation + (2 if self.refreshing else 1)
+            self.wake_event.set()
+            while self.generation < generation and not self._stopped:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def isStale(self):
+        if not self.refresh_time:
+            return True
+        for connection in self.client.active_connections:
+            # The server may have restarted and lost its functions
+            if connection.connect_time > self.refresh_time:
+                return True
+        return False
+
+
 def getJobData(job):
     if not len(job.data):
         return {}
@@ -66,6 +279,10 @@ class ZuulGearmanClient(gear.Client):
     def __init__(self, zuul_gearman):
         super(ZuulGearmanClient, self).__init__()
         self.__zuul_gearman = zuul_gearman
+        self.admin_lock = threading.Lock()
+        # Jobs are submitted from more than one thread, and the server's
+        # responses are matched to the pending tasks by their order.
+        self.submit_lock = threading.Lock()
 
     def handleWorkComplete(self, packet):
         job = super(ZuulGearmanClient, self).handleWorkComplete(packet)
@@ -100,12 +317,121 @@ class ZuulGearmanClient(gear.Client):
         try:
             job = super(ZuulGearmanClient, self).handleStatusRes(packet)
         except gear.UnknownJobError:
-            handle = packet.getArgument(0)
-            for build in self.__zuul_gearman.builds:
-                if build.__gearman_job.handle == handle:
-                    self.__zuul_gearman.onUnknownJob(job)
+            # This client has forgotten the job
+            self.__zuul_gearman.onStatusResponse(packet.getArgument(0),
+                                                 False)
+            return None
+        self.__zuul_gearman.onStatusResponse(job.handle, job.known)
+        return job
+
+    def sendAdminRequests(self, connection, requests, timeout=90):
+        """Send several admin requests, then wait for all of the responses.
+
+        Returns False if they were not all received within the timeout.
+        """
+        with self.admin_lock:
+            # The responses are matched to the requests by their order,
+            # so no other requests may be sent in between.
+            for request in requests:
+                connection.admin_requests.append(request)
+                connection.sendRaw(request.getCommand())
+        end = time.time() + timeout
+        for request in requests:
+            if not request.waitForResponse(max(end - time.time(), 0)):
+                return False
+        return True
+
+    def _getSubmitCommand(self, precedence):
+        if precedence == gear.PRECEDENCE_NORMAL:
+            return gear.constants.SUBMIT_JOB
+        elif precedence == gear.PRECEDENCE_LOW:
+            return gear.constants.SUBMIT_JOB_LOW
+        elif precedence == gear.PRECEDENCE_HIGH:
+            return gear.constants.SUBMIT_JOB_HIGH
+        raise gear.ConfigurationError("Invalid precedence value")
+
+    def _sendSubmitJob(self, job, cmd, connection):
+        """Send a request to submit a job and return its pending task."""
+        data = b'\x00'.join((job.binary_name, job.binary_unique or b'',
+                             job.binary_arguments))
+        packet = gear.Packet(gear.constants.REQ, cmd, data)
+        task = gear.SubmitJobTask(job)
+        # Responses are matched to the pending tasks by their order, so
+        # no other request may be sent in between.
+        with self.submit_lock:
+            connection.pending_tasks.append(task)
+            self.sendPacket(packet, connection)
+        return task
+
+    def submitJob(self, job, precedence=gear.PRECEDENCE_NORMAL, timeout=30):
+        """Submit a job, trying each connection in turn until one
+        accepts it.
+        """
+        cmd = self._getSubmitCommand(precedence)
+        attempted_connections = set()
+        while attempted_connections != set(self.active_connections):
+            conn = self.getConnection()
+            attempted_connections.add(conn)
+            try:
+                task = self._sendSubmitJob(job, cmd, conn)
+            except Exception:
+                # Error handling is all done by sendPacket
+                continue
+            if not task.wait(timeout):
+                self.log.error("Connection %s timed out waiting for a "
+                               "response to a submit job request: %s" %
+                               (conn, job))
+                self._lostConnection(conn)
+            elif not job.handle:
+                self.log.error("Connection %s sent an error in "
+                               "response to a submit job request: %s" %
+                               (conn, job))
+            else:
+                job.connection = conn
+                return
+        raise gear.GearmanError("Unable to submit job to any connected "
+                                "servers")
+
+    def submitJobs(self, jobs, precedence=gear.PRECEDENCE_NORMAL,
+                   timeout=30):
+        """Submit several jobs, then wait for the responses to all of them.
+
+        This saves a round trip to the server for each job.  Jobs which
+        could not be submitted that way are submitted again one at a
+        time; any which still fail are logged and left without a handle.
+        """
+        cmd = self._getSubmitCommand(precedence)
+        submitted = []
+        retry = []
+        for job in jobs:
+            try:
+                conn = self.getConnection()
+                task = self._sendSubmitJob(job, cmd, conn)
+            except Exception:
+                # Error handling is all done by sendPacket
+                retry.append(job)
+                continue
+            submitted.append((job, conn, task))
+        end = time.time() + timeout
+        for job, conn, task in submitted:
+            if not task.wait(max(end - time.time(), 0)):
+                self.log.error("Connection %s timed out waiting for a "
+                               "response to a submit job request: %s" %
+                               (conn, job))
+                self._lostConnection(conn)
+                retry.append(job)
+            elif not job.handle:
+                retry.append(job)
+            else:
+                job.connection = conn
+        for job in retry:
+            try:
+                self.submitJob(job, precedence=precedence, timeout=timeout)
+            except Exception:
+                self.log.exception("Unable to submit job %s to Gearman" %
+                                   (job,))
 
-    def waitForGearmanToSettle(self):
+    def waitForGearmanToSettle(self, registry):
         # If we're running the internal gearman server, it's possible
         # that after a restart or reload, we may be immediately ready
         # to run jobs but all the gearman workers may not have
@@ -121,30 +447,11 @@ class ZuulGearmanClient(gear.Client):
         self.waitForServer()
         self.log.info("Waiting for gearman function set to settle")
         start = time.time()
-        last_change = start
-        all_functions = set()
         while time.time() - start < 30:
-            now = time.time()
-            last_functions = set()
-            for connection in self.active_connections:
-                try:
-                    req = gear.StatusAdminRequest()
-                    connection.sendAdminRequest(req, timeout=300)
-                except Exception:
-                    self.log.exception("Exception while checking functions")
-                    continue
-                for line in req.response.split('\n'):
-                    parts = [x.strip() for x in line.split()]
-                    if not parts or parts[0] == '.':
-                        continue
-                    last_functions.add(parts[0])
-            if last_functions != all_functions:
-                last_change = now
-                all_functions.update(last_functions)
-            else:
-                if now - last_change > 5:
-                    self.log.info("Gearman function set has settled")
-                    break
+            registry.waitForRefresh()
+            if time.time() - max(registry.change_time, start) > 5:
+                self.log.info("Gearman function set has settled")
+                break
             time.sleep(1)
         self.log.info("Done waiting for Gearman server")
 
@@ -152,6 +459,11 @@ class ZuulGearmanClient(gear.Client):
 class Gearman(object):
     log = logging.getLogger("zuul.Gearman")
     negative_function_cache_ttl = 5
+    # The number of jobs submitted before waiting for the responses
+    launch_batch_size = 50
+    # How long to wait for the status of the builds when looking for
+    # lost builds
+    lost_build_timeout = 60
 
     def __init__(self, config, sched, swift):
         self.config = config
@@ -174,52 +486,52 @@ class Gearman(object):
         self.gearman = ZuulGearmanClient(self)
         self.gearman.addServer(server, port)
 
+        self.function_registry = GearmanFunctionRegistry(self.gearman)
+        self.function_registry.start()
+
         if (config.has_option('gearman_server', 'start') and
             config.getboolean('gearman_server', 'start')):
-            self.gearman.waitForGearmanToSettle()
+            self.gearman.waitForGearmanToSettle(self.function_registry)
+
+        # The handles of the builds whose status has been requested,
+        # but not received, and of those the server does not know.
+        self.status_lock = threading.Lock()
+        self.status_event = threading.Event()
+        self.status_pending = set()
+        self.status_unknown = set()
 
         self.cleanup_thread = GearmanCleanup(self)
         self.cleanup_thread.start()
-        self.function_cache = set()
-        self.function_cache_time = 0
+        self.canceller = GearmanCanceller(self)
+        self.canceller.start()
 
     def stop(self):
         self.log.debug("Stopping")
         self.cleanup_thread.stop()
         self.cleanup_thread.join()
+        self.canceller.stop()
+        self.canceller.join()
+        self.function_registry.stop()
         self.gearman.shutdown()
+        self.function_registry.join()
         self.log.debug("Stopped")
 
     def isJobRegistered(self, name):
-        if self.function_cache_time:
-            for connection in self.gearman.active_connections:
-                if connection.connect_time > self.function_cache_time:
-                    self.function_cache = set()
-                    self.function_cache_time = 0
-                    break
-        if name in self.function_cache:
+        # Only the functions from the last refresh are looked at, so
+        # that launching never waits for the gearman servers.  If they
+        # may be out of date the registry is asked to refresh them, at
+        # most once every negative_function_cache_ttl seconds.
+        registry = self.function_registry
+        registered = name in registry.functions
+        if not registered or registry.isStale():
+            registry.requestRefresh(self.negative_function_cache_ttl)
+        if registered:
             self.log.debug("Function %s is registered" % name)
             return True
-        if ((time.time() - self.function_cache_time) <
-            self.negative_function_cache_ttl):
-            self.log.debug("Function %s is not registered "
-                           "(negative ttl in effect)" % name)
-            return False
-        self.function_cache_time = time.time()
-        for connection in self.gearman.active_connections:
-            try:
-                req = gear.StatusAdminRequest()
-                connection.sendAdminRequest(req, timeout=300)
-            except Exception:
-                self.log.exception("Exception while checking functions")
-                continue
-            for line in req.response.split('\n'):
-                parts = [x.strip() for x in line.split()]
-                if not parts or parts[0] == '.':
-                    continue
-                self.function_cache.add(parts[0])
-        if name in self.function_cache:
-            self.log.debug("Function %s is registered" % name)
+        if not registry.refresh_time and not registry.functions:
+            # Nothing is known yet, so let gearman decide
+            self.log.debug("Function %s is not known to be registered "
+                           "(functions not yet refreshed)" % name)
             return True
         self.log.debug("Function %s is not registered" % name)
         return False
@@ -273,20 +585,13 @@ class Gearman(object):
                 for key, value in swift_instructions.items():
                     params['_'.join(['SWIFT', name, key])] = value
 
-    def launch(self, job, item, pipeline, dependent_items=[]):
-        uuid = str(uuid4().hex)
-        self.log.info(
-            "Launch job %s (uuid: %s) for change %s with dependent "
-            "changes %s" % (
-                job, uuid, item.change,
-                [x.change for x in dependent_items]))
+    def getItemParameters(self, item, pipeline, dependent_items):
+        """Return the parameters which every job for an item shares."""
         dependent_items = dependent_items[:]
         dependent_items.reverse()
-        params = dict(ZUUL_UUID=uuid,
-                      ZUUL_PROJECT=item.change.project.name)
+        params = dict(ZUUL_PROJECT=item.change.project.name)
         params['ZUUL_PIPELINE'] = pipeline.name
         params['ZUUL_URL'] = item.current_build_set.zuul_url
-        params['ZUUL_VOTING'] = job.voting and '1' or '0'
         if hasattr(item.change, 'refspec'):
             changes_str = '^'.join(
                 ['%s:%s:%s' % (i.change.project.name, i.change.branch,
@@ -313,11 +618,85 @@ class Gearman(object):
             params['ZUUL_REF'] = item.change.ref
             params['ZUUL_COMMIT'] = item.change.newrev
 
+        params['BASE_LOG_PATH'] = item.change.getBasePath()
+        return params
+
+    def launch(self, job, item, pipeline, dependent_items=[]):
+        return self.launchJobs([job], item, pipeline, dependent_items)[0]
+
+    def launchJobs(self, jobs, item, pipeline, dependent_items=[]):
+        """Launch several jobs for an item and return their builds.
+
+        The parameters shared by the jobs are only worked out once, and
+        the jobs are submitted to gearman in batches, without waiting
+        for the server to respond to each one before sending the next.
+        A job which fails to launch has a build with a result, as with
+        launch().  If the parameters for a job can not be worked out,
+        the exception is logged and it has no build.
+        """
+        build_set = item.current_build_set
+        # Items ahead may leave the queue (e.g. when they merge)
+        # without resetting this item, so check they are the same.
+        if (build_set.parameters is not None and
+            build_set.parameters_items == dependent_items):
+            item_params = build_set.parameters
+        else:
+            item_params = self.getItemParameters(item, pipeline,
+                                                 dependent_items)
+            # Until the merge is complete, the commit is not known
+            if build_set.merge_state == build_set.COMPLETE:
+                build_set.parameters = item_params
+                build_set.parameters_items = list(dependent_items)
+        dependent_changes = [x.change for x in dependent_items]
+
+        if pipeline.precedence == zuul.model.PRECEDENCE_NORMAL:
+            precedence = gear.PRECEDENCE_NORMAL
+        elif pipeline.precedence == zuul.model.PRECEDENCE_HIGH:
+            precedence = gear.PRECEDENCE_HIGH
+        elif pipeline.precedence == zuul.model.PRECEDENCE_LOW:
+            precedence = gear.PRECEDENCE_LOW
+
+        builds = []
+        submit = []
+        for job in jobs:
+            try:
+                build = self._prepareBuild(job, item, pipeline,
+                                           dependent_changes, item_params)
+            except Exception:
+                self.log.exception("Exception while launching job %s "
+                                   "for change %s:" % (job, item.change))
+                continue
+            builds.append(build)
+            if build.result is None:
+                submit.append(build)
+
+        for i in range(0, len(submit), self.launch_batch_size):
+            batch = submit[i:i + self.launch_batch_size]
+            self.gearman.submitJobs([b.__gearman_job for b in batch],
+                                    precedence=precedence, timeout=300)
+            for build in batch:
+                gearman_job = build.__gearman_job
+                if not gearman_job.handle:
+                    self.onBuildCompleted(gearman_job, 'EXCEPTION')
+                    continue
+                self.log.debug("Received handle %s for %s" %
+                               (gearman_job.handle, build))
+        return builds
+
+    def _prepareBuild(self, job, item, pipeline, dependent_changes,
+                      item_params):
+        uuid = str(uuid4().hex)
+        self.log.info(
+            "Launch job %s (uuid: %s) for change %s with dependent "
+            "changes %s" % (job, uuid, item.change, dependent_changes))
+        params = dict(item_params)
+        params['ZUUL_UUID'] = uuid
+        params['ZUUL_VOTING'] = job.voting and '1' or '0'
+
         # The destination_path is a unqiue path for this build request
         # and generally where the logs are expected to be placed
         destination_path = os.path.join(item.change.getBasePath(),
                                         pipeline.name, job.name, uuid[:7])
-        params['BASE_LOG_PATH'] = item.change.getBasePath()
         params['LOG_PATH'] = destination_path
 
         # Allow the job to update the params
@@ -373,64 +752,76 @@ class Gearman(object):
             self.onBuildCompleted(gearman_job, 'RETRY_LIMIT')
             return build
 
-        if pipeline.precedence == zuul.model.PRECEDENCE_NORMAL:
-            precedence = gear.PRECEDENCE_NORMAL
-        elif pipeline.precedence == zuul.model.PRECEDENCE_HIGH:
-            precedence = gear.PRECEDENCE_HIGH
-        elif pipeline.precedence == zuul.model.PRECEDENCE_LOW:
-            precedence = gear.PRECEDENCE_LOW
-
-        try:
-            self.gearman.submitJob(gearman_job, precedence=precedence,
-                                   timeout=300)
-        except Exception:
-            self.log.exception("Unable to submit job to Gearman")
-            self.onBuildCompleted(gearman_job, 'EXCEPTION')
-            return build
-
-        if not gearman_job.handle:
-            self.log.error("No job handle was received for %s after"
-                           " 300 seconds; marking as lost." %
-                           gearman_job)
-            self.onBuildCompleted(gearman_job, 'NO_HANDLE')
-
-        self.log.debug("Received handle %s for %s" % (gearman_job.handle,
-                                                      build))
-
         return build
 
     def cancel(self, build):
+        """Mark a build canceled and cancel it in the background."""
         self.log.info("Cancel build %s for job %s" % (build, build.job))
 
         build.canceled = True
-        try:
-            job = build.__gearman_job  # noqa
-        except AttributeError:
-            self.log.debug("Build %s has no associated gearman job" % build)
-            return
+        self.canceller.cancel(build)
 
-        if build.number is not None:
-            self.log.debug("Build %s has already started" % build)
-            self.cancelRunningBuild(build)
-            self.log.debug("Canceled running build %s" % build)
-            return
-        else:
-            self.log.debug("Build %s has not started yet" % build)
+    def areCancelsOutstanding(self):
+        if self.canceller.outstanding:
+            return True
+        return False
 
-        self.log.debug("Looking for build %s in queue" % build)
-        if self.cancelJobInQueue(build):
-            self.log.debug("Removed build %s from queue" % build)
-            return
+    def cancelBuilds(self, builds):
+        """Cancel builds, waiting for gearman to respond.
+
+        Builds which are waiting in a gearman queue are removed from it
+        with a batch of admin requests for each connection, and stop
+        jobs for the builds which have started are submitted together.
+        The outcome for each build is reported to the scheduler.
+        """
+        running = []
+        queued = {}
+        for build in builds:
+            try:
+                job = build.__gearman_job  # noqa
+            except AttributeError:
+                self.log.debug("Build %s has no associated gearman job" %
+                               build)
+                self.sched.onBuildCanceled(build, 'NOT_LAUNCHED')
+                continue
+            if build.number is not None:
+                self.log.debug("Build %s has already started" % build)
+                running.append(build)
+            elif job.handle and job.connection:
+                self.log.debug("Build %s has not started yet" % build)
+                queued.setdefault(job.connection, []).append(build)
+            else:
+                self.log.debug("Build %s was not submitted" % build)
+                self.sched.onBuildCanceled(build, 'NOT_LAUNCHED')
 
-        time.sleep(1)
+        missed = []
+        for connection, connection_builds in queued.items():
+            self.log.debug("Looking for %s builds in queue on %s" %
+                           (len(connection_builds), connection))
+            missed.extend(self.cancelJobsInQueue(connection,
+                                                 connection_builds))
 
-        self.log.debug("Still unable to find build %s to cancel" % build)
-        if build.number:
-            self.log.debug("Build %s has just started" % build)
-            self.log.debug("Canceled running build %s" % build)
-            self.cancelRunningBuild(build)
-            return
-        self.log.debug("Unable to cancel build %s" % build)
+        if missed:
+            time.sleep(1)
+
+        for build in missed:
+            self.log.debug("Still unable to find build %s to cancel" % build)
+            if build.number:
+                self.log.debug("Build %s has just started" % build)
+                running.append(build)
+            else:
+                self.log.debug("Unable to cancel build %s" % build)
+                self.sched.onBuildCanceled(build, 'NOT_FOUND')
+
+        if running:
+            stopped = self.cancelRunningBuilds(running)
+            for build in running:
+                if build in stopped:
+                    self.log.debug("Canceled running build %s" % build)
+                    self.sched.onBuildCanceled(build, 'STOPPED')
+                else:
+                    self.log.debug("Unable to stop build %s" % build)
+                    self.sched.onBuildCanceled(build, 'NOT_FOUND')
 
     def onBuildCompleted(self, job, result=None):
         if job.unique in self.meta_jobs:
@@ -450,6 +841,9 @@ class Gearman(object):
                 self.log.info("Build %s complete, result %s" %
                               (job, result))
                 self.sched.onBuildCompleted(build, result)
+            else:
+                self.log.info("Canceled build %s complete" % (job,))
+                self.sched.onBuildCanceled(build, 'COMPLETED')
             # The test suite expects the build to be removed from the
             # internal dict after it's added to the report queue.
             del self.builds[job.unique]
@@ -466,6 +860,8 @@ class Gearman(object):
             build.url = data.get('url') or build.url
             # Update information about worker
             build.worker.updateFromData(data)
+            if build.build_set:
+                build.build_set.item.invalidateStatus()
 
             if build.number is None:
                 self.log.info("Build %s started" % job)
@@ -483,32 +879,57 @@ class Gearman(object):
         self.log.info("Gearman job %s lost due to unknown handle" % job)
         self.onBuildCompleted(job, 'LOST')
 
-    def cancelJobInQueue(self, build):
-        job = build.__gearman_job
-
-        req = gear.CancelJobAdminRequest(job.handle)
-        job.connection.sendAdminRequest(req, timeout=300)
-        self.log.debug("Response to cancel build %s request: %s" %
-                       (build, req.response.strip()))
-        if req.response.startswith("OK"):
-            try:
-                del self.builds[job.unique]
-            except:
-                pass
-            return True
-        return False
+    def cancelJobsInQueue(self, connection, builds):
+        """Remove builds from a connection's queue.
 
-    def cancelRunningBuild(self, build):
-        stop_uuid = str(uuid4().hex)
-        data = dict(name=build.job.name,
-                    number=build.number)
-        stop_job = gear.Job("stop:%s" % build.__gearman_manager,
-                            json.dumps(data), unique=stop_uuid)
-        self.meta_jobs[stop_uuid] = stop_job
-        self.log.debug("Submitting stop job: %s", stop_job)
-        self.gearman.submitJob(stop_job, precedence=gear.PRECEDENCE_HIGH,
-                               timeout=300)
-        return True
+        Returns the builds which were not found in the queue.
+        """
+        reqs = [gear.CancelJobAdminRequest(build.__gearman_job.handle)
+                for build in builds]
+        try:
+            self.gearman.sendAdminRequests(connection, reqs, timeout=300)
+        except Exception:
+            self.log.exception("Exception while canceling builds in queue")
+        missed = []
+        for build, req in zip(builds, reqs):
+            response = req.response or ''
+            self.log.debug("Response to cancel build %s request: %s" %
+                           (build, response.strip()))
+            if response.startswith("OK"):
+                self.log.debug("Removed build %s from queue" % build)
+                try:
+                    del self.builds[build.__gearman_job.unique]
+                except:
+                    pass
+                self.sched.onBuildCanceled(build, 'DEQUEUED')
+            else:
+                missed.append(build)
+        return missed
+
+    def cancelRunningBuilds(self, builds):
+        """Submit stop jobs for running builds.
+
+        Returns the builds for which a stop job was submitted.
+        """
+        stop_jobs = []
+        for build in builds:
+            stop_uuid = str(uuid4().hex)
+            data = dict(name=build.job.name,
+                        number=build.number)
+            stop_job = gear.Job("stop:%s" % build.__gearman_manager,
+                                json.dumps(data), unique=stop_uuid)
+            self.meta_jobs[stop_uuid] = stop_job
+            self.log.debug("Submitting stop job: %s", stop_job)
+            stop_jobs.append(stop_job)
+        self.gearman.submitJobs(stop_jobs, precedence=gear.PRECEDENCE_HIGH,
+                                timeout=300)
+        stopped = []
+        for build, stop_job in zip(builds, stop_jobs):
+            if not stop_job.handle:
+                self.meta_jobs.pop(stop_job.unique, None)
+            else:
+                stopped.append(build)
+        return stopped
 
     def setBuildDescription(self, build, desc):
         try:
@@ -533,8 +954,17 @@ class Gearman(object):
         return True
 
     def lookForLostBuilds(self):
+        """Mark builds which gearman no longer knows about as lost.
+
+        The status of every build is requested before waiting for
+        any of the responses, and the builds whose jobs are unknown
+        are marked lost when the responses are in.  Builds with no
+        response are left for the next pass.
+        """
         self.log.debug("Looking for lost builds")
-        for build in self.builds.values():
+        handles = {}
+        connections = {}
+        for build in list(self.builds.values()):
             if build.result:
                 # The build has finished, it will be removed
                 continue
@@ -542,6 +972,55 @@ class Gearman(object):
             if not job.handle:
                 # The build hasn't been enqueued yet
                 continue
-            p = gear.Packet(gear.constants.REQ, gear.constants.GET_STATUS,
-                            job.handle)
-            job.connection.sendPacket(p)
+            if not job.connection:
+                # The connection was lost, and the build with it
+                continue
+            handles[job.handle] = build
+            connections.setdefault(job.connection, []).append(job.handle)
+        if not handles:
+            return
+        with self.status_lock:
+            self.status_pending = set(handles)
+            self.status_unknown = set()
+            self.status_event.clear()
+        for connection, connection_handles in connections.items():
+            try:
+                for handle in connection_handles:
+                    req = gear.Packet(gear.constants.REQ,
+                                      gear.constants.GET_STATUS, handle)
+                    self.gearman.sendPacket(req, connection)
+            except Exception:
+                # The client has marked the connection lost, and its
+                # builds with it, so there are no responses to wait for.
+                self.log.exception("Exception requesting status of builds "
+                                   "from %s" % (connection,))
+                with self.status_lock:
+                    self.status_pending.difference_update(connection_handles)
+                    if not self.status_pending:
+                        self.status_event.set()
+        if not self.status_event.wait(self.lost_build_timeout):
+            self.log.debug("No status received for %s builds" %
+                           len(self.status_pending))
+        with self.status_lock:
+            unknown = self.status_unknown
+            self.status_pending = set()
+            self.status_unknown = set()
+        lost = 0
+        for handle in unknown:
+            build = handles[handle]
+            if build.result or build.uuid not in self.builds:
+                # It completed while we were looking
+                continue
+            self.onUnknownJob(build.__gearman_job)
+            lost += 1
+        self.log.debug("Found %s lost builds of %s" % (lost, len(handles)))
+
+    def onStatusResponse(self, handle, known):
+        with self.status_lock:
+            if handle not in self.status_pending:
+                return
+            self.status_pending.discard(handle)
+            if not known:
+                self.status_unknown.add(handle)
+            if not self.status_pending:
+                self.status_event.set()
@@ -12,14 +12,27 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import extras
+import hashlib
 import json
 import logging
+import threading
 from uuid import uuid4
 
 import gear
 
 import zuul.model
 
+statsd = extras.try_import('statsd.statsd')
+
+# A request may join an outstanding job only if that job's precedence
+# is at least as high as its own.
+PRECEDENCE_RANK = {
+    zuul.model.PRECEDENCE_LOW: 0,
+    zuul.model.PRECEDENCE_NORMAL: 1,
+    zuul.model.PRECEDENCE_HIGH: 2,
+}
+
 
 def getJobData(job):
     if not len(job.data):
@@ -35,6 +48,16 @@ class MergeGearmanClient(gear.Client):
         super(MergeGearmanClient, self).__init__()
         self.__merge_client = merge_client
 
+    def handleWorkStatus(self, packet):
+        job = super(MergeGearmanClient, self).handleWorkStatus(packet)
+        self.__merge_client.onMergeStarted(job)
+        return job
+
+    def handleWorkData(self, packet):
+        job = super(MergeGearmanClient, self).handleWorkData(packet)
+        self.__merge_client.onMergeData(job)
+        return job
+
     def handleWorkComplete(self, packet):
         job = super(MergeGearmanClient, self).handleWorkComplete(packet)
         self.__merge_client.onBuildCompleted(job)
@@ -71,7 +94,24 @@ class MergeClient(object):
         self.gearman.addServer(server, port)
         self.log.debug("Waiting for gearman")
         self.gearman.waitForServer()
+        # Merge and update jobs may be routed by project to the
+        # mergers which serve that project's shard.
+        if self.config.has_option('merger', 'shard_count'):
+            self.shard_count = self.config.getint('merger', 'shard_count')
+        else:
+            self.shard_count = 0
         self.build_sets = {}
+        # Identical requests share a single job until the merger starts
+        # it.  These map the hash of a queued job's request to its
+        # uuid, and a job's uuid to its precedence, to the zuul refs of
+        # its items and to the build sets which are waiting for it
+        # besides its own, with the zuul refs of their items.
+        self.outstanding = {}
+        self.precedences = {}
+        self.item_refs = {}
+        self.followers = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
 
     def stop(self):
         self.gearman.shutdown()
@@ -81,27 +121,112 @@ class MergeClient(object):
             return True
         return False
 
+    def getShard(self, project):
+        # Python's own hash of a string differs between processes, so
+        # use one which every scheduler will agree on.
+        digest = hashlib.sha1(project.encode('utf8')).hexdigest()
+        return int(digest, 16) % self.shard_count
+
+    def getFunctionName(self, name, project):
+        if not self.shard_count:
+            return name
+        return '%s:%d' % (name, self.getShard(project))
+
+    def getRequestKey(self, name, data):
+        # The zuul ref names differ between build sets, but do not
+        # change what the merger does, so leave them out.
+        if 'items' in data:
+            data = dict(data)
+            data['items'] = [dict((k, v) for k, v in item.items()
+                                  if k != 'ref')
+                             for item in data['items']]
+        request = json.dumps([name, data], sort_keys=True)
+        return hashlib.sha1(request.encode('utf8')).hexdigest()
+
     def submitJob(self, name, data, build_set,
                   precedence=zuul.model.PRECEDENCE_NORMAL):
-        uuid = str(uuid4().hex)
-        job = gear.Job(name,
-                       json.dumps(data),
-                       unique=uuid)
-        self.log.debug("Submitting job %s with data %s" % (job, data))
-        self.build_sets[uuid] = build_set
+        key = self.getRequestKey(name, data)
+        item_refs = [item['ref'] for item in data.get('items', [])]
+        with self.lock:
+            uuid = self.outstanding.get(key)
+            if (uuid and PRECEDENCE_RANK[self.precedences[uuid]] >=
+                PRECEDENCE_RANK[precedence]):
+                self.log.debug("Adding build set %s to identical job %s" %
+                               (build_set, uuid))
+                self.followers[uuid].append((build_set, item_refs))
+                self.coalesced += 1
+                if statsd:
+                    statsd.incr('zuul.merge_client.coalesced')
+                return
+            uuid = str(uuid4().hex)
+            job = gear.Job(name,
+                           json.dumps(data),
+                           unique=uuid)
+            self.log.debug("Submitting job %s with data %s" % (job, data))
+            self.build_sets[uuid] = build_set
+            self.outstanding[key] = uuid
+            self.precedences[uuid] = precedence
+            self.item_refs[uuid] = item_refs
+            self.followers[uuid] = []
         self.gearman.submitJob(job, precedence=precedence,
                                timeout=300)
 
     def mergeChanges(self, items, build_set,
                      precedence=zuul.model.PRECEDENCE_NORMAL):
+        items = list(items)
         data = dict(items=items)
-        self.submitJob('merger:merge', data, build_set, precedence)
+        # Route the job by the project of the item being merged, whose
+        # repo is the one most certain to be used.
+        name = self.getFunctionName('merger:merge', items[-1]['project'])
+        self.submitJob(name, data, build_set, precedence)
 
     def updateRepo(self, project, url, build_set,
-                   precedence=zuul.model.PRECEDENCE_NORMAL):
+                   precedence=zuul.model.PRECEDENCE_NORMAL,
+                   connection_name='default'):
         data = dict(project=project,
-                    url=url)
-        self.submitJob('merger:update', data, build_set, precedence)
+                    url=url,
+                    connection_name=connection_name)
+        name = self.getFunctionName('merger:update', project)
+        self.submitJob(name, data, build_set, precedence)
+
+    def _removeOutstanding(self, uuid):
+        # Must be called with the lock held
+        for key, outstanding_uuid in list(self.outstanding.items()):
+            if outstanding_uuid == uuid:
+                del self.outstanding[key]
+
+    def onMergeStarted(self, job):
+        # Once the merger has started, a later request may need a
+        # result which this job would not give (for instance, the
+        # repo may have been updated since it fetched), so it is not
+        # shared with any more requests.
+        with self.lock:
+            self._removeOutstanding(job.unique)
+
+    def onMergeData(self, job):
+        # The merger reports the commit for each item ahead of the
+        # last as soon as it has been merged.
+        data = getJobData(job)
+        ref = data.get('ref')
+        if not ref:
+            return
+        with self.lock:
+            build_set = self.build_sets.get(job.unique)
+            item_refs = self.item_refs.get(job.unique, [])
+            followers = list(self.followers.get(job.unique, []))
+        if not build_set or ref not in item_refs:
+            return
+        self.log.debug("Merge %s merged ref %s, commit: %s" %
+                       (job, ref, data.get('commit')))
+        self.sched.onItemMerged(build_set, ref, data.get('zuul_url'),
+                                data.get('commit'))
+        # The build sets which joined this job know the item by their
+        # own zuul ref, but the merger created the one of this job.
+        index = item_refs.index(ref)
+        for waiting_build_set, waiting_refs in followers:
+            self.sched.onItemMerged(waiting_build_set, waiting_refs[index],
+                                    data.get('zuul_url'),
+                                    data.get('commit'), zuul_ref=ref)
 
     def onBuildCompleted(self, job):
         build_set = self.build_sets.get(job.unique)
@@ -114,8 +239,22 @@ class MergeClient(object):
             self.log.info("Merge %s complete, merged: %s, updated: %s, "
                           "commit: %s" %
                           (job, merged, updated, build_set.commit))
+            with self.lock:
+                self._removeOutstanding(job.unique)
+                self.precedences.pop(job.unique, None)
+                item_refs = self.item_refs.pop(job.unique, [])
+                followers = self.followers.pop(job.unique, [])
             self.sched.onMergeCompleted(build_set, zuul_url,
                                         merged, updated, commit)
+            # The merger created zuul refs named after this job's
+            # items, not those of the build sets which joined it.  They
+            # asked for an identical merge, so the ref of this job's
+            # last item points at the commit they need.
+            zuul_ref = item_refs[-1] if item_refs else None
+            for waiting_build_set, waiting_refs in followers:
+                self.sched.onMergeCompleted(waiting_build_set, zuul_url,
+                                            merged, updated, commit,
+                                            zuul_ref=zuul_ref)
             # The test suite expects the build_set to be removed from
             # the internal dict after the wake flag is set.
             del self.build_sets[job.unique]
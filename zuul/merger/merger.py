@@ -13,12 +13,22 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import extras
 import git
 import os
 import logging
+import shutil
+import tempfile
+import threading
+import time
+
+from six.moves import queue as Queue
 
 import zuul.model
 
+statsd = extras.try_import('statsd.statsd')
+
 
 def reset_repo_to_head(repo):
     # This lets us reset the repo even if there is a file in the root
@@ -43,11 +53,16 @@ class ZuulReference(git.Reference):
 class Repo(object):
     log = logging.getLogger("zuul.Repo")
 
-    def __init__(self, remote, local, email, username):
+    def __init__(self, remote, local, email, username, stats_prefix=None,
+                 mirror=None):
         self.remote_url = remote
         self.local_path = local
         self.email = email
         self.username = username
+        self.stats_prefix = stats_prefix
+        # A bare repo, possibly shared with other mergers, from which
+        # this repo borrows objects using git alternates
+        self.mirror = mirror
         self._initialized = False
         try:
             self._ensure_cloned()
@@ -62,7 +77,11 @@ class Repo(object):
         if not repo_is_cloned:
             self.log.debug("Cloning from %s to %s" % (self.remote_url,
                                                       self.local_path))
-            git.Repo.clone_from(self.remote_url, self.local_path)
+            if self.mirror and self._ensureMirror():
+                git.Repo.clone_from(self.remote_url, self.local_path,
+                                    reference=self.mirror)
+            else:
+                git.Repo.clone_from(self.remote_url, self.local_path)
         repo = git.Repo(self.local_path)
         if self.email:
             repo.config_writer().set_value('user', 'email',
@@ -73,6 +92,52 @@ class Repo(object):
         repo.config_writer().write()
         self._initialized = True
 
+    def _ensureMirror(self):
+        if os.path.exists(self.mirror):
+            return True
+        parent = os.path.dirname(self.mirror)
+        try:
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            # Clone next to the mirror and move it into place, since
+            # another merger may be creating the same mirror.
+            tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+            try:
+                self.log.debug("Creating mirror of %s in %s" %
+                               (self.remote_url, self.mirror))
+                mirror = git.Repo.clone_from(self.remote_url, tmp, bare=True)
+                # Repos using the mirror may need objects which are no
+                # longer reachable from it.
+                mirror.git.config('gc.pruneExpire', 'never')
+                os.rename(tmp, self.mirror)
+            finally:
+                if os.path.exists(tmp):
+                    shutil.rmtree(tmp)
+        except Exception:
+            if os.path.exists(self.mirror):
+                return True
+            self.log.exception("Unable to create mirror %s" % self.mirror)
+            return False
+        return True
+
+    def updateMirror(self):
+        """Fetch branches and tags from the remote into the mirror."""
+        if not (self.mirror and os.path.exists(self.mirror)):
+            return
+        self.log.debug("Updating mirror %s" % self.mirror)
+        try:
+            git.Repo(self.mirror).git.fetch(
+                self.remote_url, '+refs/heads/*:refs/heads/*',
+                '+refs/tags/*:refs/tags/*')
+        except git.GitCommandError:
+            # Another merger may be updating it at the same time
+            self.log.debug("Unable to update mirror %s" % self.mirror,
+                           exc_info=True)
+
+    def _incr(self, stat, count=1):
+        if statsd and self.stats_prefix and count:
+            statsd.incr('%s.%s' % (self.stats_prefix, stat), count)
+
     def isInitialized(self):
         return self._initialized
 
@@ -129,6 +194,14 @@ class Repo(object):
         ref = repo.refs[refname]
         return ref.commit
 
+    def getCommit(self, sha):
+        repo = self.createRepoObject()
+        try:
+            return repo.commit(sha)
+        except Exception:
+            # The commit may have been garbage collected
+            return None
+
     def checkout(self, ref):
         repo = self.createRepoObject()
         self.log.debug("Checking out %s" % ref)
@@ -154,6 +227,41 @@ class Repo(object):
         repo.git.merge(*args)
         return repo.head.commit
 
+    def _isAncestor(self, repo, ancestor, commit):
+        try:
+            repo.git.merge_base('--is-ancestor', ancestor, commit)
+        except git.GitCommandError as e:
+            if e.status == 1:
+                return False
+            raise
+        return True
+
+    def mergeTree(self, base, ref):
+        """Merge ref into base without using the working tree.
+
+        The merge is computed by git merge-tree (git 2.38 or later)
+        and committed with git commit-tree, so neither the index nor
+        the working tree are touched.  As with git merge, a fast
+        forward is made if possible.
+        """
+        repo = self.createRepoObject()
+        self.fetch(ref)
+        base = str(base)
+        theirs = repo.git.rev_parse('FETCH_HEAD')
+        self.log.debug("Merging %s onto %s without checkout" % (ref, base))
+        if self._isAncestor(repo, theirs, base):
+            return repo.commit(base)
+        if self._isAncestor(repo, base, theirs):
+            return repo.commit(theirs)
+        # This fails with status 1 if there are conflicts
+        tree = repo.git.merge_tree('--write-tree', base, theirs)
+        tree = tree.splitlines()[0]
+        message = "Merge commit '%s' of %s into HEAD" % (ref,
+                                                         self.remote_url)
+        sha = repo.git.commit_tree(tree, '-p', base, '-p', theirs,
+                                   '-m', message)
+        return repo.commit(sha)
+
     def fetch(self, ref):
         repo = self.createRepoObject()
         # The git.remote.fetch method may read in git progress info and
@@ -173,18 +281,119 @@ class Repo(object):
     def createZuulRef(self, ref, commit='HEAD'):
         repo = self.createRepoObject()
         self.log.debug("CreateZuulRef %s at %s on %s" % (ref, commit, repo))
-        ref = ZuulReference.create(repo, ref, commit)
+        # The reflog entry records when the ref was created, which
+        # pruneZuulRefs uses to tell whether it may still be in use.
+        ref = ZuulReference.create(repo, ref, commit,
+                                   logmsg='zuul: created')
         return ref.commit
 
+    def _getRefCreated(self, repo, refname):
+        path = os.path.join(repo.git_dir, 'logs', refname)
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except IOError:
+            return None
+        if not lines:
+            return None
+        # <old> <new> <name> <email> <timestamp> <tz>\t<message>
+        try:
+            return int(lines[-1].split('\t')[0].split()[-2])
+        except (IndexError, ValueError):
+            return None
+
+    def pruneZuulRefs(self, max_age):
+        """Delete zuul refs created more than max_age seconds ago.
+
+        Refs created before their creation time was recorded are aged
+        by the date of the commit they point to instead.
+        """
+        repo = self.createRepoObject()
+        now = time.time()
+        old = []
+        for line in repo.git.for_each_ref(
+                '--format=%(refname) %(committerdate:raw)',
+                'refs/zuul').splitlines():
+            refname, committed = line.split(' ')[:2]
+            created = self._getRefCreated(repo, refname)
+            if created is None:
+                created = int(committed)
+            if now - created >= max_age:
+                old.append(refname)
+        if not old:
+            return 0
+        self.log.debug("Pruning %s zuul refs from %s" %
+                       (len(old), self.local_path))
+        # Delete them all in one transaction rather than rewriting
+        # packed-refs once for each one.
+        with tempfile.TemporaryFile() as f:
+            for refname in old:
+                f.write(('delete %s\n' % refname).encode('utf8'))
+            f.seek(0)
+            repo.git.update_ref('--stdin', istream=f)
+        self._incr('zuul_refs.pruned', len(old))
+        return len(old)
+
+    def gc(self):
+        """Pack refs, and repack objects if git thinks it necessary."""
+        repo = self.createRepoObject()
+        self.log.debug("Packing refs and collecting garbage in %s" %
+                       self.local_path)
+        repo.git.pack_refs('--all')
+        repo.git.gc('--auto', '--quiet')
+
     def push(self, local, remote):
         repo = self.createRepoObject()
         self.log.debug("Pushing %s:%s to %s" % (local, remote,
                                                 self.remote_url))
         repo.remotes.origin.push('%s:%s' % (local, remote))
 
+    def isUpToDate(self):
+        """Return whether a fetch would not change any branch or tag.
+
+        This compares the branches and tags advertised by the remote
+        with the local ones, which is much cheaper than a fetch.
+        """
+        repo = self.createRepoObject()
+        try:
+            remote = repo.git.ls_remote('--heads', '--tags', 'origin')
+        except git.GitCommandError:
+            self.log.debug("Unable to list refs for %s" % self.remote_url,
+                           exc_info=True)
+            return False
+        local = {}
+        for line in repo.git.for_each_ref(
+                '--format=%(objectname) %(refname)',
+                'refs/remotes/origin', 'refs/tags').splitlines():
+            sha, name = line.split(' ', 1)
+            local[name] = sha
+        for line in remote.splitlines():
+            sha, name = line.split(None, 1)
+            if name.endswith('^{}'):
+                # The commit an annotated tag points to
+                continue
+            if name.startswith('refs/heads/'):
+                name = 'refs/remotes/origin/' + name[len('refs/heads/'):]
+            if local.get(name) != sha:
+                return False
+        return True
+
     def update(self):
+        """Fetch branches and tags from the remote if they have changed.
+
+        Returns whether a fetch was performed.
+        """
+        if self.isUpToDate():
+            self.log.debug("Repository %s is up to date" % self.local_path)
+            self._incr('fetches.skipped')
+            return False
+        # Fetching into the mirror first leaves little or nothing for
+        # this repo to fetch, and the objects are shared with any other
+        # repos using the mirror.
+        self.updateMirror()
         repo = self.createRepoObject()
         self.log.debug("Updating repository %s" % self.local_path)
+        self._incr('fetches.performed')
         origin = repo.remotes.origin
         if repo.git.version_info[:2] < (1, 9):
             # Before 1.9, 'git fetch --tags' did not include the
@@ -194,12 +403,17 @@ class Repo(object):
             # https://github.com/git/git/blob/master/Documentation/RelNotes/1.9.0.txt#L18-L20
             origin.fetch()
         origin.fetch(tags=True)
+        return True
 
 
 class Merger(object):
     log = logging.getLogger("zuul.Merger")
+    # The number of merge results to remember
+    merge_cache_size = 1000
 
-    def __init__(self, working_root, connections, email, username):
+    def __init__(self, working_root, connections, email, username,
+                 prepare_workers=1, tree_merges=False, stats_prefix=None,
+                 mirror_root=None):
         self.repos = {}
         self.working_root = working_root
         if not os.path.exists(working_root):
@@ -207,6 +421,40 @@ class Merger(object):
         self._makeSSHWrappers(working_root, connections)
         self.email = email
         self.username = username
+        self.stats_prefix = stats_prefix
+        self.mirror_root = mirror_root
+        # The number of repos which may be prepared for a merge at
+        # once.  With one, repos are prepared as they are reached.
+        self.prepare_workers = prepare_workers
+        if tree_merges and git.Git().version_info[:2] < (2, 38):
+            self.log.warning("Merging without a checkout requires git "
+                             "2.38 or later; using git merge instead")
+            tree_merges = False
+        self.tree_merges = tree_merges
+        self.lock = threading.Lock()
+        self.repo_locks = {}
+        # GIT_SSH is set for the whole process, so merges for
+        # different connections can not run at the same time.
+        self.ssh_condition = threading.Condition()
+        self.ssh_connection = None
+        self.ssh_users = 0
+        # (project, base commit, refspec, merge mode) -> merged commit.
+        # Since the base commit is the result of merging any changes
+        # ahead of this one, this identifies the whole series of
+        # merges, so repeating them (e.g. after a gate reset) gives
+        # the same commit without running git again.
+        self.merge_cache = collections.OrderedDict()
+
+    def getRepoLocks(self, projects):
+        """Return the locks for the repos of the given projects.
+
+        The locks are returned in the order in which they must be
+        acquired, so that jobs which lock several repos can not
+        deadlock.  A job must hold the lock for every repo it uses.
+        """
+        with self.lock:
+            return [self.repo_locks.setdefault(project, threading.Lock())
+                    for project in sorted(set(projects))]
 
     def _makeSSHWrappers(self, working_root, connections):
         for connection_name, connection in connections.items():
@@ -227,7 +475,12 @@ class Merger(object):
         repo = None
         try:
             path = os.path.join(self.working_root, project)
-            repo = Repo(url, path, self.email, self.username)
+            if self.mirror_root:
+                mirror = os.path.join(self.mirror_root, project)
+            else:
+                mirror = None
+            repo = Repo(url, path, self.email, self.username,
+                        self.stats_prefix, mirror)
 
             self.repos[project] = repo
         except Exception:
@@ -242,25 +495,70 @@ class Merger(object):
                             " without a url" % (project,))
         return self.addProject(project, url)
 
-    def updateRepo(self, project, url):
-        repo = self.getRepo(project, url)
+    def maintainRepo(self, project, zuul_ref_max_age):
+        repo = self.repos[project]
         try:
-            self.log.info("Updating local repository %s", project)
-            repo.update()
+            repo.pruneZuulRefs(zuul_ref_max_age)
+            repo.gc()
         except Exception:
-            self.log.exception("Unable to update %s", project)
+            self.log.exception("Unable to maintain %s", project)
+
+    def updateRepo(self, project, url, connection_name='default'):
+        self._acquireGitSsh(connection_name)
+        try:
+            repo = self.getRepo(project, url)
+            try:
+                self.log.info("Updating local repository %s", project)
+                repo.update()
+            except Exception:
+                self.log.exception("Unable to update %s", project)
+        finally:
+            self._releaseGitSsh()
+
+    def _getCachedMerge(self, repo, key):
+        with self.lock:
+            sha = self.merge_cache.pop(key, None)
+            if sha is None:
+                return None
+            self.merge_cache[key] = sha
+        commit = repo.getCommit(sha)
+        if commit is None:
+            with self.lock:
+                self.merge_cache.pop(key, None)
+        return commit
+
+    def _cacheMerge(self, key, commit):
+        with self.lock:
+            self.merge_cache.pop(key, None)
+            self.merge_cache[key] = commit.hexsha
+            while len(self.merge_cache) > self.merge_cache_size:
+                self.merge_cache.popitem(last=False)
 
     def _mergeChange(self, item, ref):
         repo = self.getRepo(item['project'], item['url'])
-        try:
-            repo.checkout(ref)
-        except Exception:
-            self.log.exception("Unable to checkout %s" % ref)
-            return None
+        key = (item['project'], ref.hexsha, item['refspec'],
+               item['merge_mode'])
+        commit = self._getCachedMerge(repo, key)
+        if commit:
+            self.log.debug("Found merged commit %s for %s onto %s" %
+                           (commit, item['refspec'], ref))
+            return commit
+
+        mode = item['merge_mode']
+        tree_merge = (self.tree_merges and
+                      mode in (zuul.model.MERGER_MERGE,
+                               zuul.model.MERGER_MERGE_RESOLVE))
+        if not tree_merge:
+            try:
+                repo.checkout(ref)
+            except Exception:
+                self.log.exception("Unable to checkout %s" % ref)
+                return None
 
         try:
-            mode = item['merge_mode']
-            if mode == zuul.model.MERGER_MERGE:
+            if tree_merge:
+                commit = repo.mergeTree(ref, item['refspec'])
+            elif mode == zuul.model.MERGER_MERGE:
                 commit = repo.merge(item['refspec'])
             elif mode == zuul.model.MERGER_MERGE_RESOLVE:
                 commit = repo.merge(item['refspec'], 'resolve')
@@ -277,8 +575,24 @@ class Merger(object):
             self.log.exception("Exception while merging a change:")
             return None
 
+        self._cacheMerge(key, commit)
         return commit
 
+    def _acquireGitSsh(self, connection_name):
+        with self.ssh_condition:
+            while (self.ssh_users and
+                   self.ssh_connection != connection_name):
+                self.ssh_condition.wait()
+            if not self.ssh_users:
+                self._setGitSsh(connection_name)
+                self.ssh_connection = connection_name
+            self.ssh_users += 1
+
+    def _releaseGitSsh(self):
+        with self.ssh_condition:
+            self.ssh_users -= 1
+            self.ssh_condition.notify_all()
+
     def _setGitSsh(self, connection_name):
         wrapper_name = '.ssh_wrapper_%s' % connection_name
         name = os.path.join(self.working_root, wrapper_name)
@@ -287,11 +601,69 @@ class Merger(object):
         elif 'GIT_SSH' in os.environ:
             del os.environ['GIT_SSH']
 
-    def _mergeItem(self, item, recent):
+    def _prepareRepo(self, project, items):
+        # Clone the repo if needed, and reset it if any of its
+        # project-branches do not already have a zuul ref to start
+        # from.  This is the same work _mergeItem would otherwise do
+        # on reaching the first item for each project-branch.
+        repo = self.getRepo(project, items[0]['url'])
+        for item in items:
+            zuul_ref = item['branch'] + '/' + item['ref']
+            if not repo.getCommitFromRef(zuul_ref):
+                break
+        else:
+            return False
+        self.log.debug("Preparing repo for %s" % (project,))
+        repo.reset()
+        return True
+
+    def _prepareRepos(self, items):
+        """Prepare the repos used by a list of items concurrently.
+
+        Returns the set of projects whose repos were reset.
+        """
+        # The first item for each project-branch, grouped by project
+        projects = collections.OrderedDict()
+        seen = set()
+        for item in items:
+            key = (item['project'], item['branch'])
+            if key in seen:
+                continue
+            seen.add(key)
+            projects.setdefault(item['project'], []).append(item)
+
+        prepared = set()
+
+        def worker(queue):
+            while True:
+                try:
+                    project, project_items = queue.get(block=False)
+                except Queue.Empty:
+                    return
+                try:
+                    if self._prepareRepo(project, project_items):
+                        prepared.add(project)
+                except Exception:
+                    self.log.exception("Unable to prepare repo for %s" %
+                                       (project,))
+
+        queue = Queue.Queue()
+        for project, project_items in projects.items():
+            queue.put((project, project_items))
+        threads = []
+        for x in range(min(self.prepare_workers, len(projects))):
+            thread = threading.Thread(target=worker, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return prepared
+
+    def _mergeItem(self, item, recent, prepared=frozenset()):
         self.log.debug("Processing refspec %s for project %s / %s ref %s" %
                        (item['refspec'], item['project'], item['branch'],
                         item['ref']))
-        self._setGitSsh(item['connection_name'])
         repo = self.getRepo(item['project'], item['url'])
         key = (item['project'], item['branch'])
         # See if we have a commit for this change already in this repo
@@ -311,11 +683,12 @@ class Merger(object):
             # There is none, so use the branch tip
             # we need to reset here in order to call getBranchHead
             self.log.debug("No base commit found for %s" % (key,))
-            try:
-                repo.reset()
-            except Exception:
-                self.log.exception("Unable to reset repo %s" % repo)
-                return None
+            if item['project'] not in prepared:
+                try:
+                    repo.reset()
+                except Exception:
+                    self.log.exception("Unable to reset repo %s" % repo)
+                    return None
             base = repo.getBranchHead(item['branch'])
         else:
             self.log.debug("Found base commit %s for %s" % (base, key,))
@@ -339,9 +712,33 @@ class Merger(object):
                 return None
         return commit
 
-    def mergeChanges(self, items):
+    def mergeChanges(self, items, callback=None):
+        """Merge a series of items and return the commit of the last.
+
+        If callback is given, it is called with each item before the
+        last and the hexsha of its commit as soon as the item has been
+        merged, so that the commits for the items ahead may be used
+        before the whole series is done.
+        """
+        # The items of a merge job all come from the same pipeline,
+        # and so the same connection.
+        self._acquireGitSsh(items[0]['connection_name'])
+        try:
+            return self._mergeChanges(items, callback)
+        finally:
+            self._releaseGitSsh()
+
+    def _mergeChanges(self, items, callback=None):
         recent = {}
         commit = None
+        if self.prepare_workers > 1:
+            # Fetching and resetting the repos is most of the work, and
+            # can be done for each repo independently.  The merges
+            # themselves are then made in order, since each builds on
+            # the previous ones for its project-branch.
+            prepared = self._prepareRepos(items)
+        else:
+            prepared = set()
         for item in items:
             if item.get("number") and item.get("patchset"):
                 self.log.debug("Merging for change %s,%s." %
@@ -349,7 +746,13 @@ class Merger(object):
             elif item.get("newrev") and item.get("oldrev"):
                 self.log.debug("Merging for rev %s with oldrev %s." %
                                (item["newrev"], item["oldrev"]))
-            commit = self._mergeItem(item, recent)
+            commit = self._mergeItem(item, recent, prepared)
             if not commit:
                 return None
+            if callback and item is not items[-1]:
+                try:
+                    callback(item, commit.hexsha)
+                except Exception:
+                    self.log.exception("Exception reporting merge of %s" %
+                                       (item,))
         return commit.hexsha
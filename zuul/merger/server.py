@@ -12,8 +12,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import extras
 import json
 import logging
+import socket
 import threading
 import traceback
 
@@ -21,6 +23,8 @@ import gear
 
 from zuul.merger import merger
 
+statsd = extras.try_import('statsd.statsd')
+
 
 class MergeServer(object):
     log = logging.getLogger("zuul.MergeServer")
@@ -34,6 +38,11 @@ class MergeServer(object):
         else:
             merge_root = '/var/lib/zuul/git'
 
+        if self.config.has_option('merger', 'git_mirror_dir'):
+            mirror_root = self.config.get('merger', 'git_mirror_dir')
+        else:
+            mirror_root = None
+
         if self.config.has_option('merger', 'git_user_email'):
             merge_email = self.config.get('merger', 'git_user_email')
         else:
@@ -44,8 +53,61 @@ class MergeServer(object):
         else:
             merge_name = None
 
+        if self.config.has_option('merger', 'prepare_workers'):
+            prepare_workers = self.config.getint('merger', 'prepare_workers')
+        else:
+            prepare_workers = 4
+
+        if self.config.has_option('merger', 'tree_merges'):
+            tree_merges = self.config.getboolean('merger', 'tree_merges')
+        else:
+            tree_merges = False
+
+        self.stats_prefix = 'zuul.merger.%s' % (
+            socket.gethostname().replace('.', '_'),)
+
         self.merger = merger.Merger(merge_root, connections, merge_email,
-                                    merge_name)
+                                    merge_name, prepare_workers,
+                                    tree_merges, self.stats_prefix,
+                                    mirror_root)
+
+        if self.config.has_option('merger', 'slots'):
+            self.slots = self.config.getint('merger', 'slots')
+        else:
+            self.slots = 1
+        self.slot_semaphore = threading.Semaphore(self.slots)
+        self.slot_lock = threading.Lock()
+        # Jobs which are running, and jobs which are waiting for the
+        # repos they use to be free
+        self.active_slots = 0
+        self.queued_slots = 0
+
+        # Seconds between pruning and garbage collecting the repos, or 0
+        # to leave that to the operator.
+        if self.config.has_option('merger', 'maintenance_interval'):
+            self.maintenance_interval = self.config.getint(
+                'merger', 'maintenance_interval')
+        else:
+            self.maintenance_interval = 3600
+        if self.config.has_option('merger', 'zuul_ref_max_age'):
+            self.zuul_ref_max_age = self.config.getint(
+                'merger', 'zuul_ref_max_age')
+        else:
+            self.zuul_ref_max_age = 7 * 24 * 60 * 60
+        self.maintenance_event = threading.Event()
+        self.maintenance_thread = None
+
+        # With shards, the scheduler routes each project's jobs to
+        # the mergers which serve its shard.
+        if self.config.has_option('merger', 'shard_count'):
+            self.shard_count = self.config.getint('merger', 'shard_count')
+        else:
+            self.shard_count = 0
+        if self.config.has_option('merger', 'shards'):
+            self.shards = [int(x) for x in
+                           self.config.get('merger', 'shards').split(',')]
+        else:
+            self.shards = list(range(self.shard_count))
 
     def start(self):
         self._running = True
@@ -64,44 +126,149 @@ class MergeServer(object):
         self.thread = threading.Thread(target=self.run)
         self.thread.daemon = True
         self.thread.start()
+        if self.maintenance_interval:
+            self.maintenance_thread = threading.Thread(
+                target=self.runMaintenance)
+            self.maintenance_thread.daemon = True
+            self.maintenance_thread.start()
 
     def register(self):
         self.worker.registerFunction("merger:merge")
         self.worker.registerFunction("merger:update")
+        for shard in self.shards:
+            self.worker.registerFunction("merger:merge:%d" % shard)
+            self.worker.registerFunction("merger:update:%d" % shard)
 
     def stop(self):
         self.log.debug("Stopping")
         self._running = False
+        self.maintenance_event.set()
+        # Wake the listener if it is waiting for a free slot
+        self.slot_semaphore.release()
         self.worker.shutdown()
         self.log.debug("Stopped")
 
     def join(self):
         self.thread.join()
+        if self.maintenance_thread:
+            self.maintenance_thread.join()
+
+    def _isIdle(self):
+        with self.slot_lock:
+            return not (self.active_slots or self.queued_slots)
+
+    def runMaintenance(self):
+        while self._running:
+            self.maintenance_event.wait(self.maintenance_interval)
+            if not self._running:
+                return
+            try:
+                self.maintain()
+            except Exception:
+                self.log.exception("Exception while maintaining repos")
+
+    def maintain(self):
+        """Prune old zuul refs and collect garbage in every repo.
+
+        Repos are only maintained while no jobs are running, and a repo
+        in use by a job is skipped, so maintenance never holds up merges
+        for more than the time taken to maintain a single repo.
+        """
+        self.log.debug("Starting repo maintenance")
+        for project in sorted(self.merger.repos.keys()):
+            while self._running and not self._isIdle():
+                self.maintenance_event.wait(10)
+            if not self._running:
+                return
+            locks = self.merger.getRepoLocks([project])
+            if not locks[0].acquire(False):
+                continue
+            try:
+                self.merger.maintainRepo(project, self.zuul_ref_max_age)
+            finally:
+                locks[0].release()
+        self.log.debug("Finished repo maintenance")
 
     def run(self):
         self.log.debug("Starting merge listener")
         while self._running:
+            # Only take a job from gearman when there is a free slot,
+            # so that other mergers may run it in the meantime.
+            self.slot_semaphore.acquire()
+            if not self._running:
+                break
             try:
                 job = self.worker.getJob()
-                try:
-                    if job.name == 'merger:merge':
-                        self.log.debug("Got merge job: %s" % job.unique)
-                        self.merge(job)
-                    elif job.name == 'merger:update':
-                        self.log.debug("Got update job: %s" % job.unique)
-                        self.update(job)
-                    else:
-                        self.log.error("Unable to handle job %s" % job.name)
-                        job.sendWorkFail()
-                except Exception:
-                    self.log.exception("Exception while running job")
-                    job.sendWorkException(traceback.format_exc())
             except Exception:
+                self.slot_semaphore.release()
                 self.log.exception("Exception while getting job")
+                continue
+            thread = threading.Thread(target=self.runJob, args=(job,))
+            thread.daemon = True
+            thread.start()
+
+    def runJob(self, job):
+        # Leave out the shard, if any
+        name = ':'.join(job.name.split(':')[:2])
+        try:
+            # Let the client know the job has started, so that it does
+            # not give its result to any later requests.
+            job.sendWorkStatus(0, 0)
+            if name == 'merger:merge':
+                self.log.debug("Got merge job: %s" % job.unique)
+                self.merge(job)
+            elif name == 'merger:update':
+                self.log.debug("Got update job: %s" % job.unique)
+                self.update(job)
+            else:
+                self.log.error("Unable to handle job %s" % job.name)
+                job.sendWorkFail()
+        except Exception:
+            self.log.exception("Exception while running job")
+            job.sendWorkException(traceback.format_exc())
+        finally:
+            self.slot_semaphore.release()
+
+    def _updateSlots(self, active=0, queued=0):
+        with self.slot_lock:
+            self.active_slots += active
+            self.queued_slots += queued
+            if statsd:
+                statsd.gauge(self.stats_prefix + '.slots.active',
+                             self.active_slots)
+                statsd.gauge(self.stats_prefix + '.slots.queued',
+                             self.queued_slots)
+
+    def _lockRepos(self, projects):
+        # Two jobs must never use the same repo at once.
+        self._updateSlots(queued=1)
+        locks = self.merger.getRepoLocks(projects)
+        for lock in locks:
+            lock.acquire()
+        self._updateSlots(active=1, queued=-1)
+        return locks
+
+    def _unlockRepos(self, locks):
+        for lock in reversed(locks):
+            lock.release()
+        self._updateSlots(active=-1)
 
     def merge(self, job):
         args = json.loads(job.arguments)
-        commit = self.merger.mergeChanges(args['items'])
+        locks = self._lockRepos([item['project'] for item in args['items']])
+
+        def itemMerged(item, commit):
+            # Let the scheduler use the items ahead while the rest of
+            # the series is merged.
+            data = dict(ref=item['ref'],
+                        commit=commit,
+                        zuul_url=self.zuul_url)
+            job.sendWorkData(json.dumps(data))
+
+        try:
+            commit = self.merger.mergeChanges(args['items'], itemMerged)
+        finally:
+            self._unlockRepos(locks)
         result = dict(merged=(commit is not None),
                       commit=commit,
                       zuul_url=self.zuul_url)
@@ -109,7 +276,12 @@ class MergeServer(object):
 
     def update(self, job):
         args = json.loads(job.arguments)
-        self.merger.updateRepo(args['project'], args['url'])
+        locks = self._lockRepos([args['project']])
+        try:
+            self.merger.updateRepo(args['project'], args['url'],
+                                   args.get('connection_name', 'default'))
+        finally:
+            self._unlockRepos(locks)
         result = dict(updated=True,
                       zuul_url=self.zuul_url)
         job.sendWorkComplete(json.dumps(result))
@@ -81,6 +81,7 @@ class Pipeline(object):
         self.job_trees = {}  # project -> JobTree
         self.manager = None
         self.queues = []
+        self._item_index = {}  # change index key -> [QueueItem]
         self.precedence = PRECEDENCE_NORMAL
         self.source = None
         self.start_actions = []
@@ -272,7 +273,26 @@ class Pipeline(object):
             items.extend(shared_queue.queue)
         return items
 
-    def formatStatusJSON(self, url_pattern=None):
+    def getItemsForChange(self, change):
+        """Return the items in any queue which may be for this change.
+
+        The items are returned in the order they were enqueued; callers
+        should still check them with equals() or isUpdateOf()."""
+        return list(self._item_index.get(change.getIndexKey(), []))
+
+    def _indexItem(self, item):
+        key = item.change.getIndexKey()
+        self._item_index.setdefault(key, []).append(item)
+
+    def _unindexItem(self, item):
+        key = item.change.getIndexKey()
+        items = self._item_index.get(key)
+        if items and item in items:
+            items.remove(item)
+            if not items:
+                del self._item_index[key]
+
+    def formatStatusJSON(self, url_pattern=None, version=0):
         j_pipeline = dict(name=self.name,
                           description=self.description)
         j_queues = []
@@ -289,7 +309,7 @@ class Pipeline(object):
                     if j_changes:
                         j_queue['heads'].append(j_changes)
                     j_changes = []
-                j_changes.append(e.formatJSON(url_pattern))
+                j_changes.append(e.getStatusJSON(url_pattern, version))
                 if (len(j_changes) > 1 and
                         (j_changes[-2]['remaining_time'] is not None) and
                         (j_changes[-1]['remaining_time'] is not None)):
@@ -317,6 +337,11 @@ class ChangeQueue(object):
         self.projects = []
         self._jobs = set()
         self.queue = []
+        self._item_index = {}  # change index key -> [QueueItem]
+        # Set whenever something which may affect the processing of
+        # this queue happens; cleared by the pipeline manager once it
+        # has processed the queue.
+        self.dirty = True
         self.window = window
         self.window_floor = window_floor
         self.window_increase_type = window_increase_type
@@ -361,38 +386,62 @@ class ChangeQueue(object):
         if self.queue:
             item.item_ahead = self.queue[-1]
             item.item_ahead.items_behind.append(item)
+            item.item_ahead.invalidateStatus()
         self.queue.append(item)
+        self._item_index.setdefault(
+            item.change.getIndexKey(), []).append(item)
+        self.pipeline._indexItem(item)
+        self.dirty = True
+        item.invalidateStatus()
 
     def dequeueItem(self, item):
         if item in self.queue:
             self.queue.remove(item)
+            key = item.change.getIndexKey()
+            self._item_index[key].remove(item)
+            if not self._item_index[key]:
+                del self._item_index[key]
+            self.pipeline._unindexItem(item)
+            self.dirty = True
         if item.item_ahead:
             item.item_ahead.items_behind.remove(item)
+            item.item_ahead.invalidateStatus()
         for item_behind in item.items_behind:
             if item.item_ahead:
                 item.item_ahead.items_behind.append(item_behind)
             item_behind.item_ahead = item.item_ahead
+            item_behind.invalidateStatus()
         item.item_ahead = None
         item.items_behind = []
         item.dequeue_time = time.time()
+        item.invalidateStatus()
 
     def moveItem(self, item, item_ahead):
         if item.item_ahead == item_ahead:
             return False
+        self.dirty = True
         # Remove from current location
         if item.item_ahead:
             item.item_ahead.items_behind.remove(item)
+            item.item_ahead.invalidateStatus()
         for item_behind in item.items_behind:
             if item.item_ahead:
                 item.item_ahead.items_behind.append(item_behind)
             item_behind.item_ahead = item.item_ahead
+            item_behind.invalidateStatus()
         # Add to new location
         item.item_ahead = item_ahead
         item.items_behind = []
         if item.item_ahead:
             item.item_ahead.items_behind.append(item)
+            item.item_ahead.invalidateStatus()
+        item.invalidateStatus()
         return True
 
+    def getItemsForChange(self, change):
+        """Return the items in this queue which may be for this change."""
+        return list(self._item_index.get(change.getIndexKey(), []))
+
     def mergeChangeQueue(self, other):
         for project in other.projects:
             self.addProject(project)
@@ -649,6 +698,12 @@ class BuildSet(object):
         self.failing_reasons = []
         self.merge_state = self.NEW
         self.tries = {}
+        # The launch parameters shared by every build, worked out when
+        # the first one is launched, and the items ahead they were
+        # worked out for.  A reset makes a new build set, so they never
+        # outlive the merge they describe.
+        self.parameters = None
+        self.parameters_items = None
 
     def __repr__(self):
         return '<BuildSet item: %s #builds: %s merge state: %s>' % (
@@ -667,6 +722,7 @@ class BuildSet(object):
                 next_item = next_item.item_ahead
         if not self.ref:
             self.ref = 'Z' + uuid4().hex
+            self.item.invalidateStatus()
 
     def getStateName(self, state_num):
         return self.states_map.get(
@@ -712,6 +768,13 @@ class QueueItem(object):
         self.reported = False
         self.active = False  # Whether an item is within an active window
         self.live = True  # Whether an item is intended to be processed at all
+        # The number of changes to the status, the cached result of
+        # formatJSON (with the number of changes and the url pattern it
+        # was formatted for), and the status version at which it was
+        # last rebuilt (see invalidateStatus).
+        self._status_changes = 0
+        self._status_cache = None
+        self.status_version = 0
 
     def __repr__(self):
         if self.pipeline:
@@ -721,6 +784,15 @@ class QueueItem(object):
         return '<QueueItem 0x%x for %s in %s>' % (
             id(self), self.change, pipeline)
 
+    def invalidateStatus(self):
+        # Mark the cached status fragment out of date so that it is
+        # rebuilt the next time the status is requested.  This must be
+        # called whenever anything shown by formatJSON changes.  It may
+        # be called while the fragment is being rebuilt in another
+        # thread, so rather than discard the fragment, count the
+        # change; a fragment started before it is not used again.
+        self._status_changes += 1
+
     def resetAllBuilds(self):
         old = self.current_build_set
         self.current_build_set.result = 'CANCELED'
@@ -728,16 +800,20 @@ class QueueItem(object):
         old.next_build_set = self.current_build_set
         self.current_build_set.previous_build_set = old
         self.build_sets.append(self.current_build_set)
+        self.invalidateStatus()
 
     def addBuild(self, build):
         self.current_build_set.addBuild(build)
         build.pipeline = self.pipeline
+        self.invalidateStatus()
 
     def removeBuild(self, build):
         self.current_build_set.removeBuild(build)
+        self.invalidateStatus()
 
     def setReportedResult(self, result):
         self.current_build_set.result = result
+        self.invalidateStatus()
 
     def formatJobResult(self, job, url_pattern=None):
         build = self.current_build_set.getBuild(job.name)
@@ -861,6 +937,42 @@ class QueueItem(object):
             ret['remaining_time'] = None
         return ret
 
+    def getStatusJSON(self, url_pattern=None, version=0):
+        """Return the status of this item, rebuilding it only if needed.
+
+        The output of formatJSON is cached until invalidateStatus is
+        called; when it is rebuilt, the item's status_version is set
+        to `version`.  Elapsed and remaining times of running builds
+        depend on the current time and are refreshed on every call.
+        """
+        changes = self._status_changes
+        cache = self._status_cache
+        if (cache is None or cache[0] != changes or
+                cache[1] != url_pattern):
+            cache = (changes, url_pattern, self.formatJSON(url_pattern))
+            self._status_cache = cache
+            self.status_version = version
+        ret = dict(cache[2])
+        ret['status_version'] = self.status_version
+        now = time.time()
+        jobs = []
+        max_remaining = 0
+        for job in ret['jobs']:
+            if job['start_time'] and not job['end_time']:
+                job = dict(job)
+                job['elapsed_time'] = int((now - job['start_time']) * 1000)
+                if job['estimated_time']:
+                    job['remaining_time'] = max(
+                        int(job['estimated_time'] * 1000) -
+                        job['elapsed_time'], 0)
+            if job['remaining_time'] and job['remaining_time'] > max_remaining:
+                max_remaining = job['remaining_time']
+            jobs.append(job)
+        ret['jobs'] = jobs
+        if ret['remaining_time'] is not None:
+            ret['remaining_time'] = max_remaining
+        return ret
+
     def formatStatus(self, indent=0, html=False):
         changeish = self.change
         indent_str = ' ' * indent
@@ -922,6 +1034,12 @@ class Changeish(object):
     def isUpdateOf(self, other):
         raise NotImplementedError()
 
+    def getIndexKey(self):
+        # Items are indexed within pipelines and change queues by
+        # this key.  Anything which equals() or isUpdateOf() this
+        # must have the same key.
+        return ('project', str(self.project))
+
     def filterJobs(self, jobs):
         return filter(lambda job: job.changeMatches(self), jobs)
 
@@ -961,6 +1079,9 @@ class Change(Changeish):
             return True
         return False
 
+    def getIndexKey(self):
+        return ('change', self.number)
+
     def isUpdateOf(self, other):
         if ((hasattr(other, 'number') and self.number == other.number) and
             (hasattr(other, 'patchset') and
@@ -1015,6 +1136,9 @@ class Ref(Changeish):
     def isUpdateOf(self, other):
         return False
 
+    def getIndexKey(self):
+        return ('ref', str(self.project), self.ref)
+
 
 class NullChange(Changeish):
     def __repr__(self):
@@ -1050,6 +1174,8 @@ class TriggerEvent(object):
         self.approvals = []
         self.branch = None
         self.comment = None
+        # Set if no pipeline can use the change, so it was not queried
+        self.skip_change_query = False
         # ref-updated
         self.ref = None
         self.oldrev = None
@@ -1230,6 +1356,21 @@ class EventFilter(BaseFilter):
         return ret
 
     def matches(self, event, change):
+        if not self.matchesEvent(event):
+            return False
+
+        # required approvals are ANDed (reject approvals are ORed)
+        if not self.matchesApprovals(change):
+            return False
+
+        return True
+
+    def matchesEvent(self, event):
+        """Return whether the event matches this filter.
+
+        Only the parts of the filter which depend on the event itself
+        are checked, so this may be used before the change is known.
+        """
         # event types are ORed
         matches_type = False
         for etype in self.types:
@@ -1309,10 +1450,6 @@ class EventFilter(BaseFilter):
             if not matches_approval:
                 return False
 
-        # required approvals are ANDed (reject approvals are ORed)
-        if not self.matchesApprovals(change):
-            return False
-
         # timespecs are ORed
         matches_timespec = False
         for timespec in self.timespecs:
@@ -1454,6 +1591,7 @@ class TimeDataBase(object):
     def __init__(self, root):
         self.root = root
         self.jobs = {}
+        self.unsaved = set()
 
     def _getTD(self, name):
         td = self.jobs.get(name)
@@ -1470,3 +1608,17 @@ class TimeDataBase(object):
         td = self._getTD(name)
         td.add(elapsed, result)
         td.save()
+        self.unsaved.discard(name)
+
+    def add(self, name, elapsed, result):
+        # Like update, but the data is not written out until save()
+        # is called, so that several results for a job cost one write.
+        td = self._getTD(name)
+        td.add(elapsed, result)
+        self.unsaved.add(name)
+
+    def save(self):
+        unsaved = self.unsaved
+        self.unsaved = set()
+        for name in sorted(unsaved):
+            self.jobs[name].save()
@@ -65,6 +65,9 @@ class MutexHandler(object):
 
     def __init__(self):
         self.mutexes = {}
+        # Builds which were canceled while holding a mutex, by mutex
+        # name; the mutex is kept until the cancel is confirmed.
+        self.canceled = {}
 
     def acquire(self, item, job):
         if not job.mutex:
@@ -75,6 +78,9 @@ class MutexHandler(object):
             # The mutex is not held, acquire it
             self._acquire(mutex_name, item, job.name)
             return True
+        if mutex_name in self.canceled:
+            # The build which holds the mutex may still be running
+            return False
         held_item, held_job_name = m
         if held_item is item and held_job_name == job.name:
             # This item already holds the mutex
@@ -91,6 +97,15 @@ class MutexHandler(object):
             return True
         return False
 
+    def isHeld(self, item, job):
+        if not job.mutex:
+            return False
+        m = self.mutexes.get(job.mutex)
+        if not m:
+            return False
+        held_item, held_job_name = m
+        return held_item is item and held_job_name == job.name
+
     def release(self, item, job):
         if not job.mutex:
             return
@@ -111,6 +126,27 @@ class MutexHandler(object):
                        "which does not hold it" %
                        (item,))
 
+    def cancel(self, item, build):
+        """Keep the mutex held by a canceled build until it stops."""
+        if not self.isHeld(item, build.job):
+            return
+        self.log.debug("Build %s of item %s canceled while holding "
+                       "mutex %s" % (build, item, build.job.mutex))
+        self.canceled[build.job.mutex] = build
+
+    def releaseCanceled(self, build):
+        """Release the mutex held by a canceled build.
+
+        Returns True if the build held a mutex which has been released.
+        """
+        mutex_name = build.job.mutex
+        if not mutex_name or self.canceled.get(mutex_name) is not build:
+            return False
+        del self.canceled[mutex_name]
+        held_item, held_job_name = self.mutexes[mutex_name]
+        self._release(mutex_name, held_item, held_job_name)
+        return True
+
     def _acquire(self, mutex_name, item, job_name):
         self.log.debug("Job %s of item %s acquiring mutex %s" %
                        (job_name, item, mutex_name))
@@ -206,6 +242,22 @@ class BuildCompletedEvent(ResultEvent):
         self.build = build
 
 
+class BuildCanceledEvent(ResultEvent):
+    """The launcher has finished canceling a build
+
+    :arg Build build: The build which was canceled.
+    :arg str outcome: How it was canceled: DEQUEUED if it was removed
+        from the queue before it started, STOPPED if it was asked to
+        stop, NOT_FOUND if it could not be found, NOT_LAUNCHED if it
+        was never submitted to gearman, or COMPLETED once a canceled
+        build has finished running.
+    """
+
+    def __init__(self, build, outcome):
+        self.build = build
+        self.outcome = outcome
+
+
 class MergeCompletedEvent(ResultEvent):
     """A remote merge operation has completed
 
@@ -214,14 +266,38 @@ class MergeCompletedEvent(ResultEvent):
     :arg bool merged: Whether the merge succeeded (changes with refs).
     :arg bool updated: Whether the repo was updated (changes without refs).
     :arg str commit: The SHA of the merged commit (changes with refs).
+    :arg str zuul_ref: The Zuul ref the merger created for the build
+        set, if it is not the build set's own (when it shared the merge
+        of another build set).
     """
 
-    def __init__(self, build_set, zuul_url, merged, updated, commit):
+    def __init__(self, build_set, zuul_url, merged, updated, commit,
+                 zuul_ref=None):
         self.build_set = build_set
         self.zuul_url = zuul_url
         self.merged = merged
         self.updated = updated
         self.commit = commit
+        self.zuul_ref = zuul_ref
+
+
+class ItemMergedEvent(ResultEvent):
+    """A remote merge operation has merged an item ahead of its last
+
+    :arg BuildSet build_set: The build_set waiting for the merge.
+    :arg str ref: The Zuul ref of the item which was merged.
+    :arg str zuul_url: The URL of the Zuul Merger.
+    :arg str commit: The SHA of the merged commit for the item.
+    :arg str zuul_ref: The Zuul ref the merger created for the item, if
+        it is not the item's own.
+    """
+
+    def __init__(self, build_set, ref, zuul_url, commit, zuul_ref=None):
+        self.build_set = build_set
+        self.ref = ref
+        self.zuul_url = zuul_url
+        self.commit = commit
+        self.zuul_ref = zuul_ref
 
 
 def toList(item):
@@ -234,6 +310,12 @@ def toList(item):
 
 class Scheduler(threading.Thread):
     log = logging.getLogger("zuul.Scheduler")
+    # Pipeline managers only process change queues which have been
+    # marked dirty; every queue is processed at least this often
+    # (in seconds) in case anything was missed.
+    queue_sweep_interval = 60
+    # The maximum number of result events handled in one batch.
+    result_batch_size = 100
 
     def __init__(self, config, testonly=False):
         threading.Thread.__init__(self)
@@ -267,6 +349,13 @@ class Scheduler(threading.Thread):
 
         self.zuul_version = zuul_version.version_info.release_string()
         self.last_reconfigured = None
+        self.last_queue_sweep = 0
+
+        # The status version is incremented whenever the formatted
+        # status differs from the previously formatted one.
+        self.status_lock = threading.Lock()
+        self.status_version = 0
+        self._status_signature = None
 
         # A set of reporter configuration keys to action mapping
         self._reporter_actions = {
@@ -653,6 +742,8 @@ class Scheduler(threading.Thread):
     def onBuildStarted(self, build):
         self.log.debug("Adding start event for build: %s" % build)
         build.start_time = time.time()
+        if build.build_set:
+            build.build_set.item.invalidateStatus()
         event = BuildStartedEvent(build)
         self.result_event_queue.put(event)
         self.wake_event.set()
@@ -667,6 +758,8 @@ class Scheduler(threading.Thread):
         # processed.  Ensure that any other data from the event (eg,
         # timing) is recorded before setting the result.
         build.result = result
+        if build.build_set:
+            build.build_set.item.invalidateStatus()
         try:
             if statsd and build.pipeline:
                 jobname = build.job.name.replace('.', '_')
@@ -700,11 +793,26 @@ class Scheduler(threading.Thread):
         self.wake_event.set()
         self.log.debug("Done adding complete event for build: %s" % build)
 
-    def onMergeCompleted(self, build_set, zuul_url, merged, updated, commit):
+    def onBuildCanceled(self, build, outcome):
+        self.log.debug("Adding cancel event for build: %s outcome: %s" % (
+            build, outcome))
+        event = BuildCanceledEvent(build, outcome)
+        self.result_event_queue.put(event)
+        self.wake_event.set()
+
+    def onMergeCompleted(self, build_set, zuul_url, merged, updated, commit,
+                         zuul_ref=None):
         self.log.debug("Adding merge complete event for build set: %s" %
                        build_set)
         event = MergeCompletedEvent(build_set, zuul_url,
-                                    merged, updated, commit)
+                                    merged, updated, commit, zuul_ref)
+        self.result_event_queue.put(event)
+        self.wake_event.set()
+
+    def onItemMerged(self, build_set, ref, zuul_url, commit, zuul_ref=None):
+        self.log.debug("Adding item merged event for build set: %s" %
+                       build_set)
+        event = ItemMergedEvent(build_set, ref, zuul_url, commit, zuul_ref)
         self.result_event_queue.put(event)
         self.wake_event.set()
 
@@ -856,6 +964,7 @@ class Scheduler(threading.Thread):
                                                                   last_head):
                             items_to_remove.append(item)
                 for item in items_to_remove:
+                    old_pipeline.source.unpinChanges(item)
                     for build in item.current_build_set.getBuilds():
                         builds_to_cancel.append(build)
                 for build in builds_to_cancel:
@@ -867,8 +976,11 @@ class Scheduler(threading.Thread):
                         self.log.exception(
                             "Exception while canceling build %s "
                             "for change %s" % (build, item.change))
+            for name, old_pipeline in self.layout.pipelines.items():
+                if name not in layout.pipelines:
+                    for item in old_pipeline.getAllItems():
+                        old_pipeline.source.unpinChanges(item)
             self.layout = layout
-            self.maintainConnectionCache()
             for trigger in self.triggers.values():
                 trigger.postConfig()
             for pipeline in self.layout.pipelines.values():
@@ -987,6 +1099,12 @@ class Scheduler(threading.Thread):
                 if self._pause and self._areAllBuildsComplete():
                     self._doPauseEvent()
 
+                if time.time() - self.last_queue_sweep > \
+                        self.queue_sweep_interval:
+                    self.log.debug("Marking all change queues dirty")
+                    self.markQueuesDirty()
+                    self.last_queue_sweep = time.time()
+
                 for pipeline in self.layout.pipelines.values():
                     while pipeline.manager.processQueue():
                         pass
@@ -998,18 +1116,9 @@ class Scheduler(threading.Thread):
             finally:
                 self.run_handler_lock.release()
 
-    def maintainConnectionCache(self):
-        relevant = set()
+    def markQueuesDirty(self):
         for pipeline in self.layout.pipelines.values():
-            self.log.debug("Gather relevant cache items for: %s" % pipeline)
-            for item in pipeline.getAllItems():
-                relevant.add(item.change)
-                relevant.update(item.change.getRelatedChanges())
-        for connection in self.connections.values():
-            connection.maintainCache(relevant)
-            self.log.debug(
-                "End maintain connection cache for: %s" % connection)
-        self.log.debug("Connection cache size: %s" % len(relevant))
+            pipeline.manager.markQueuesDirty()
 
     def process_event_queue(self):
         self.log.debug("Fetching trigger event")
@@ -1030,6 +1139,9 @@ class Scheduler(threading.Thread):
                                    "another connection trigger)",
                                    e.change, pipeline.source)
                     continue
+                # The change may have been updated, so anything in the
+                # pipeline which depends on it must be looked at again.
+                pipeline.manager.markQueuesDirty(change)
                 if not project or project.foreign:
                     self.log.debug("Project %s not found" % event.project_name)
                     continue
@@ -1063,27 +1175,73 @@ class Scheduler(threading.Thread):
         self.management_event_queue.task_done()
 
     def process_result_queue(self):
-        self.log.debug("Fetching result event")
-        event = self.result_event_queue.get()
-        self.log.debug("Processing result event %s" % event)
+        self.log.debug("Fetching result events")
+        if statsd:
+            statsd.gauge('zuul.scheduler.result_queue.depth',
+                         self.result_event_queue.qsize())
+        events = []
+        while len(events) < self.result_batch_size:
+            try:
+                events.append(self.result_event_queue.get(block=False))
+            except Queue.Empty:
+                break
+        self.log.debug("Processing %s result events" % len(events))
         try:
-            if isinstance(event, BuildStartedEvent):
-                self._doBuildStartedEvent(event)
-            elif isinstance(event, BuildCompletedEvent):
-                self._doBuildCompletedEvent(event)
-            elif isinstance(event, MergeCompletedEvent):
-                self._doMergeCompletedEvent(event)
-            else:
-                self.log.error("Unable to handle event %s" % event)
+            # Discard events for anything which is no longer current
+            # (for instance, builds canceled by a gate reset) before
+            # doing any work on the rest.
+            current = []
+            for event in events:
+                if self._isResultEventCurrent(event):
+                    current.append(event)
+                else:
+                    self.log.debug("Discarding result event %s for a build "
+                                   "set which is not current" % event)
+            if statsd:
+                statsd.gauge('zuul.scheduler.result_queue.batch_size',
+                             len(events))
+                if len(events) > len(current):
+                    statsd.incr('zuul.scheduler.result_queue.stale',
+                                len(events) - len(current))
+            for event in current:
+                self.log.debug("Processing result event %s" % event)
+                try:
+                    if isinstance(event, BuildStartedEvent):
+                        self._doBuildStartedEvent(event)
+                    elif isinstance(event, BuildCompletedEvent):
+                        self._doBuildCompletedEvent(event)
+                    elif isinstance(event, MergeCompletedEvent):
+                        self._doMergeCompletedEvent(event)
+                    elif isinstance(event, ItemMergedEvent):
+                        self._doItemMergedEvent(event)
+                    elif isinstance(event, BuildCanceledEvent):
+                        self._doBuildCanceledEvent(event)
+                    else:
+                        self.log.error("Unable to handle event %s" % event)
+                except Exception:
+                    self.log.exception("Exception processing result "
+                                       "event %s:" % event)
         finally:
-            self.result_event_queue.task_done()
+            # Build times from the whole batch are written out
+            # together, once per job.
+            try:
+                self.time_database.save()
+            except Exception:
+                self.log.exception("Exception recording build times:")
+            for event in events:
+                self.result_event_queue.task_done()
+
+    def _isResultEventCurrent(self, event):
+        if isinstance(event, (MergeCompletedEvent, ItemMergedEvent)):
+            build_set = event.build_set
+        elif isinstance(event, (BuildStartedEvent, BuildCompletedEvent)):
+            build_set = event.build.build_set
+        else:
+            return True
+        return build_set is build_set.item.current_build_set
 
     def _doBuildStartedEvent(self, event):
         build = event.build
-        if build.build_set is not build.build_set.item.current_build_set:
-            self.log.warning("Build %s is not in the current build set" %
-                             (build,))
-            return
         pipeline = build.build_set.item.pipeline
         if not pipeline:
             self.log.warning("Build %s is not associated with a pipeline" %
@@ -1094,14 +1252,11 @@ class Scheduler(threading.Thread):
                 build.job.name))
         except Exception:
             self.log.exception("Exception estimating build time:")
+        build.build_set.item.invalidateStatus()
         pipeline.manager.onBuildStarted(event.build)
 
     def _doBuildCompletedEvent(self, event):
         build = event.build
-        if build.build_set is not build.build_set.item.current_build_set:
-            self.log.warning("Build %s is not in the current build set" %
-                             (build,))
-            return
         pipeline = build.build_set.item.pipeline
         if not pipeline:
             self.log.warning("Build %s is not associated with a pipeline" %
@@ -1110,17 +1265,31 @@ class Scheduler(threading.Thread):
         if build.end_time and build.start_time and build.result:
             duration = build.end_time - build.start_time
             try:
-                self.time_database.update(
+                self.time_database.add(
                     build.job.name, duration, build.result)
             except Exception:
                 self.log.exception("Exception recording build time:")
         pipeline.manager.onBuildCompleted(event.build)
 
+    def _doBuildCanceledEvent(self, event):
+        # The build set has been replaced or dequeued, so there is
+        # nothing left to do but record how the cancel went and
+        # release any mutex the build held once it is no longer
+        # running.  A stopped build keeps its mutex until the launcher
+        # reports that it has completed.
+        build = event.build
+        self.log.info("Build %s canceled: %s" % (build, event.outcome))
+        if statsd:
+            statsd.incr('zuul.scheduler.canceled_builds.%s' %
+                        event.outcome.lower())
+        if event.outcome == 'STOPPED':
+            return
+        if self.mutex.releaseCanceled(build):
+            # Items in any pipeline may be waiting for the mutex
+            self.markQueuesDirty()
+
     def _doMergeCompletedEvent(self, event):
         build_set = event.build_set
-        if build_set is not build_set.item.current_build_set:
-            self.log.warning("Build set %s is not current" % (build_set,))
-            return
         pipeline = build_set.item.pipeline
         if not pipeline:
             self.log.warning("Build set %s is not associated with a pipeline" %
@@ -1128,39 +1297,82 @@ class Scheduler(threading.Thread):
             return
         pipeline.manager.onMergeCompleted(event)
 
-    def formatStatusJSON(self):
+    def _doItemMergedEvent(self, event):
+        build_set = event.build_set
+        pipeline = build_set.item.pipeline
+        if not pipeline:
+            self.log.warning("Build set %s is not associated with a pipeline" %
+                             (build_set,))
+            return
+        pipeline.manager.onItemMerged(event)
+
+    def formatStatus(self):
+        """Return the status of the system as a dictionary.
+
+        Item status is assembled from fragments cached on each
+        QueueItem, so only items which have changed since the last
+        call are re-formatted.  The returned status_version is
+        incremented whenever the result differs from the previous
+        call (other than the elapsed time of running builds).
+        """
         if self.config.has_option('zuul', 'url_pattern'):
             url_pattern = self.config.get('zuul', 'url_pattern')
         else:
             url_pattern = None
 
-        data = {}
-
-        data['zuul_version'] = self.zuul_version
-
-        if self._pause:
-            ret = '<p><b>Queue only mode:</b> preparing to '
-            if self._exit:
-                ret += 'exit'
-            ret += ', queue length: %s' % self.trigger_event_queue.qsize()
-            ret += '</p>'
-            data['message'] = ret
-
-        data['trigger_event_queue'] = {}
-        data['trigger_event_queue']['length'] = \
-            self.trigger_event_queue.qsize()
-        data['result_event_queue'] = {}
-        data['result_event_queue']['length'] = \
-            self.result_event_queue.qsize()
-
-        if self.last_reconfigured:
-            data['last_reconfigured'] = self.last_reconfigured * 1000
+        with self.status_lock:
+            version = self.status_version + 1
+            data = {}
+
+            data['zuul_version'] = self.zuul_version
+
+            if self._pause:
+                ret = '<p><b>Queue only mode:</b> preparing to '
+                if self._exit:
+                    ret += 'exit'
+                ret += ', queue length: %s' % self.trigger_event_queue.qsize()
+                ret += '</p>'
+                data['message'] = ret
+
+            data['trigger_event_queue'] = {}
+            data['trigger_event_queue']['length'] = \
+                self.trigger_event_queue.qsize()
+            data['result_event_queue'] = {}
+            data['result_event_queue']['length'] = \
+                self.result_event_queue.qsize()
+
+            if self.last_reconfigured:
+                data['last_reconfigured'] = self.last_reconfigured * 1000
+
+            # The signature captures everything in the status which is
+            # not part of an item fragment, so that we can tell whether
+            # anything has changed without comparing the output.
+            signature = [data.get('message'),
+                         data['trigger_event_queue']['length'],
+                         data['result_event_queue']['length'],
+                         data.get('last_reconfigured')]
+            changed = False
+            pipelines = []
+            data['pipelines'] = pipelines
+            for pipeline in self.layout.pipelines.values():
+                pipelines.append(pipeline.formatStatusJSON(url_pattern,
+                                                           version))
+                for queue in pipeline.queues:
+                    signature.append((pipeline.name, queue.name, queue.window,
+                                      [id(item) for item in queue.queue]))
+                    for item in queue.queue:
+                        if item.status_version == version:
+                            changed = True
+            if signature != self._status_signature:
+                self._status_signature = signature
+                changed = True
+            if changed:
+                self.status_version = version
+            data['status_version'] = self.status_version
+        return data
 
-        pipelines = []
-        data['pipelines'] = pipelines
-        for pipeline in self.layout.pipelines.values():
-            pipelines.append(pipeline.formatStatusJSON(url_pattern))
-        return json.dumps(data)
+    def formatStatusJSON(self):
+        return json.dumps(self.formatStatus())
 
 
 class BasePipelineManager(object):
@@ -1254,14 +1466,14 @@ class BasePipelineManager(object):
 
     def isChangeAlreadyInPipeline(self, change):
         # Checks live items in the pipeline
-        for item in self.pipeline.getAllItems():
+        for item in self.pipeline.getItemsForChange(change):
             if item.live and change.equals(item.change):
                 return True
         return False
 
     def isChangeAlreadyInQueue(self, change, change_queue):
         # Checks any item in the specified change queue
-        for item in change_queue.queue:
+        for item in change_queue.getItemsForChange(change):
             if change.equals(item.change):
                 return True
         return False
@@ -1324,14 +1536,31 @@ class BasePipelineManager(object):
                        [x.change for x in items]))
         return items
 
+    def markQueuesDirty(self, change=None):
+        """Mark change queues as needing to be processed.
+
+        If a change is supplied, only queues with items for that change
+        or for changes related to it are marked, otherwise every queue
+        in the pipeline is.
+        """
+        if change is None:
+            for queue in self.pipeline.queues:
+                queue.dirty = True
+            return
+        changes = set([change])
+        changes.update(change.getRelatedChanges())
+        for c in changes:
+            for item in self.pipeline.getItemsForChange(c):
+                item.queue.dirty = True
+
     def getItemForChange(self, change):
-        for item in self.pipeline.getAllItems():
+        for item in self.pipeline.getItemsForChange(change):
             if item.change.equals(change):
                 return item
         return None
 
     def findOldVersionOfChangeAlreadyInQueue(self, change):
-        for item in self.pipeline.getAllItems():
+        for item in self.pipeline.getItemsForChange(change):
             if not item.live:
                 continue
             if change.isUpdateOf(item.change):
@@ -1349,7 +1578,7 @@ class BasePipelineManager(object):
 
     def removeAbandonedChange(self, change):
         self.log.debug("Change %s abandoned, removing." % change)
-        for item in self.pipeline.getAllItems():
+        for item in self.pipeline.getItemsForChange(change):
             if not item.live:
                 continue
             if item.change.equals(change):
@@ -1361,6 +1590,7 @@ class BasePipelineManager(object):
                 self.log.debug("Re-enqueing change %s in queue %s" %
                                (item.change, change_queue))
                 change_queue.enqueueItem(item)
+                self.pipeline.source.pinChanges(item)
 
                 # Re-set build results in case any new jobs have been
                 # added to the tree.
@@ -1426,9 +1656,11 @@ class BasePipelineManager(object):
             self.log.debug("Adding change %s to queue %s" %
                            (change, change_queue))
             item = change_queue.enqueueChange(change)
+            self.pipeline.source.pinChanges(item)
             if enqueue_time:
                 item.enqueue_time = enqueue_time
             item.live = live
+            item.invalidateStatus()
             self.reportStats(item)
             if not quiet:
                 if len(self.pipeline.start_actions) > 0:
@@ -1442,6 +1674,7 @@ class BasePipelineManager(object):
     def dequeueItem(self, item):
         self.log.debug("Removing change %s from queue" % item.change)
         item.queue.dequeueItem(item)
+        self.pipeline.source.unpinChanges(item)
 
     def removeItem(self, item):
         # Remove an item from the queue, probably because it has been
@@ -1501,9 +1734,11 @@ class BasePipelineManager(object):
         else:
             self.log.debug("Preparing update repo for: %s" % item.change)
             url = self.pipeline.source.getGitUrl(item.change.project)
+            connection = self.pipeline.source.connection
             self.sched.merger.updateRepo(item.change.project.name,
                                          url, build_set,
-                                         self.pipeline.precedence)
+                                         self.pipeline.precedence,
+                                         connection.connection_name)
         # merge:merge has been emitted properly:
         build_set.merge_state = build_set.PENDING
         return False
@@ -1513,16 +1748,18 @@ class BasePipelineManager(object):
         dependent_items = self.getDependentItems(item)
         for job in jobs:
             self.log.debug("Found job %s for change %s" % (job, item.change))
-            try:
-                build = self.sched.launcher.launch(job, item,
-                                                   self.pipeline,
-                                                   dependent_items)
-                self.log.debug("Adding build %s of job %s to item %s" %
-                               (build, job, item))
-                item.addBuild(build)
-            except:
-                self.log.exception("Exception while launching job %s "
-                                   "for change %s:" % (job, item.change))
+        try:
+            builds = self.sched.launcher.launchJobs(jobs, item,
+                                                    self.pipeline,
+                                                    dependent_items)
+        except:
+            self.log.exception("Exception while launching jobs "
+                               "for change %s:" % item.change)
+            return
+        for build in builds:
+            self.log.debug("Adding build %s of job %s to item %s" %
+                           (build, build.job, item))
+            item.addBuild(build)
 
     def launchJobs(self, item):
         jobs = self.pipeline.findJobsToRun(item, self.sched.mutex)
@@ -1538,11 +1775,17 @@ class BasePipelineManager(object):
         for build in old_build_set.getBuilds():
             try:
                 self.sched.launcher.cancel(build)
+                # The mutex is released once the launcher confirms the
+                # build is no longer running.
+                self.sched.mutex.cancel(item, build)
             except:
                 self.log.exception("Exception while canceling build %s "
                                    "for change %s" % (build, item.change))
+                if self.sched.mutex.isHeld(item, build.job):
+                    self.sched.mutex.release(item, build.job)
             build.result = 'CANCELED'
             canceled = True
+        item.invalidateStatus()
         self.updateBuildDescriptions(old_build_set)
         for item_behind in item.items_behind:
             self.log.debug("Canceling jobs for change %s, behind change %s" %
@@ -1574,7 +1817,9 @@ class BasePipelineManager(object):
             return (True, nnfi)
         dep_items = self.getFailingDependentItems(item)
         actionable = change_queue.isActionable(item)
-        item.active = actionable
+        if item.active != actionable:
+            item.active = actionable
+            item.invalidateStatus()
         ready = False
         if dep_items:
             failing_reasons.append('a needed change is failing')
@@ -1621,7 +1866,11 @@ class BasePipelineManager(object):
             changed = True
         elif not failing_reasons and item.live:
             nnfi = item
-        item.current_build_set.failing_reasons = failing_reasons
+        if item.current_build_set.failing_reasons != failing_reasons:
+            item.current_build_set.failing_reasons = failing_reasons
+            item.invalidateStatus()
+            # Items in other queues may depend on this one
+            self.markQueuesDirty(item.change)
         if failing_reasons:
             self.log.debug("%s is a failing item because %s" %
                            (item, failing_reasons))
@@ -1632,6 +1881,9 @@ class BasePipelineManager(object):
         self.log.debug("Starting queue processor: %s" % self.pipeline.name)
         changed = False
         for queue in self.pipeline.queues:
+            if not queue.dirty:
+                continue
+            queue.dirty = False
             queue_changed = False
             nnfi = None  # Nearest non-failing item
             for item in queue.queue[:]:
@@ -1642,12 +1894,17 @@ class BasePipelineManager(object):
                 self.reportStats(item)
             if queue_changed:
                 changed = True
+                # Keep processing this queue until it settles
+                queue.dirty = True
                 status = ''
                 for item in queue.queue:
                     status += item.formatStatus()
                 if status:
                     self.log.debug("Queue %s status is now:\n %s" %
                                    (queue.name, status))
+        if not changed:
+            # Processing a later queue may have affected an earlier one
+            changed = any(queue.dirty for queue in self.pipeline.queues)
         self.log.debug("Finished queue processor: %s (changed: %s)" %
                        (self.pipeline.name, changed))
         return changed
@@ -1682,6 +1939,10 @@ class BasePipelineManager(object):
 
         self.pipeline.setResult(item, build)
         self.sched.mutex.release(item, build.job)
+        self.markQueuesDirty(item.change)
+        if build.job.mutex:
+            # Items in any pipeline may be waiting for the mutex
+            self.sched.markQueuesDirty()
         self.log.debug("Item %s status is now:\n %s" %
                        (item, item.formatStatus()))
         return True
@@ -1689,8 +1950,16 @@ class BasePipelineManager(object):
     def onMergeCompleted(self, event):
         build_set = event.build_set
         item = build_set.item
+        if build_set.merge_state == build_set.COMPLETE:
+            # The merge for an item behind this one got here first,
+            # and jobs may already be using its commit.
+            self.log.debug("Ignoring merge result for %s which was "
+                           "already merged" % item.change)
+            return
         build_set.merge_state = build_set.COMPLETE
         build_set.zuul_url = event.zuul_url
+        if event.zuul_ref:
+            build_set.ref = event.zuul_ref
         if event.merged:
             build_set.commit = event.commit
         elif event.updated:
@@ -1699,6 +1968,28 @@ class BasePipelineManager(object):
         if not build_set.commit and not isinstance(item.change, NullChange):
             self.log.info("Unable to merge change %s" % item.change)
             self.pipeline.setUnableToMerge(item)
+        self.markQueuesDirty(item.change)
+
+    def onItemMerged(self, event):
+        # The merge for this item has merged one of the items ahead,
+        # so that item need not wait for its own merge to finish.
+        item = event.build_set.item
+        while item.item_ahead:
+            item = item.item_ahead
+            build_set = item.current_build_set
+            if build_set.ref != event.ref:
+                continue
+            if build_set.merge_state != build_set.PENDING:
+                return
+            self.log.debug("Using commit %s merged for %s" %
+                           (event.commit, item.change))
+            build_set.merge_state = build_set.COMPLETE
+            build_set.zuul_url = event.zuul_url
+            build_set.commit = event.commit
+            if event.zuul_ref:
+                build_set.ref = event.zuul_ref
+            self.markQueuesDirty(item.change)
+            return
 
     def reportItem(self, item):
         if not item.reported:
@@ -52,6 +52,12 @@ class BaseSource(object):
     def postConfig(self):
         """Called after configuration has been processed."""
 
+    def pinChanges(self, item):
+        """Keep the changes used by an enqueued item cached."""
+
+    def unpinChanges(self, item):
+        """Release the changes pinned for an item."""
+
     @abc.abstractmethod
     def getChange(self, event, project):
         """Get the change representing an event."""
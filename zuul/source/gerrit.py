@@ -143,8 +143,29 @@ class GerritSource(BaseSource):
     def postConfig(self):
         pass
 
+    def pinChanges(self, item):
+        changes = set([item.change])
+        changes.update(item.change.getRelatedChanges())
+        keys = ['%s,%s' % (change.number, change.patchset)
+                for change in changes if isinstance(change, Change)]
+        self.connection.pinChanges(item, keys)
+
+    def unpinChanges(self, item):
+        self.connection.unpinChanges(item)
+
     def getChange(self, event, project):
         if event.change_number:
+            key = '%s,%s' % (event.change_number, event.patch_number)
+            if (event.skip_change_query and
+                    not self.connection.isChangeCached(key)):
+                # No pipeline can use the change, so rather than query
+                # it, use one with only what the event says about it.
+                change = Change(project)
+                change.number = event.change_number
+                change.patchset = event.patch_number
+                change.branch = event.branch
+                change.url = event.change_url
+                return change
             refresh = False
             change = self._getChange(event.change_number, event.patch_number,
                                      refresh=refresh)
@@ -158,23 +179,35 @@ class GerritSource(BaseSource):
             change = NullChange(project)
         return change
 
-    def _getChange(self, number, patchset, refresh=False, history=None):
-        key = '%s,%s' % (number, patchset)
-        change = self.connection.getCachedChange(key)
-        if change and not refresh:
-            return change
-        if not change:
-            change = Change(None)
-            change.number = number
-            change.patchset = patchset
-        key = '%s,%s' % (change.number, change.patchset)
-        self.connection.updateChangeCache(key, change)
+    def _getChange(self, number, patchset, refresh=False, history=None,
+                   related=None):
+        lock_key = '%s,%s' % (number, patchset)
+        # The event connector's workers update changes, and the changes
+        # related to them, at the same time; only one of them may
+        # update a change at once.
+        updating = self.connection.lockChange(lock_key)
+        if updating:
+            # Another thread is updating this change while this one
+            # updates a change related to it.
+            return updating
         try:
-            self._updateChange(change, history)
-        except Exception:
-            self.connection.deleteCachedChange(key)
-            raise
-        return change
+            change = self.connection.getCachedChange(lock_key, refresh)
+            if change and not refresh:
+                return change
+            if not change:
+                change = Change(None)
+                change.number = number
+                change.patchset = patchset
+            key = '%s,%s' % (change.number, change.patchset)
+            self.connection.updateChangeCache(key, change)
+            try:
+                self._updateChange(change, history, related)
+            except Exception:
+                self.connection.deleteCachedChange(key)
+                raise
+            return change
+        finally:
+            self.connection.unlockChange(lock_key)
 
     def getProjectOpenChanges(self, project):
         # This is a best-effort function in case Gerrit is unable to return
@@ -194,7 +227,7 @@ class GerritSource(BaseSource):
                                    (record.get('number'),))
         return changes
 
-    def _getDependsOnFromCommit(self, message, change):
+    def _getDependsOnFromCommit(self, message, related):
         records = []
         seen = set()
         for match in self.depends_on_re.findall(message):
@@ -203,39 +236,135 @@ class GerritSource(BaseSource):
                                (match,))
                 continue
             seen.add(match)
-            query = "change:%s" % (match,)
-            self.log.debug("Updating %s: Running query %s "
-                           "to find needed changes" %
-                           (change, query,))
-            records.extend(self.connection.simpleQuery(query))
+            records.extend(related['depends_on'][match])
         return records
 
-    def _getNeededByFromCommit(self, change_id, change):
-        records = []
+    def _getNeededByFromCommit(self, change_id, related):
+        return related['needed_by'][change_id]
+
+    def _queryDependsOn(self, change_ids, related):
+        # Look up the changes named by the Depends-On headers of the
+        # commit messages of a level of changes at once
+        change_ids = [x for x in change_ids
+                      if x not in related['depends_on']]
+        if not change_ids:
+            return
+        query = ' OR '.join(["change:%s" % (x,) for x in change_ids])
+        self.log.debug("Running query %s to find needed changes" %
+                       (query,))
+        for change_id in change_ids:
+            related['depends_on'][change_id] = []
+        for record in self.connection.simpleQuery(query):
+            if record.get('id') in related['depends_on']:
+                related['depends_on'][record['id']].append(record)
+
+    def _queryNeededBy(self, change_ids, related):
+        # Look up the changes whose commit messages depend on any of a
+        # level of changes at once
+        change_ids = [x for x in change_ids
+                      if x not in related['needed_by']]
+        if not change_ids:
+            return
+        query = ' OR '.join(["message:%s" % (x,) for x in change_ids])
+        self.log.debug("Running query %s to find changes needed-by" %
+                       (query,))
         seen = set()
-        query = 'message:%s' % change_id
-        self.log.debug("Updating %s: Running query %s "
-                       "to find changes needed-by" %
-                       (change, query,))
-        results = self.connection.simpleQuery(query)
-        for result in results:
+        for change_id in change_ids:
+            related['needed_by'][change_id] = []
+        for result in self.connection.simpleQuery(query):
             for match in self.depends_on_re.findall(
                 result['commitMessage']):
-                if match != change_id:
+                if match not in change_ids:
                     continue
-                key = (result['number'], result['currentPatchSet']['number'])
+                key = (match, result['number'],
+                       result['currentPatchSet']['number'])
                 if key in seen:
                     continue
-                self.log.debug("Updating %s: Found change %s,%s "
-                               "needs %s from commit" %
-                               (change, key[0], key[1], change_id))
+                self.log.debug("Found change %s,%s needs %s from commit" %
+                               (key[1], key[2], match))
                 seen.add(key)
-                records.append(result)
-        return records
+                related['needed_by'][match].append(result)
+
+    def _queryChanges(self, numbers):
+        # Fetch the data for several changes with one query, so that
+        # they need not be queried individually by _updateChange.
+        if not numbers:
+            return {}
+        self.log.debug("Querying changes %s" % (sorted(numbers),))
+        ret = {}
+        for data in self.connection.queryChanges(sorted(numbers)):
+            if 'number' in data:
+                ret[str(data['number'])] = data
+        return ret
+
+    def _getRelated(self, data):
+        # Updating a change updates the changes it needs and is needed
+        # by which are not already cached (or which must be
+        # refreshed), and so on.  Rather than query Gerrit for each of
+        # them in turn, walk those changes a level at a time, and fetch
+        # everything each level needs with one query of each kind.
+        related = dict(changes={}, depends_on={}, needed_by={})
+        level = [data]
+        while level:
+            level = [d for d in level if d and 'project' in d]
+            for d in level:
+                related['changes'][str(d['number'])] = d
+            # Merged changes are not looked at any further
+            level = [d for d in level if d['status'] != 'MERGED']
+            change_ids = []
+            for d in level:
+                change_ids.extend(self.depends_on_re.findall(
+                    d['commitMessage']))
+            self._queryDependsOn(change_ids, related)
+            self._queryNeededBy([d['id'] for d in level], related)
+
+            to_query = set()
+            for d in level:
+                for dep_num, dep_ps, refresh in (
+                        self._getNeeds(d, related) +
+                        self._getNeededBy(d, related)):
+                    if dep_num in related['changes']:
+                        continue
+                    if refresh or not self.connection.isChangeCached(
+                            '%s,%s' % (dep_num, dep_ps)):
+                        to_query.add(dep_num)
+            level = list(self._queryChanges(to_query).values())
+        return related
+
+    def _getNeeds(self, data, related):
+        # The changes a change needs, as (number, patchset, refresh)
+        needs = []
+        if 'dependsOn' in data:
+            parts = data['dependsOn'][0]['ref'].split('/')
+            needs.append((parts[3], parts[4], False))
+        for record in self._getDependsOnFromCommit(data['commitMessage'],
+                                                   related):
+            needs.append((str(record['number']),
+                          record['currentPatchSet']['number'], False))
+        return needs
+
+    def _getNeededBy(self, data, related):
+        # The changes which need a change, as (number, patchset, refresh)
+        needed_by = []
+        for needed in data.get('neededBy', []):
+            parts = needed['ref'].split('/')
+            needed_by.append((parts[3], parts[4], False))
+        for record in self._getNeededByFromCommit(data['id'], related):
+            # Because a commit needed-by may be a cross-repo
+            # dependency, cause that change to refresh so that it will
+            # reference the latest patchset of its Depends-On (this
+            # change).
+            needed_by.append((str(record['number']),
+                              record['currentPatchSet']['number'], True))
+        return needed_by
 
-    def _updateChange(self, change, history=None):
+    def _updateChange(self, change, history=None, related=None):
         self.log.info("Updating %s" % (change,))
-        data = self.connection.query(change.number)
+        if related and str(change.number) in related['changes']:
+            data = related['changes'][str(change.number)]
+        else:
+            data = self.connection.query(change.number)
+            related = None
         change._data = data
 
         if change.patchset is None:
@@ -279,36 +408,20 @@ class GerritSource(BaseSource):
             history = history[:]
         history.append(change.number)
 
-        needs_changes = []
-        if 'dependsOn' in data:
-            parts = data['dependsOn'][0]['ref'].split('/')
-            dep_num, dep_ps = parts[3], parts[4]
+        if related is None:
+            related = self._getRelated(data)
+        needs = self._getNeeds(data, related)
+        for dep_num, dep_ps, refresh in needs:
             if dep_num in history:
                 raise Exception("Dependency cycle detected: %s in %s" % (
                     dep_num, history))
-            self.log.debug("Updating %s: Getting git-dependent change %s,%s" %
-                           (change, dep_num, dep_ps))
-            dep = self._getChange(dep_num, dep_ps, history=history)
-            # Because we are not forcing a refresh in _getChange, it
-            # may return without executing this code, so if we are
-            # updating our change to add ourselves to a dependency
-            # cycle, we won't detect it.  By explicitly performing a
-            # walk of the dependency tree, we will.
-            detect_cycle(dep, history)
-            if (not dep.is_merged) and dep not in needs_changes:
-                needs_changes.append(dep)
 
-        for record in self._getDependsOnFromCommit(data['commitMessage'],
-                                                   change):
-            dep_num = record['number']
-            dep_ps = record['currentPatchSet']['number']
-            if dep_num in history:
-                raise Exception("Dependency cycle detected: %s in %s" % (
-                    dep_num, history))
-            self.log.debug("Updating %s: Getting commit-dependent "
-                           "change %s,%s" %
+        needs_changes = []
+        for dep_num, dep_ps, refresh in needs:
+            self.log.debug("Updating %s: Getting needed change %s,%s" %
                            (change, dep_num, dep_ps))
-            dep = self._getChange(dep_num, dep_ps, history=history)
+            dep = self._getChange(dep_num, dep_ps, history=history,
+                                  related=related)
             # Because we are not forcing a refresh in _getChange, it
             # may return without executing this code, so if we are
             # updating our change to add ourselves to a dependency
@@ -320,30 +433,22 @@ class GerritSource(BaseSource):
         change.needs_changes = needs_changes
 
         needed_by_changes = []
-        if 'neededBy' in data:
-            for needed in data['neededBy']:
-                parts = needed['ref'].split('/')
-                dep_num, dep_ps = parts[3], parts[4]
-                self.log.debug("Updating %s: Getting git-needed change %s,%s" %
-                               (change, dep_num, dep_ps))
-                dep = self._getChange(dep_num, dep_ps)
-                if (not dep.is_merged) and dep.is_current_patchset:
-                    needed_by_changes.append(dep)
-
-        for record in self._getNeededByFromCommit(data['id'], change):
-            dep_num = record['number']
-            dep_ps = record['currentPatchSet']['number']
-            self.log.debug("Updating %s: Getting commit-needed change %s,%s" %
+        for dep_num, dep_ps, refresh in self._getNeededBy(data, related):
+            self.log.debug("Updating %s: Getting needed-by change %s,%s" %
                            (change, dep_num, dep_ps))
-            # Because a commit needed-by may be a cross-repo
-            # dependency, cause that change to refresh so that it will
-            # reference the latest patchset of its Depends-On (this
-            # change).
-            dep = self._getChange(dep_num, dep_ps, refresh=True)
+            dep = self._getChange(dep_num, dep_ps, refresh=refresh,
+                                  related=related)
             if (not dep.is_merged) and dep.is_current_patchset:
                 needed_by_changes.append(dep)
         change.needed_by_changes = needed_by_changes
 
+        # The changes related to one which a queue item uses may only
+        # be found now, so they are kept in the cache for it as well.
+        self.connection.pinRelatedChanges(
+            '%s,%s' % (change.number, change.patchset),
+            ['%s,%s' % (dep.number, dep.patchset)
+             for dep in needs_changes + needed_by_changes])
+
         return change
 
     def getGitUrl(self, project):
@@ -34,9 +34,16 @@ The supported urls are:
    queue / pipeline structure of the system
  - /status.json (backwards compatibility): same as /status
  - /status/change/X,Y: return status just for gerrit change X,Y
+ - /status?since=N: return the status, but with the contents of any
+   change which has not changed since status version N replaced by
+   a stub of the form {"id": "X,Y", "unchanged": true}
 
 When returning status for a single gerrit change you will get an
 array of changes, they will not include the queue structure.
+
+The status version is returned as the ETag of the response, so
+clients may also send If-None-Match to receive a 304 response if
+nothing has changed.
 """
 
 
@@ -52,6 +59,9 @@ class WebApp(threading.Thread):
         self.cache_expiry = cache_expiry
         self.cache_time = 0
         self.cache = None
+        self.cache_data = None
+        self.cache_version = None
+        self.cache_lock = threading.Lock()
         self.daemon = True
         self.server = httpserver.serve(
             dec.wsgify(self.app), host=self.listen_address, port=self.port,
@@ -72,8 +82,7 @@ class WebApp(threading.Thread):
         is a flattened list of those collected changes.
         """
         status = []
-        jsonstruct = json.loads(self.cache)
-        for pipeline in jsonstruct['pipelines']:
+        for pipeline in self.cache_data['pipelines']:
             for change_queue in pipeline['change_queues']:
                 for head in change_queue['heads']:
                     for change in head:
@@ -87,6 +96,31 @@ class WebApp(threading.Thread):
             return change['id'] == rev
         return self._changes_by_func(func)
 
+    def _status_since(self, data, since):
+        """Return the status with unchanged items replaced by stubs."""
+        status = copy.copy(data)
+        pipelines = []
+        for pipeline in data['pipelines']:
+            pipeline = copy.copy(pipeline)
+            change_queues = []
+            for change_queue in pipeline['change_queues']:
+                change_queue = copy.copy(change_queue)
+                heads = []
+                for head in change_queue['heads']:
+                    changes = []
+                    for change in head:
+                        if change['status_version'] <= since:
+                            change = dict(id=change['id'], unchanged=True)
+                        changes.append(change)
+                    heads.append(changes)
+                change_queue['heads'] = heads
+                change_queues.append(change_queue)
+            pipeline['change_queues'] = change_queues
+            pipelines.append(pipeline)
+        status['pipelines'] = pipelines
+        status['since'] = since
+        return json.dumps(status)
+
     def _normalize_path(self, path):
         # support legacy status.json as well as new /status
         if path == '/status.json' or path == '/status':
@@ -101,20 +135,40 @@ class WebApp(threading.Thread):
         if path is None:
             raise webob.exc.HTTPNotFound()
 
-        if (not self.cache or
-            (time.time() - self.cache_time) > self.cache_expiry):
+        since = request.GET.get('since')
+        if since is not None:
             try:
-                self.cache = self.scheduler.formatStatusJSON()
-                # Call time.time() again because formatting above may take
-                # longer than the cache timeout.
-                self.cache_time = time.time()
-            except:
-                self.log.exception("Exception formatting status:")
-                raise
+                since = int(since)
+            except ValueError:
+                raise webob.exc.HTTPBadRequest()
+
+        with self.cache_lock:
+            if (not self.cache or
+                (time.time() - self.cache_time) > self.cache_expiry):
+                try:
+                    self.cache_data = self.scheduler.formatStatus()
+                    self.cache_version = self.cache_data['status_version']
+                    self.cache = json.dumps(self.cache_data)
+                    # Call time.time() again because formatting above may
+                    # take longer than the cache timeout.
+                    self.cache_time = time.time()
+                except:
+                    self.log.exception("Exception formatting status:")
+                    raise
+            cache = self.cache
+            cache_data = self.cache_data
+            cache_version = self.cache_version
 
         if path == 'status':
-            response = webob.Response(body=self.cache,
+            if since is not None and since == cache_version:
+                raise webob.exc.HTTPNotModified()
+            if since is not None and since < cache_version:
+                body = self._status_since(cache_data, since)
+            else:
+                body = cache
+            response = webob.Response(body=body,
                                       content_type='application/json')
+            response.etag = str(cache_version)
         else:
             status = self._status_for_change(path)
             if status: